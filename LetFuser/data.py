@@ -1,5 +1,6 @@
 import os
 import json
+import shutil
 import cv2
 from PIL import Image, ImageFile
 
@@ -18,181 +19,39 @@ class CARLA_Data(Dataset):
         self.seq_len = config.seq_len
         self.pred_len = config.pred_len
 
-        self.front = []
-        # self.left = []
-        # self.right = []
-        # self.rear = []
-        self.x = []
-        self.y = []
-        self.x_command = []
-        self.y_command = []
-        self.theta = []
-        self.steer = []
-        self.throttle = []
-        self.brake = []
-        self.command = []
-        self.velocity = []
-        self.seg_front = []
-        self.depth_front = []
-        self.red_light = []
-        self.stop_sign = []
+        self.sub_roots = []
+        self.indices = []
+        lengths = []
 
         for sub_root in root:
             if config.augment_control_data:
-                preload_file = os.path.join(sub_root, 'Letfuser_'+str(self.seq_len)+'_'+str(self.pred_len)+'.npy')
+                index_dir = os.path.join(sub_root, 'Letfuser_'+str(self.seq_len)+'_'+str(self.pred_len)+'.index')
             else:
-                preload_file = os.path.join(sub_root, 'Letfuser_noaugcntrl_'+str(self.seq_len)+'_'+str(self.pred_len)+'.npy')
-          
-            # dump to npy if no preload
-            if not os.path.exists(preload_file):
-                preload_front = []
-                # preload_left = []
-                # preload_right = []
-                # preload_rear = []
-                preload_x = []
-                preload_y = []
-                preload_x_command = []
-                preload_y_command = []
-                preload_theta = []
-                preload_steer = []
-                preload_throttle = []
-                preload_brake = []
-                preload_command = []
-                preload_velocity = []
-                preload_seg_front = []
-                preload_depth_front = []
-                preload_red_light = []
-                preload_stop_sign = []
-
-                # list sub-directories in root 
-                root_files = os.listdir(sub_root)
-                scenarios = [folder for folder in root_files if not os.path.isfile(os.path.join(sub_root,folder))]
-                # for route in routes:
-                #     routep = os.path.join(sub_root,route)
-                #     scn_files = os.listdir(routep)
-                #     scenarios = [folder for folder in scn_files if not os.path.isfile(os.path.join(routep,folder))]
-
-                for scenario in scenarios:
-
-                    scenario_dir = os.path.join(sub_root, scenario)
-                    # print(scenario_dir)
-                    # subtract final frames (pred_len) since there are no future waypoints
-                    # first frame of sequence not used
-                    num_seq = (len(os.listdir(scenario_dir+"/rgb/"))-self.pred_len-2)//self.seq_len
-                    for seq in range(num_seq):
-                        fronts = []
-                        # lefts = []
-                        # rights = []
-                        # rears = []
-                        xs = []
-                        ys = []
-                        thetas = []
-                        seg_fronts = []
-                        depth_fronts = []
-
-                        # read files sequentially (past and current frames)
-                        for i in range(self.seq_len):
-                            
-                            # images
-                            filename = f"{str(seq*self.seq_len+1+i).zfill(4)}.png"
-                            fronts.append(scenario_dir+"/rgb/"+filename)
-                            # lefts.append(route_dir+"/rgb_left/"+filename)
-                            # rights.append(route_dir+"/rgb_right/"+filename)
-                            # rears.append(route_dir+"/rgb_rear/"+filename)
-                            seg_fronts.append(scenario_dir+"/semantics/"+filename)
-                            depth_fronts.append(scenario_dir+"/depth/"+filename)
-
-                            # position
-                            with open(scenario_dir + f"/measurements/{str(seq*self.seq_len+1+i).zfill(4)}.json", "r") as read_file:
-                                data = json.load(read_file)
-                            xs.append(data['x'])
-                            ys.append(data['y'])
-                            thetas.append(data['theta'])
-
-                        # get control value of final frame in sequence
-                        preload_x_command.append(data['x_command'])
-                        preload_y_command.append(data['y_command'])
-                        preload_steer.append(data['steer'])
-                        preload_throttle.append(data['throttle'])
-                        preload_brake.append(data['brake'])
-                        preload_command.append(data['command'])
-                        preload_velocity.append(data['speed'])
-                        preload_red_light.append(data['light_hazard'])
-                        preload_stop_sign.append(data['stop_sign_hazard'])
-                        
-
-                        # read files sequentially (future frames)
-                        for i in range(self.seq_len, self.seq_len + self.pred_len):
-                            # position
-                            with open(scenario_dir + f"/measurements/{str(seq*self.seq_len+1+i).zfill(4)}.json", "r") as read_file:
-                                data = json.load(read_file)
-                            xs.append(data['x'])
-                            ys.append(data['y'])
-
-                            # fix for theta=nan in some measurements
-                            if np.isnan(data['theta']):
-                                thetas.append(0)
-                            else:
-                                thetas.append(data['theta'])
-
-                        preload_front.append(fronts)
-                        # preload_left.append(lefts)
-                        # preload_right.append(rights)
-                        # preload_rear.append(rears)
-                        preload_x.append(xs)
-                        preload_y.append(ys)
-                        preload_theta.append(thetas)
-                        preload_seg_front.append(seg_fronts)
-                        preload_depth_front.append(depth_fronts)
-
-                # dump to npy
-                preload_dict = {}
-                preload_dict['front'] = preload_front
-                # preload_dict['left'] = preload_left
-                # preload_dict['right'] = preload_right
-                # preload_dict['rear'] = preload_rear
-                preload_dict['x'] = preload_x
-                preload_dict['y'] = preload_y
-                preload_dict['x_command'] = preload_x_command
-                preload_dict['y_command'] = preload_y_command
-                preload_dict['theta'] = preload_theta
-                preload_dict['steer'] = preload_steer
-                preload_dict['throttle'] = preload_throttle
-                preload_dict['brake'] = preload_brake
-                preload_dict['command'] = preload_command
-                preload_dict['velocity'] = preload_velocity
-                preload_dict['seg_front'] = preload_seg_front
-                preload_dict['depth_front'] = preload_depth_front
-                preload_dict['red_light'] = preload_red_light
-                preload_dict['stop_sign'] = preload_stop_sign
-
-                np.save(preload_file, preload_dict)
-
-            # load from npy if available
-            preload_dict = np.load(preload_file, allow_pickle=True)
-            self.front += preload_dict.item()['front']
-            # self.left += preload_dict.item()['left']
-            # self.right += preload_dict.item()['right']
-            # self.rear += preload_dict.item()['rear']
-            self.x += preload_dict.item()['x']
-            self.y += preload_dict.item()['y']
-            self.x_command += preload_dict.item()['x_command']
-            self.y_command += preload_dict.item()['y_command']
-            self.theta += preload_dict.item()['theta']
-            self.steer += preload_dict.item()['steer']
-            self.throttle += preload_dict.item()['throttle']
-            self.brake += preload_dict.item()['brake']
-            self.command += preload_dict.item()['command']
-            self.velocity += preload_dict.item()['velocity']
-            self.seg_front += preload_dict.item()['seg_front']
-            self.depth_front += preload_dict.item()['depth_front']
-            self.red_light += preload_dict.item()['red_light']
-            self.stop_sign += preload_dict.item()['stop_sign']
-
-            print("Preloading " + str(len(preload_dict.item()['front'])) + " sequences from " + preload_file)
+                index_dir = os.path.join(sub_root, 'Letfuser_noaugcntrl_'+str(self.seq_len)+'_'+str(self.pred_len)+'.index')
+
+            # build the columnar index if there is none (or it is from an older version)
+            if read_index_version(index_dir) != INDEX_VERSION:
+                build_sample_index(sub_root, index_dir, self.seq_len, self.pred_len, config.augment_control_data)
+
+            # memory-map the columns, so workers share the page cache instead of copying lists
+            index = load_sample_index(index_dir)
+            self.sub_roots.append(sub_root)
+            self.indices.append(index)
+            lengths.append(len(index['frame']))
+
+            print("Preloading " + str(lengths[-1]) + " sequences from " + index_dir)
+
+        self.offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
 
     def __len__(self):
-        return len(self.front)
+        return int(self.offsets[-1])
+
+    def locate(self, index):
+        """
+        Map a global sample index to (sub_root id, row in that sub_root's index).
+        """
+        root_id = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        return root_id, index - int(self.offsets[root_id])
 
     def __getitem__(self, index):
         data = dict()
@@ -202,36 +61,28 @@ class CARLA_Data(Dataset):
         # data['rears'] = []
         data['seg_fronts'] = []
         data['depth_fronts'] = []
-        seq_fronts = self.front[index]
-        # seq_lefts = self.left[index]
-        # seq_rights = self.right[index]
-        # seq_rears = self.rear[index]
-        seq_x = self.x[index]
-        seq_y = self.y[index]
-        seq_theta = self.theta[index]
-        seq_seg_fronts = self.seg_front[index]
-        seq_depth_fronts = self.depth_front[index]
-
-        # print("=====================================================================")
-        # print(seq_fronts)
-        # print(seq_seg_fronts[-1])
-
-        for i in range(self.seq_len):
-            # fix for theta=nan in some measurements
-            if np.isnan(seq_theta[i]):
-                seq_theta[i] = 0.
+
+        root_id, row = self.locate(index)
+        sample = self.indices[root_id]
+        scenario_dir = os.path.join(self.sub_roots[root_id], index_scenario(sample, sample['scenario'][row]))
+        # only the last frame of the input sequence is used
+        filename = f"{str(int(sample['frame'][row])+self.seq_len-1).zfill(4)}.png"
+
+        seq_x = np.array(sample['x'][row])
+        seq_y = np.array(sample['y'][row])
+        seq_theta = np.array(sample['theta'][row])
 
         #input 1 RGB, no sequence
         data['fronts'] = torch.from_numpy(np.array(
-            scale_and_crop_image(Image.open(seq_fronts[-1]), scale=self.config.scale, crop=self.config.input_resolution))) #[ ]
+            scale_and_crop_image(Image.open(scenario_dir+"/rgb/"+filename), scale=self.config.scale, crop=self.config.input_resolution))) #[ ]
         data['seg_fronts'] = torch.from_numpy(np.array(cls2one_hot(
-            scale_and_crop_image_cv(cv2.imread(seq_seg_fronts[-1]), scale=self.config.scale, crop=self.config.input_resolution)))) #[ ]
+            scale_and_crop_image_cv(cv2.imread(scenario_dir+"/semantics/"+filename), scale=self.config.scale, crop=self.config.input_resolution)))) #[ ]
         data['depth_fronts'] = torch.from_numpy(np.array(rgb_to_depth(
-            scale_and_crop_image_cv(swap_RGB2BGR(cv2.imread(seq_depth_fronts[-1],cv2.COLOR_BGR2RGB)), scale=self.config.scale, crop=self.config.input_resolution)))) #[ ]
+            scale_and_crop_image_cv(swap_RGB2BGR(cv2.imread(scenario_dir+"/depth/"+filename,cv2.COLOR_BGR2RGB)), scale=self.config.scale, crop=self.config.input_resolution)))) #[ ]
 
-        ego_x = seq_x[i]
-        ego_y = seq_y[i]
-        ego_theta = seq_theta[i]   
+        ego_x = seq_x[self.seq_len-1]
+        ego_y = seq_y[self.seq_len-1]
+        ego_theta = seq_theta[self.seq_len-1]
 
         # lidar and waypoint processing to local coordinates
         waypoints = []
@@ -245,36 +96,217 @@ class CARLA_Data(Dataset):
 
         data['waypoints'] = waypoints
 
-
-        if config.augment_control_data:
-            for i in range(self.seq_len):
-                # fix for nan in some measurements
-                if np.isnan(self.steer[index][i]):
-                    self.steer[index][i] = 0.
-                if np.isnan(self.throttle[index][i]):
-                    self.throttle[index][i] = 0.
-                if np.isnan(self.brake[index][i]):
-                    self.brake[index][i] = False
-
         # convert x_command, y_command to local coordinates
         # taken from LBC code (uses 90+theta instead of theta)
         R = np.array([
             [np.cos(np.pi/2+ego_theta), -np.sin(np.pi/2+ego_theta)],
             [np.sin(np.pi/2+ego_theta),  np.cos(np.pi/2+ego_theta)]
             ])
-        local_command_point = np.array([self.x_command[index]-ego_x, self.y_command[index]-ego_y])
+        local_command_point = np.array([sample['x_command'][row]-ego_x, sample['y_command'][row]-ego_y])
         local_command_point = R.T.dot(local_command_point)
         data['target_point'] = tuple(local_command_point)
-        data['steer'] = self.steer[index]
-        data['throttle'] = self.throttle[index] 
-        data['brake'] = self.brake[index]
-        data['velocity'] = self.velocity[index]
-        data['red_light'] = self.red_light[index]
-        data['stop_sign'] = self.stop_sign[index]
-        data['command'] = self.command[index]
+        # augmented control data is stored as one column per step, plain control data as a scalar
+        data['steer'] = sample['steer'][row].tolist()
+        data['throttle'] = sample['throttle'][row].tolist()
+        data['brake'] = sample['brake'][row].tolist()
+        data['velocity'] = float(sample['velocity'][row])
+        data['red_light'] = bool(sample['red_light'][row])
+        data['stop_sign'] = bool(sample['stop_sign'][row])
+        data['command'] = int(sample['command'][row])
         
         return data
 
+
+# bump whenever the on-disk layout of the sample index changes, stale indices are rebuilt
+INDEX_VERSION = 4
+
+# per-route future control windows written by utilx/augmentcontroldata.py, keep in sync
+CONTROL_FILE = 'control_windows_%d.npz'
+
+# per-sample columns of the sample index and their on-disk dtypes
+INDEX_COLUMNS = {
+    'scenario': np.int32,     # row into the scenario path table
+    'frame': np.int32,        # frame number of the first input frame
+    'x': np.float64,          # [seq_len + pred_len]
+    'y': np.float64,          # [seq_len + pred_len]
+    'theta': np.float64,      # [seq_len + pred_len]
+    'x_command': np.float64,
+    'y_command': np.float64,
+    'steer': np.float32,      # scalar or [augmented seq_len]
+    'throttle': np.float32,   # scalar or [augmented seq_len]
+    'brake': np.bool_,        # scalar or [augmented seq_len]
+    'command': np.int32,
+    'velocity': np.float32,
+    'red_light': np.bool_,
+    'stop_sign': np.bool_,
+}
+
+
+def read_index_version(index_dir):
+    """
+    Return the version of the sample index in index_dir, or None if there is no usable index.
+    """
+    try:
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as read_file:
+            return json.load(read_file)['version']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def build_sample_index(sub_root, index_dir, seq_len, pred_len, augment_control_data):
+    """
+    Walk every scenario of sub_root once and write fixed-dtype columns (one .npy per column)
+    plus an offset-encoded table of scenario paths relative to sub_root.
+    """
+    columns = {name: [] for name in INDEX_COLUMNS}
+    scenario_names = []
+
+    # list sub-directories in root 
+    scenarios = sorted(folder for folder in os.listdir(sub_root) if os.path.isdir(os.path.join(sub_root, folder))
+                       and '.index' not in folder)
+
+    for scenario in scenarios:
+        scenario_dir = os.path.join(sub_root, scenario)
+        # subtract final frames (pred_len) since there are no future waypoints
+        # first frame of sequence not used
+        num_seq = (len(os.listdir(scenario_dir+"/rgb/"))-pred_len-2)//seq_len
+        if num_seq <= 0:
+            continue
+        scenario_id = len(scenario_names)
+        scenario_names.append(scenario)
+        # augmented control data comes from the route sidecar if there is one, otherwise from the measurements
+        control_windows = load_control_windows(scenario_dir, pred_len) if augment_control_data else None
+
+        for seq in range(num_seq):
+            xs = []
+            ys = []
+            thetas = []
+            # controls of the final frame in sequence and its successors, used if there is no sidecar window for it
+            control_window = {name: [] for name in ('steer', 'throttle', 'brake')}
+
+            # read measurements sequentially (past, current and future frames)
+            for i in range(seq_len + pred_len):
+                with open(scenario_dir + f"/measurements/{str(seq*seq_len+1+i).zfill(4)}.json", "r") as read_file:
+                    data = json.load(read_file)
+                xs.append(data['x'])
+                ys.append(data['y'])
+                thetas.append(data['theta'])
+
+                # get control value of final frame in sequence
+                if i == seq_len - 1:
+                    control = data
+                if seq_len - 1 <= i < seq_len - 1 + pred_len:
+                    for name in control_window:
+                        control_window[name].append(first_control(data[name]))
+
+            columns['scenario'].append(scenario_id)
+            columns['frame'].append(seq*seq_len+1)
+            columns['x'].append(xs)
+            columns['y'].append(ys)
+            columns['theta'].append(thetas)
+            columns['x_command'].append(control['x_command'])
+            columns['y_command'].append(control['y_command'])
+            if augment_control_data:
+                found = False
+                if control_windows is not None:
+                    frames, windows = control_windows
+                    frame = seq*seq_len+seq_len
+                    row = int(np.searchsorted(frames, frame))
+                    # a sidecar that is older than the measurements may miss the frame
+                    found = row < len(frames) and frames[row] == frame
+                # routes without a sidecar get the same [pred_len] windows, built from the measurements
+                for name in ('steer', 'throttle', 'brake'):
+                    columns[name].append(windows[name][row] if found else control_window[name])
+            else:
+                columns['steer'].append(control['steer'])
+                columns['throttle'].append(control['throttle'])
+                columns['brake'].append(control['brake'])
+            columns['command'].append(control['command'])
+            columns['velocity'].append(control['speed'])
+            columns['red_light'].append(control['light_hazard'])
+            columns['stop_sign'].append(control['stop_sign_hazard'])
+
+    arrays = {}
+    for name, dtype in INDEX_COLUMNS.items():
+        # brake is collected as float for the nan fix and stored as bool below
+        arrays[name] = np.asarray(columns[name], dtype=np.float32 if name == 'brake' else dtype)
+    if len(arrays['frame']) == 0:
+        for name in ('x', 'y', 'theta'):
+            arrays[name] = arrays[name].reshape(0, seq_len + pred_len)
+
+    # fix for theta=nan in some measurements
+    arrays['theta'] = np.nan_to_num(arrays['theta'], nan=0.)
+    if augment_control_data:
+        # fix for nan in some measurements
+        for name in ('steer', 'throttle', 'brake'):
+            arrays[name] = np.nan_to_num(arrays[name], nan=0.)
+    arrays['brake'] = arrays['brake'].astype(INDEX_COLUMNS['brake'])
+
+    encoded = [name.encode('utf-8') for name in scenario_names]
+    arrays['scenario_offsets'] = np.concatenate([[0], np.cumsum([len(name) for name in encoded], dtype=np.int64)])
+    arrays['scenario_paths'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    # write into a scratch directory and swap it in, so a crashed or concurrent build never leaves a half index
+    tmp_dir = index_dir + '.tmp' + str(os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as write_file:
+        json.dump({'version': INDEX_VERSION, 'seq_len': seq_len, 'pred_len': pred_len,
+                   'num_samples': int(len(arrays['frame']))}, write_file)
+
+    if os.path.isdir(index_dir):
+        shutil.rmtree(index_dir, ignore_errors=True)
+    try:
+        os.replace(tmp_dir, index_dir)
+    except OSError:
+        # another process won the race, its index is just as good
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_control_windows(scenario_dir, seq_len):
+    """
+    Load the future control windows of a route as (frame numbers [N], {control name: [N, seq_len]}),
+    or None if the route has no sidecar for seq_len.
+    """
+    sidecar = os.path.join(scenario_dir, CONTROL_FILE % seq_len)
+    if not os.path.isfile(sidecar):
+        return None
+    with np.load(sidecar) as arrays:
+        return arrays['frames'], {name: arrays[name] for name in ('steer', 'throttle', 'brake')}
+
+
+def first_control(value):
+    """
+    Control of a measurement. Measurements that were augmented in place by the old version of
+    utilx/augmentcontroldata.py hold a list that starts with the own control.
+    """
+    return value[0] if isinstance(value, list) else value
+
+
+def load_sample_index(index_dir):
+    """
+    Open every column of a sample index as a read-only np.memmap.
+    """
+    with open(os.path.join(index_dir, 'meta.json'), 'r') as read_file:
+        meta = json.load(read_file)
+    # zero-sized arrays cannot be memory-mapped
+    mmap_mode = 'r' if meta['num_samples'] > 0 else None
+
+    index = {}
+    for name in list(INDEX_COLUMNS) + ['scenario_offsets', 'scenario_paths']:
+        index[name] = np.load(os.path.join(index_dir, name + '.npy'), mmap_mode=mmap_mode)
+    return index
+
+
+def index_scenario(index, scenario_id):
+    """
+    Decode the scenario directory name of scenario_id from the offset-encoded path table.
+    """
+    start, end = index['scenario_offsets'][scenario_id], index['scenario_offsets'][scenario_id+1]
+    return bytes(index['scenario_paths'][start:end]).decode('utf-8')
+
+
 def swap_RGB2BGR(matrix):
     red = matrix[:,:,0].copy()
     blue = matrix[:,:,2].copy()
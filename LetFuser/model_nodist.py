@@ -1,4 +1,5 @@
 from collections import deque, OrderedDict
+import math
 import sys
 import numpy as np
 from torch import torch, cat, add, nn
@@ -149,6 +150,7 @@ class Attention_2D(nn.Module):
                  padding_kv=1,
                  padding_q=1,
                  with_cls_token=False,
+                 attention_backend='math',
                  ):
         super().__init__()
         self.stride_kv = stride_kv
@@ -158,6 +160,8 @@ class Attention_2D(nn.Module):
         # head_dim = self.qkv_dim // num_heads
         self.scale = dim_q ** -0.5
         self.with_cls_token = with_cls_token
+        # The fused kernel needs torch >= 2.0, older versions fall back to the explicit attention
+        self.use_sdpa = attention_backend == 'sdpa' and hasattr(F, 'scaled_dot_product_attention')
 
         self.conv_proj_q = self._build_projection(
             dim_q, dim_q, kernel_size, padding_q,
@@ -259,11 +263,16 @@ class Attention_2D(nn.Module):
         k = rearrange(self.proj_k(k), 'b t (h d) -> b h t d', h=self.num_heads)
         v = rearrange(self.proj_v(v), 'b t (h d) -> b h t d', h=self.num_heads)
 
-        attn_score = torch.einsum('bhlk,bhtk->bhlt', [q, k]) * self.scale
-        attn = F.softmax(attn_score, dim=-1)
-        attn = self.attn_drop(attn)
+        if self.use_sdpa:
+            # The scale is based on the full dim instead of the head dim, so q is rescaled for the default scale of the kernel
+            q = q * (self.scale * math.sqrt(q.shape[-1]))
+            x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0)
+        else:
+            attn_score = torch.einsum('bhlk,bhtk->bhlt', [q, k]) * self.scale
+            attn = F.softmax(attn_score, dim=-1)
+            attn = self.attn_drop(attn)
 
-        x = torch.einsum('bhlt,bhtv->bhlv', [attn, v])
+            x = torch.einsum('bhlt,bhtv->bhlv', [attn, v])
         x = rearrange(x, 'b h t d -> b t (h d)')
 
         x = self.proj(x)
@@ -282,7 +291,8 @@ class Fusion_Block(nn.Module):
                  attn_drop=0.,
                  drop_path=0.,
                  act_layer=nn.GELU,
-                 norm_layer=nn.LayerNorm):
+                 norm_layer=nn.LayerNorm,
+                 attention_backend='math'):
         super().__init__()
 
         self.with_cls_token = False
@@ -290,6 +300,7 @@ class Fusion_Block(nn.Module):
         self.norm1 = norm_layer(dim_in)
         self.attn = Attention_2D(
             dim_in, dim_out, num_heads, qkv_bias, attn_drop, drop,
+            attention_backend=attention_backend,
         )
 
         self.drop_path = DropPath(drop_path) \
@@ -399,6 +410,12 @@ class letfuser(nn.Module): #
         self.fx = 160  # 160 
         self.x_matrix = torch.vstack([torch.arange(-self.w/2, self.w/2)]*self.h) / self.fx
         self.x_matrix = self.x_matrix.to(device)
+        #camera splits of the semantic cloud: (first column, width, rot, height_coverage, width_coverage)
+        #a negative first column is counted from the right image border
+        self.sc_cameras = [(0, 224, 130, 120, 300), (-224, 224, -65, 120, 300), (224, 320, 0, 160, 320)]
+        #plans of the most recently used inputs, at most sc_plans_max are kept
+        self.sc_plans = OrderedDict()
+        self.sc_plans_max = 4
         #SC
         self.SC_encoder = models.efficientnet_b1(pretrained=False) 
         self.SC_encoder.features[0][0] = nn.Conv2d(config.n_class, config.n_fmap_b1[0][0], kernel_size=3, stride=2, padding=1, bias=False) 
@@ -513,6 +530,7 @@ class letfuser(nn.Module): #
                     drop_path=dpr[j],
                     act_layer=act_layer,
                     norm_layer=norm_layer,
+                    attention_backend=config.attention_backend,
                 )
                 )
             self.blocks = nn.ModuleList(blocks)
@@ -605,28 +623,7 @@ class letfuser(nn.Module): #
             big_top_view = big_top_view[:,:,0:wi,768-160:768+160]
             self.save2(gt_ss,big_top_view)
         
-        big_top_view = torch.zeros((bs,ly,2*wi,hi)).cuda()
-        for i in range(3):
-            if i==0:
-                width = 224 # 224
-                rot = 130 #60 # 43.3
-                height_coverage = 120
-                width_coverage = 300
-                big_top_view = self.gen_top_view_sc(big_top_view, depth_f[:,:,:,:width], ss_f[:,:,:,:width], rot, width, hi, height_coverage,width_coverage)
-            elif i==1:
-                width = 224 # 224
-                rot = -65 #-60 # -43.3
-                height_coverage = 120
-                width_coverage = 300
-                big_top_view = self.gen_top_view_sc(big_top_view, depth_f[:,:,:,-width:], ss_f[:,:,:,-width:], rot, width, hi, height_coverage,width_coverage)
-            elif i==2:
-                width = 320 # 320
-                rot = 0
-                height_coverage = 160
-                width_coverage = 320
-                big_top_view = self.gen_top_view_sc(big_top_view, depth_f[:,:,:,224:hi-224], ss_f[:,:,:,224:hi-224], rot, width, hi,height_coverage,width_coverage)
-
-        top_view_sc = big_top_view[:,:,:wi,:]
+        top_view_sc = self.gen_top_view_sc_fused(depth_f, ss_f)
 
         #downsampling section
         #------------------------------------------------------------------------------------------------
@@ -867,6 +864,100 @@ class letfuser(nn.Module): #
 
         return big_top_view
   
+    def get_sc_plan(self, n_class, im_height, im_width, device):
+        """
+        Constant tensors of the semantic cloud rasterizer, cached on the device per
+        (classes, image size, camera splits, device) so nothing is rebuilt on the CPU per frame.
+        big_top_view only ever holds 0/1 and torchvision rotate is a nearest neighbour gather, so the
+        write+rotate passes of gen_top_view_sc reduce to a fixed map from the grid cells of every camera
+        split to the pixels of top_view_sc (dest_idx). It is precomputed by running the same rotations
+        on images of cell ids, so the result is identical to the sequential passes.
+        """
+        key = (n_class, im_height, im_width, tuple(self.sc_cameras), str(device))
+        if key in self.sc_plans:
+            self.sc_plans.move_to_end(key)
+            return self.sc_plans[key]
+
+        cols, x_matrix, x_max, row_len, cell_offset, cov_h, cov_w = [], [], [], [], [], [], []
+        offset = 0
+        for first_col, width, rot, height_coverage, width_coverage in self.sc_cameras:
+            first_col = first_col % im_width
+            cols.append(torch.arange(first_col, first_col+width))
+            x_matrix.append(torch.arange(-width//2, width//2) / self.fx)
+            x_max.append(torch.full((width,), width-1))
+            row_len.append(torch.full((width,), width))
+            cell_offset.append(torch.full((width,), offset))
+            cov_h.append(torch.full((width,), 64/256*height_coverage))
+            cov_w.append(torch.full((width,), 64/256*width_coverage))
+            offset += self.h*width
+        n_cells = offset
+        n_pixels = self.h*im_width
+
+        #run the rotations of gen_top_view_sc on images of cell ids (+1, rotate fills with 0)
+        id_views = torch.zeros((len(self.sc_cameras), 1, 2*self.h, im_width), device=device)
+        offset = 0
+        for i, (_, width, rot, _, _) in enumerate(self.sc_cameras):
+            cell_ids = torch.arange(offset+1, offset+1+self.h*width, dtype=torch.float32).view(self.h, width)
+            id_views[i,0,0:self.h,(im_width-width)//2:(im_width+width)//2] = cell_ids.to(device)
+            if rot != 0:
+                id_views = rotate(id_views, rot)
+            offset += self.h*width
+        source_idx = id_views[:,0,:self.h,:].reshape(len(self.sc_cameras), -1).round().long() - 1
+
+        #invert to cell -> pixels, a cell can land on several pixels (or none) after nearest resampling
+        pixel = torch.arange(n_pixels, device=device).repeat(len(self.sc_cameras))
+        source_idx = source_idx.ravel()
+        pixel, source_idx = pixel[source_idx >= 0], source_idx[source_idx >= 0]
+        source_idx, order = torch.sort(source_idx, stable=True)
+        pixel = pixel[order]
+        first = torch.searchsorted(source_idx, source_idx)
+        rank = torch.arange(len(source_idx), device=device) - first
+        n_dest = int(rank.max().item()) + 1 if len(rank) > 0 else 1
+        dest_idx = torch.full((n_cells, n_dest), n_pixels, dtype=torch.long, device=device) #n_pixels is a dummy pixel
+        dest_idx[source_idx, rank] = pixel
+
+        plan = {
+            'cols': torch.cat(cols).to(device),
+            'x_matrix': torch.cat(x_matrix).to(device),
+            'x_max': torch.cat(x_max).float().to(device),
+            'row_len': torch.cat(row_len).to(device),
+            'cell_offset': torch.cat(cell_offset).to(device),
+            'cov_h': torch.cat(cov_h).float().to(device),
+            'cov_w': torch.cat(cov_w).float().to(device),
+            'n_pixels': n_pixels,
+            'dest_idx': dest_idx,
+        }
+        self.sc_plans[key] = plan
+        if len(self.sc_plans) > self.sc_plans_max:
+            self.sc_plans.popitem(last=False)
+        return plan
+
+    def gen_top_view_sc_fused(self, depth, semseg):
+        #rasterize all camera splits of gen_top_view_sc straight into the rotated frame, returns big_top_view[:,:,:h,:]
+        bs, n_class, im_height, im_width = semseg.shape
+        plan = self.get_sc_plan(n_class, im_height, im_width, depth.device)
+
+        if depth.dim() == 4:
+            depth = depth[:,0]
+        depth_in = depth[:,:,plan['cols']] * 1000.0 #normalisasi ke 1 - 1000
+        _, label_img = torch.max(semseg, dim=1) #pada axis C
+        label_img = label_img[:,:,plan['cols']]
+
+        #normalize to frames, same arithmetic as gen_top_view_sc with per column constants
+        cloud_data_x = torch.round(((depth_in * plan['x_matrix']) + (plan['cov_w']/2)) * plan['x_max'] / plan['cov_w'])
+        cloud_data_z = torch.round((depth_in * -(self.h-1) / plan['cov_h']) + (self.h-1))
+        bool_xz = torch.logical_and(torch.logical_and(cloud_data_x <= plan['x_max'], cloud_data_x >= 0), torch.logical_and(cloud_data_z <= self.h-1, cloud_data_z >= 0))
+
+        #one index_put of every point to all pixels its cell lands on, duplicates all write 1.0 so no unique is needed
+        cell = plan['cell_offset'] + cloud_data_z.long()*plan['row_len'] + cloud_data_x.long()
+        batch_offset = (torch.arange(bs, device=semseg.device)*n_class*(plan['n_pixels']+1)).view(bs, 1, 1)
+        n_pix = batch_offset + label_img*(plan['n_pixels']+1)
+        idx = n_pix[bool_xz].unsqueeze(1) + plan['dest_idx'][cell[bool_xz]]
+        top_view_sc = torch.zeros(bs*n_class*(plan['n_pixels']+1), dtype=semseg.dtype, device=semseg.device)
+        top_view_sc[idx.ravel()] = 1.0
+
+        return top_view_sc.view(bs, n_class, plan['n_pixels']+1)[:,:,:plan['n_pixels']].reshape(bs, n_class, self.h, im_width)
+
     def gen_top_view_sc_old(self, depth, semseg): #,rgb_f
         #proses awal
         depth_in = depth * 1000.0 #normalize to 1 - 1000
@@ -2,11 +2,15 @@ import os
 import json
 from PIL import Image
 
+import sys
 import numpy as np
-import random
 import torch 
 from torch.utils.data import Dataset
 
+# The LiDAR splatting is shared with transfuser_pami
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'transfuser_pami', 'team_code_transfuser'))
+from lidar_splat import LidarSplatter, sample_cell_points
+
 
 class CARLA_Data(Dataset):
 
@@ -271,36 +275,11 @@ def correspondences_at_one_scale(valid_bev_points, valid_cam_points, crop, scale
     """
     Compute projections between LiDAR BEV and image space
     """
-    cam_to_bev_proj_locs = np.zeros((crop[1], crop[0], 5, 2))
-    bev_to_cam_proj_locs = np.zeros((crop[1], crop[0], 5, 2))
-
-    tmp_bev = np.empty((crop[1], crop[0], ), dtype=object)
-    tmp_cam = np.empty((crop[1], crop[0], ), dtype=object)
-    for i in range(crop[1]):
-        for j in range(crop[0]):
-            tmp_bev[i,j] = []
-            tmp_cam[i,j] = []
-
-    for i in range(valid_bev_points.shape[0]):
-        tmp_bev[valid_bev_points[i][0]//scale, valid_bev_points[i][1]//scale].append(valid_cam_points[i]//scale)
-        tmp_cam[valid_cam_points[i][0]//scale, valid_cam_points[i][1]//scale].append(valid_bev_points[i]//scale)
-
-    for i in range(crop[1]):
-        for j in range(crop[0]):
-            cam_to_bev_points = tmp_bev[i,j]
-            bev_to_cam_points = tmp_cam[i,j]
-
-            if len(cam_to_bev_points) > 5:
-                cam_to_bev_proj_locs[i,j] = np.array(random.sample(cam_to_bev_points, 5))
-            elif len(cam_to_bev_points) > 0:
-                num_points = len(cam_to_bev_points)
-                cam_to_bev_proj_locs[i,j,:num_points] = np.array(cam_to_bev_points)
-
-            if len(bev_to_cam_points) > 5:
-                bev_to_cam_proj_locs[i,j] = np.array(random.sample(bev_to_cam_points, 5))
-            elif len(bev_to_cam_points) > 0:
-                num_points = len(bev_to_cam_points)
-                bev_to_cam_proj_locs[i,j,:num_points] = np.array(bev_to_cam_points)
+    valid_bev_points = np.asarray(valid_bev_points, dtype=np.int64).reshape(-1, 2) // scale
+    valid_cam_points = np.asarray(valid_cam_points, dtype=np.int64).reshape(-1, 2) // scale
+
+    cam_to_bev_proj_locs = sample_cell_points(valid_bev_points, valid_cam_points, crop[1], crop[0])
+    bev_to_cam_proj_locs = sample_cell_points(valid_cam_points, valid_bev_points, crop[1], crop[0])
 
     return cam_to_bev_proj_locs, bev_to_cam_proj_locs
 
@@ -338,22 +317,12 @@ def lidar_bev_cam_correspondences(world, config, crop=256):
     end_x = start_x + crop[0]
     end_y = start_y + crop[1]
 
-    valid_lidar_points = []
-    valid_bev_points = []
-    valid_cam_points = []
-    for i in range(lidar.shape[0]):
-        if result[i][0] >= start_x and result[i][0] < end_x and result[i][1] >= start_y and result[i][1] < end_y:
-            result[i][0] -= start_x
-            result[i][1] -= start_y
-            valid_lidar_points.append(lidar[i])
-            valid_cam_points.append([int(result[i][0]), int(result[i][1])])
-            bev_x = min(int((lidar[i][0] + 16) * pixels_per_world), crop[0]-1)
-            bev_y = min(int(lidar[i][1] * pixels_per_world), crop[1]-1)
-            valid_bev_points.append([bev_x, bev_y])
-
-    valid_lidar_points = np.array(valid_lidar_points)
-    valid_bev_points = np.array(valid_bev_points)
-    valid_cam_points = np.array(valid_cam_points)
+    valid = (result[:,0] >= start_x) & (result[:,0] < end_x) & (result[:,1] >= start_y) & (result[:,1] < end_y)
+    valid_lidar = lidar[valid]
+    valid_cam_points = (result[valid] - [start_x, start_y]).astype(np.int64)
+    bev_x = np.minimum(((valid_lidar[:,0] + 16) * pixels_per_world).astype(np.int64), crop[0]-1)
+    bev_y = np.minimum((valid_lidar[:,1] * pixels_per_world).astype(np.int64), crop[1]-1)
+    valid_bev_points = np.stack([bev_x, bev_y], axis=1)
 
     bev_points, cam_points = correspondences_at_one_scale(valid_bev_points, valid_cam_points, [config.vert_anchors, config.horz_anchors], 32) #8,32
 
@@ -364,27 +333,14 @@ def lidar_to_histogram_features(lidar, crop=256):
     """
     Convert LiDAR point cloud into 2-bin histogram over 256x256 grid
     """
-    def splat_points(point_cloud):
-        # 256 x 256 grid
-        pixels_per_meter = 8
-        hist_max_per_pixel = 5
-        x_meters_max = int(crop[1]/pixels_per_meter/2)#16 
-        y_meters_max = int(crop[0]/pixels_per_meter) #32
-        xbins = np.linspace(-2*x_meters_max, 2*x_meters_max+1, 2*x_meters_max*pixels_per_meter+1)
-        ybins = np.linspace(-y_meters_max, 0, y_meters_max*pixels_per_meter+1)
-        hist = np.histogramdd(point_cloud[...,:2], bins=(xbins, ybins))[0]
-        hist[hist>hist_max_per_pixel] = hist_max_per_pixel
-        overhead_splat = hist/hist_max_per_pixel
-        return overhead_splat
-
-    below = lidar[lidar[...,2]<=2]
-    above = lidar[lidar[...,2]>2]
-    below_features = splat_points(below)
-    above_features = splat_points(above)
-    features = np.stack([below_features, above_features], axis=-1)
-    features = np.transpose(features, (2, 0, 1)).astype(np.float32)
-
-    return features
+    # 256 x 256 grid
+    pixels_per_meter = 8
+    x_meters_max = int(crop[1]/pixels_per_meter/2)#16
+    y_meters_max = int(crop[0]/pixels_per_meter) #32
+    # first bin: below, second bin: above
+    splatter = LidarSplatter(x_min=-2*x_meters_max, x_max=2*x_meters_max+1, y_min=-y_meters_max, y_max=0, height_threshold=2,
+                             num_x=2*x_meters_max*pixels_per_meter, num_y=y_meters_max*pixels_per_meter, rotate=False)
+    return splatter(lidar)
 
 
 def scale_and_crop_image(image, scale=1, crop=256):
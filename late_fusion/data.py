@@ -2,10 +2,18 @@ import os
 import json
 from PIL import Image
 
+import sys
 import numpy as np
 import torch 
 from torch.utils.data import Dataset
 
+# The LiDAR splatting is shared with transfuser_pami
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'transfuser_pami', 'team_code_transfuser'))
+from lidar_splat import LidarSplatter
+
+# 256 x 256 grid, 8 pixels per meter, first bin: below, second bin: above
+LIDAR_SPLATTER = LidarSplatter(x_min=-32, x_max=33, y_min=-32, y_max=0, height_threshold=2, num_x=256, num_y=256, rotate=False)
+
 
 class CARLA_Data(Dataset):
 
@@ -266,26 +274,7 @@ def lidar_to_histogram_features(lidar, crop=256):
     """
     Convert LiDAR point cloud into 2-bin histogram over 256x256 grid
     """
-    def splat_points(point_cloud):
-        # 256 x 256 grid
-        pixels_per_meter = 8
-        hist_max_per_pixel = 5
-        x_meters_max = 16
-        y_meters_max = 32
-        xbins = np.linspace(-2*x_meters_max, 2*x_meters_max+1, 2*x_meters_max*pixels_per_meter+1)
-        ybins = np.linspace(-y_meters_max, 0, y_meters_max*pixels_per_meter+1)
-        hist = np.histogramdd(point_cloud[...,:2], bins=(xbins, ybins))[0]
-        hist[hist>hist_max_per_pixel] = hist_max_per_pixel
-        overhead_splat = hist/hist_max_per_pixel
-        return overhead_splat
-
-    below = lidar[lidar[...,2]<=2]
-    above = lidar[lidar[...,2]>2]
-    below_features = splat_points(below)
-    above_features = splat_points(above)
-    features = np.stack([below_features, above_features], axis=-1)
-    features = np.transpose(features, (2, 0, 1)).astype(np.float32)
-    return features
+    return LIDAR_SPLATTER(lidar)
 
 
 def scale_and_crop_image(image, scale=1, crop=256):
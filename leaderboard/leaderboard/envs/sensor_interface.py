@@ -1,9 +1,9 @@
-import copy
 import logging
 import numpy as np
 import os
+import sys
 import time
-from threading import Thread
+from threading import Lock, Thread
 
 from queue import Queue
 from queue import Empty
@@ -130,6 +130,62 @@ class OpenDriveMapReader(BaseReader):
         return {'opendrive': CarlaDataProvider.get_map().to_opendrive()}
 
 
+class SensorBufferPool(object):
+
+    """
+    Preallocated arrays for the sensor data, so the bytes of a CARLA measurement are copied exactly once, from the
+    CARLA buffer into an array of the pool, and the agent gets read-only views of it.
+    A buffer belongs to the frame it was filled for as long as any view of it is alive (numpy views keep a reference
+    to the array that owns the memory), so agents that keep data of older frames, e.g. in an input buffer, keep it
+    valid. Only buffers without views are refilled, if there is none a new one is allocated.
+    """
+
+    # References to a free buffer during the check: the pool list, the local variable and the argument of getrefcount
+    FREE_REFCOUNT = 3
+
+    def __init__(self, max_buffers=4, headroom=1.1):
+        self._max_buffers = max_buffers
+        self._headroom = headroom
+        self._buffers = {}
+        self._lock = Lock()
+
+    def acquire(self, tag, size, dtype):
+        """
+        Returns a writable flat array of size elements that no view points to, backed by a pooled buffer of the tag
+        """
+        with self._lock:
+            buffers = self._buffers.setdefault(tag, [])
+            for i in range(len(buffers)):
+                buffer = buffers[i]
+                if sys.getrefcount(buffer) == self.FREE_REFCOUNT:
+                    if buffer.dtype != dtype or buffer.size < size:
+                        # e.g. a LiDAR sweep with more points than before
+                        buffer = np.empty(int(size * self._headroom), dtype=dtype)
+                        buffers[i] = buffer
+                    return buffer[:size]
+
+            buffer = np.empty(int(size * self._headroom), dtype=dtype)
+            if len(buffers) < self._max_buffers:
+                buffers.append(buffer)
+            return buffer[:size]
+
+    def fill(self, tag, raw_data, dtype, shape):
+        """
+        Copies the raw bytes of a measurement into a buffer of the tag and returns a read-only view with the given
+        shape, a -1 in the shape is inferred from the size of the data
+        """
+        source = np.frombuffer(raw_data, dtype=dtype)
+        array = self.acquire(tag, source.size, source.dtype)
+        np.copyto(array, source)
+        array = array.reshape(shape)
+        array.flags.writeable = False
+        return array
+
+    def clear(self):
+        with self._lock:
+            self._buffers = {}
+
+
 class CallBack(object):
     def __init__(self, tag, sensor_type, sensor, data_provider):
         self._tag = tag
@@ -155,30 +211,22 @@ class CallBack(object):
         else:
             logging.error('No callback method for this sensor.')
 
-    # Parsing CARLA physical Sensors
+    # Parsing CARLA physical Sensors, the arrays are read-only views into the buffer pool of the data provider
     def _parse_image_cb(self, image, tag):
-        array = np.frombuffer(image.raw_data, dtype=np.dtype("uint8"))
-        array = copy.deepcopy(array)
-        array = np.reshape(array, (image.height, image.width, 4))
+        array = self._data_provider.buffer_pool.fill(tag, image.raw_data, np.uint8, (image.height, image.width, 4))
         self._data_provider.update_sensor(tag, array, image.frame)
 
     def _parse_lidar_cb(self, lidar_data, tag):
-        points = np.frombuffer(lidar_data.raw_data, dtype=np.dtype('f4'))
-        points = copy.deepcopy(points)
-        points = np.reshape(points, (int(points.shape[0] / 4), 4))
+        points = self._data_provider.buffer_pool.fill(tag, lidar_data.raw_data, np.float32, (-1, 4))
         self._data_provider.update_sensor(tag, points, lidar_data.frame)
 
     def _parse_semantic_lidar_cb(self, semantic_lidar_data, tag):
-        points = np.frombuffer(semantic_lidar_data.raw_data, dtype=np.dtype('f4'))
-        points = copy.deepcopy(points)
-        points = np.reshape(points, (int(points.shape[0] / 6), 6))
+        points = self._data_provider.buffer_pool.fill(tag, semantic_lidar_data.raw_data, np.float32, (-1, 6))
         self._data_provider.update_sensor(tag, points, semantic_lidar_data.frame)
 
     def _parse_radar_cb(self, radar_data, tag):
         # [depth, azimuth, altitute, velocity]
-        points = np.frombuffer(radar_data.raw_data, dtype=np.dtype('f4'))
-        points = copy.deepcopy(points)
-        points = np.reshape(points, (int(points.shape[0] / 4), 4))
+        points = self._data_provider.buffer_pool.fill(tag, radar_data.raw_data, np.float32, (-1, 4))
         points = np.flip(points, 1)
         self._data_provider.update_sensor(tag, points, radar_data.frame)
 
@@ -209,6 +257,7 @@ class SensorInterface(object):
         self._data_buffers = {}
         self._new_data_buffers = Queue()
         self._queue_timeout = 10 # default: 10
+        self.buffer_pool = SensorBufferPool()
 
         # Only sensor that doesn't get the data on tick, needs special treatment
         self._opendrive_tag = None
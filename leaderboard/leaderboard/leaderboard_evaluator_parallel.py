@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+"""
+CARLA Challenge Evaluator Routes, parallel version
+
+Splits the routes file into shards and evaluates every shard with its own leaderboard_evaluator.py process,
+simulator port and traffic manager port. Every shard writes its own checkpoint, the shard checkpoints are merged
+into the checkpoint given by --checkpoint whenever a shard makes progress, and the global statistics are computed
+once all shards are done.
+
+With --stand_in 1 the shards are run by stand_in_evaluator.py, which replaces the simulator and the agent, so the
+orchestration can be tested without CARLA.
+"""
+from __future__ import print_function
+
+import argparse
+from argparse import RawTextHelpFormatter
+import heapq
+import math
+import os
+import shlex
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from leaderboard.utils.statistics_manager import StatisticsManager, to_route_record
+from leaderboard.utils.checkpoint_tools import fetch_dict, save_dict, create_default_json_msg, fetch_records
+
+
+def route_xml_length(route):
+    """
+    Length in meters of the waypoints of a route element
+    """
+    points = [(float(waypoint.attrib['x']), float(waypoint.attrib['y']), float(waypoint.attrib['z']))
+              for waypoint in route.iter('waypoint')]
+
+    length = 0.0
+    for previous, current in zip(points[:-1], points[1:]):
+        length += math.sqrt(sum((c - p) * (c - p) for p, c in zip(previous, current)))
+
+    return length
+
+
+def split_routes(routes_file, num_shards, shard_dir):
+    """
+    Splits the routes file into num_shards route files in shard_dir.
+    The longest routes are assigned first, always to the shard with the least total route length, so the shards
+    take about the same time. Inside a shard, the routes keep the order of the routes file.
+
+    Returns a list with the route file of every shard and a list with the positions (in the routes file) of the
+    routes of every shard. Shards without routes are left out.
+    """
+    tree = ET.parse(routes_file)
+    routes = list(tree.getroot().iter('route'))
+    lengths = [route_xml_length(route) for route in routes]
+
+    shard_positions = [[] for _ in range(num_shards)]
+    loads = [(0.0, shard) for shard in range(num_shards)]
+    for position in sorted(range(len(routes)), key=lambda i: -lengths[i]):
+        load, shard = heapq.heappop(loads)
+        shard_positions[shard].append(position)
+        heapq.heappush(loads, (load + lengths[position], shard))
+
+    shard_files = []
+    route_positions = []
+    for shard, positions in enumerate(shard_positions):
+        if not positions:
+            continue
+        positions = sorted(positions)
+
+        root = ET.Element('routes')
+        for position in positions:
+            root.append(routes[position])
+
+        shard_file = os.path.join(shard_dir, 'routes_shard_{}.xml'.format(len(shard_files)))
+        ET.ElementTree(root).write(shard_file, encoding='UTF-8', xml_declaration=True)
+        shard_files.append(shard_file)
+        route_positions.append(positions)
+
+    return shard_files, route_positions
+
+
+def merge_checkpoints(shard_checkpoints, route_positions, repetitions, endpoint, finished=False):
+    """
+    Merges the records of the shard checkpoints into one checkpoint, as if all routes had been run by one
+    evaluator: the records get the index of their route in the routes file and the progress is the sum of the
+    progress of the shards. If finished, the global statistics are computed as well.
+    The merged checkpoint is written to a temporary file that replaces endpoint, so readers never see a partially
+    written checkpoint.
+    """
+    total = sum(len(positions) for positions in route_positions) * repetitions
+    data = create_default_json_msg()
+    records = {}
+    done = 0
+    entry_status = None
+
+    for shard_checkpoint, positions in zip(shard_checkpoints, route_positions):
+        shard_data = fetch_dict(shard_checkpoint)
+        if not shard_data or '_checkpoint' not in shard_data:
+            continue
+
+        if shard_data['sensors'] and not data['sensors']:
+            data['sensors'] = shard_data['sensors']
+        if shard_data['entry_status'] in ('Rejected', 'Crashed'):
+            entry_status = shard_data['entry_status']
+
+        progress = shard_data['_checkpoint']['progress']
+        if progress:
+            done += progress[0]
+
+        for record in fetch_records(shard_checkpoint, shard_data):
+            local_route, repetition = divmod(record['index'], repetitions)
+            record['index'] = positions[local_route] * repetitions + repetition
+            records[record['index']] = record
+
+    # Routes that were not run yet leave no gap, like in the checkpoint of a single evaluator
+    data['_checkpoint']['records'] = [records[index] for index in sorted(records)]
+    data['_checkpoint']['progress'] = [done, total]
+    data['entry_status'] = entry_status or ('Started' if done < total else 'Finished')
+    data['eligible'] = False
+
+    tmp_endpoint = endpoint + '.tmp'
+    save_dict(tmp_endpoint, data)
+
+    if finished:
+        statistics_manager = StatisticsManager()
+        for record in data['_checkpoint']['records']:
+            statistics_manager._registry_route_records.append(to_route_record(record))  # pylint: disable=protected-access
+        global_stats_record = statistics_manager.compute_global_statistics(total)
+        StatisticsManager.save_global_record(global_stats_record, data['sensors'], total, tmp_endpoint)
+
+    os.replace(tmp_endpoint, endpoint)
+
+    return done, total
+
+
+class ShardWorker(object):
+
+    """
+    Evaluates the routes of one shard in a subprocess, optionally with its own simulator
+    """
+
+    def __init__(self, args, shard, routes_file):
+        self.shard = shard
+        self.routes_file = routes_file
+        self.checkpoint = os.path.join(args.shard_dir, 'checkpoint_shard_{}.json'.format(shard))
+        self.log_file = os.path.join(args.shard_dir, 'log_shard_{}.txt'.format(shard))
+        self.port = int(args.port) + shard * args.port_stride
+        self.traffic_manager_port = int(args.trafficManagerPort) + shard * args.port_stride
+        self.attempts = 0
+        self.process = None
+        self.simulator = None
+        self.returncode = None
+
+        self.env = os.environ.copy()
+        if args.gpus:
+            gpus = args.gpus.split(',')
+            self.env['CUDA_VISIBLE_DEVICES'] = gpus[shard % len(gpus)]
+
+    def command(self, args, resume):
+        if args.stand_in:
+            evaluator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stand_in_evaluator.py')
+        else:
+            evaluator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'leaderboard_evaluator.py')
+
+        command = [sys.executable, evaluator,
+                   '--host', args.host,
+                   '--port', str(self.port),
+                   '--trafficManagerPort', str(self.traffic_manager_port),
+                   '--trafficManagerSeed', str(args.trafficManagerSeed),
+                   '--debug', str(args.debug),
+                   '--timeout', str(args.timeout),
+                   '--routes', self.routes_file,
+                   '--scenarios', args.scenarios,
+                   '--repetitions', str(args.repetitions),
+                   '--agent', args.agent,
+                   '--agent-config', args.agent_config,
+                   '--track', args.track,
+                   '--checkpoint', self.checkpoint,
+                   '--weather', args.weather]
+        if args.record:
+            command += ['--record', args.record]
+        # The evaluator parses --resume with type=bool, so any value resumes
+        if resume:
+            command += ['--resume', '1']
+        if args.stand_in:
+            command += ['--route_time', str(args.stand_in_route_time)]
+
+        return command
+
+    def start(self, args, resume):
+        if args.simulator_command and self.simulator is None:
+            simulator_command = args.simulator_command.format(port=self.port, gpu=self.env.get('CUDA_VISIBLE_DEVICES', 0))
+            print('Shard {}: starting the simulator: {}'.format(self.shard, simulator_command))
+            self.simulator = subprocess.Popen(shlex.split(simulator_command), env=self.env,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            time.sleep(args.simulator_wait)
+
+        self.attempts += 1
+        self.returncode = None
+        with open(self.log_file, 'a') as log:
+            self.process = subprocess.Popen(self.command(args, resume), env=self.env, stdout=log, stderr=subprocess.STDOUT)
+
+    def poll(self):
+        """
+        Returns True while the evaluator of the shard is running
+        """
+        if self.process is None:
+            return False
+        self.returncode = self.process.poll()
+        if self.returncode is None:
+            return True
+        self.process = None
+        return False
+
+    def progress(self):
+        data = fetch_dict(self.checkpoint)
+        if data and '_checkpoint' in data and data['_checkpoint']['progress']:
+            return tuple(data['_checkpoint']['progress'])
+        return None
+
+    def finished(self):
+        progress = self.progress()
+        return progress is not None and progress[0] >= progress[1]
+
+    def stop(self):
+        for process in (self.process, self.simulator):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        self.process = None
+        self.simulator = None
+
+
+class ParallelLeaderboardEvaluator(object):
+
+    """
+    Runs the shards of a routes file in parallel and merges their checkpoints.
+    A shard whose evaluator stopped before all its routes were done (e.g. after a simulator crash, where
+    leaderboard_evaluator.py exits) is resumed from its checkpoint, up to --max_retries times.
+    """
+
+    poll_interval = 5.0  # in seconds
+
+    def __init__(self, args):
+        self.args = args
+        if not args.shard_dir:
+            args.shard_dir = os.path.splitext(args.checkpoint)[0] + '_shards'
+        os.makedirs(args.shard_dir, exist_ok=True)
+
+        shard_files, self.route_positions = split_routes(args.routes, args.num_workers, args.shard_dir)
+        self.workers = [ShardWorker(args, shard, routes_file) for shard, routes_file in enumerate(shard_files)]
+
+    def run(self):
+        args = self.args
+        print('Evaluating {} routes in {} shards'.format(sum(len(p) for p in self.route_positions), len(self.workers)))
+
+        pending = []
+        for worker in self.workers:
+            if args.resume and worker.finished():
+                continue
+            if not args.resume and os.path.exists(worker.checkpoint):
+                os.remove(worker.checkpoint)
+            worker.start(args, resume=args.resume)
+            pending.append(worker)
+
+        last_progress = None
+        try:
+            while pending:
+                time.sleep(self.poll_interval)
+
+                for worker in list(pending):
+                    if worker.poll():
+                        continue
+                    if worker.finished():
+                        print('Shard {} finished'.format(worker.shard))
+                        worker.stop()
+                        pending.remove(worker)
+                    elif worker.attempts <= args.max_retries:
+                        print('Shard {} stopped with exit code {}, resuming it'.format(worker.shard, worker.returncode))
+                        worker.start(args, resume=True)
+                    else:
+                        print('Shard {} stopped with exit code {}, giving up'.format(worker.shard, worker.returncode))
+                        worker.stop()
+                        pending.remove(worker)
+
+                progress = [worker.progress() for worker in self.workers]
+                if progress != last_progress:
+                    done, total = self.merge()
+                    print('> {}/{} routes done'.format(done, total))
+                    last_progress = progress
+        finally:
+            for worker in self.workers:
+                worker.stop()
+
+        # save global statistics
+        print("\033[1m> Registering the global statistics\033[0m")
+        self.merge(finished=True)
+
+    def merge(self, finished=False):
+        return merge_checkpoints([worker.checkpoint for worker in self.workers], self.route_positions,
+                                 self.args.repetitions, self.args.checkpoint, finished)
+
+
+def main():
+    description = "CARLA AD Leaderboard Evaluation: evaluate your Agent in CARLA scenarios, with parallel workers\n"
+
+    # general parameters
+    parser = argparse.ArgumentParser(description=description, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--host', default='localhost',
+                        help='IP of the host server (default: localhost)')
+    parser.add_argument('--port', default='2000', help='TCP port of the simulator of the first worker (default: 2000)')
+    parser.add_argument('--trafficManagerPort', default='8000',
+                        help='Port of the TrafficManager of the first worker (default: 8000)')
+    parser.add_argument('--trafficManagerSeed', default='0',
+                        help='Seed used by the TrafficManager (default: 0)')
+    parser.add_argument('--debug', type=int, help='Run with debug output', default=0)
+    parser.add_argument('--record', type=str, default='',
+                        help='Use CARLA recording feature to create a recording of the scenario')
+    parser.add_argument('--timeout', default="600.0",
+                        help='Set the CARLA client timeout value in seconds')
+
+    # simulation setup
+    parser.add_argument('--routes',
+                        help='Name of the route to be executed. Point to the route_xml_file to be executed.',
+                        required=True)
+    parser.add_argument('--scenarios',
+                        help='Name of the scenario annotation file to be mixed with the route.',
+                        required=True)
+    parser.add_argument('--repetitions',
+                        type=int,
+                        default=1,
+                        help='Number of repetitions per route.')
+
+    # agent-related options
+    parser.add_argument("-a", "--agent", type=str, help="Path to Agent's py file to evaluate", required=True)
+    parser.add_argument("--agent-config", type=str, help="Path to Agent's configuration file", default="")
+
+    parser.add_argument("--track", type=str, default='SENSORS', help="Participation track: SENSORS, MAP")
+    parser.add_argument('--resume', type=int, default=0, help='1: Resume the shards from their checkpoints')
+    parser.add_argument("--checkpoint", type=str,
+                        default='./simulation_results.json',
+                        help="Path to the merged checkpoint of all the shards")
+    parser.add_argument("--weather", type=str, help="Weather, see utilx/environmentx.py", default='ClearNoon')
+
+    # parallel evaluation
+    parser.add_argument('--num_workers', type=int, default=2, help='Number of shards that are evaluated in parallel')
+    parser.add_argument('--port_stride', type=int, default=10,
+                        help='Worker i uses port + i * port_stride and trafficManagerPort + i * port_stride. '
+                             'CARLA also uses the two ports after the RPC port, so it must be at least 3.')
+    parser.add_argument('--shard_dir', type=str, default='',
+                        help='Directory for the route files, checkpoints and logs of the shards '
+                             '(default: next to the checkpoint)')
+    parser.add_argument('--gpus', type=str, default='',
+                        help='Comma separated GPU ids that are assigned to the workers in turn (default: inherit)')
+    parser.add_argument('--simulator_command', type=str, default='',
+                        help='Command that starts a simulator for every worker, {port} and {gpu} are replaced, e.g. '
+                             '"$CARLA_ROOT/CarlaUE4.sh -carla-rpc-port={port} -graphicsadapter={gpu}". '
+                             'By default the simulators are expected to be running already.')
+    parser.add_argument('--simulator_wait', type=float, default=60.0,
+                        help='Seconds to wait for a started simulator before connecting to it')
+    parser.add_argument('--max_retries', type=int, default=3,
+                        help='Number of times a shard is resumed after its evaluator stopped early')
+    parser.add_argument('--stand_in', type=int, default=0,
+                        help='1: Run the shards with stand_in_evaluator.py instead of the simulator and the agent')
+    parser.add_argument('--stand_in_route_time', type=float, default=0.0,
+                        help='Seconds the stand in evaluator takes per route')
+
+    arguments = parser.parse_args()
+
+    if arguments.port_stride < 3:
+        parser.error('--port_stride must be at least 3')
+
+    ParallelLeaderboardEvaluator(arguments).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+"""
+Stand in for leaderboard_evaluator.py that needs neither CARLA nor an agent.
+
+It takes the same arguments and writes the same checkpoint, but every route is "driven" by drawing its traffic events
+from a random generator that is seeded with the route name and repetition. The events are scored by the real
+StatisticsManager. The simulator port is held for the whole run, like a simulator would, so workers that share a port
+fail. Used to test the parallel evaluation (leaderboard_evaluator_parallel.py) without a simulator.
+"""
+from __future__ import print_function
+
+import argparse
+from argparse import RawTextHelpFormatter
+import random
+import socket
+import time
+import zlib
+import xml.etree.ElementTree as ET
+
+from srunner.scenariomanager.traffic_events import TrafficEvent, TrafficEventType
+
+from leaderboard.utils.statistics_manager import StatisticsManager
+from leaderboard.utils.checkpoint_tools import fetch_dict, save_dict, create_default_json_msg
+
+SENSOR_ICONS = ['carla_camera', 'carla_lidar', 'carla_gnss', 'carla_imu', 'carla_speedometer']
+
+
+class StandInLocation(object):
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class StandInRouteConfiguration(object):
+
+    """
+    The parts of a RouteScenarioConfiguration the statistics need
+    """
+
+    def __init__(self, name, town, trajectory, index, repetition_index):
+        self.name = name
+        self.town = town
+        self.trajectory = trajectory
+        self.index = index
+        self.repetition_index = repetition_index
+
+
+class StandInCriterion(object):
+    def __init__(self, events):
+        self.list_traffic_events = events
+
+
+class StandInTimeout(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+
+class StandInScenario(object):
+
+    """
+    The parts of the master scenario the statistics need, with random traffic events
+    """
+
+    def __init__(self, config, seed):
+        rng = random.Random(zlib.crc32('{}.{}.{}'.format(config.name, config.repetition_index, seed).encode()))
+
+        events = []
+        for event_type in (TrafficEventType.COLLISION_VEHICLE, TrafficEventType.COLLISION_STATIC,
+                           TrafficEventType.TRAFFIC_LIGHT_INFRACTION):
+            for _ in range(rng.randint(0, 2)):
+                events.append(TrafficEvent(event_type, message='Stand in {}'.format(event_type.name)))
+
+        route_completed = round(rng.uniform(20.0, 100.0), 2) if rng.random() < 0.7 else 100.0
+        if route_completed >= 100.0:
+            events.append(TrafficEvent(TrafficEventType.ROUTE_COMPLETED))
+        else:
+            events.append(TrafficEvent(TrafficEventType.ROUTE_COMPLETION, dictionary={'route_completed': route_completed}))
+
+        self.timeout_node = StandInTimeout(route_completed < 100.0 and rng.random() < 0.3)
+        self._criteria = [StandInCriterion(events)]
+
+    def get_criteria(self):
+        return self._criteria
+
+
+def parse_routes(routes_file, repetitions):
+    """
+    Returns the route configurations in the order of RouteIndexer
+    """
+    configs = []
+    for i, route in enumerate(ET.parse(routes_file).getroot().iter('route')):
+        trajectory = [StandInLocation(float(waypoint.attrib['x']), float(waypoint.attrib['y']), float(waypoint.attrib['z']))
+                      for waypoint in route.iter('waypoint')]
+        for repetition in range(repetitions):
+            configs.append(StandInRouteConfiguration("RouteScenario_{}".format(route.attrib['id']), route.attrib['town'],
+                                                     trajectory, i * repetitions + repetition, repetition))
+    return configs
+
+
+def save_progress(index, total, endpoint):
+    data = fetch_dict(endpoint)
+    if not data:
+        data = create_default_json_msg()
+    data['_checkpoint']['progress'] = [index, total]
+
+    save_dict(endpoint, data)
+
+
+def run(args):
+    # Hold the simulator port like a simulator does
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind((args.host, int(args.port)))
+    server.listen(1)
+
+    configs = parse_routes(args.routes, args.repetitions)
+    statistics_manager = StatisticsManager()
+
+    index = 0
+    if args.resume:
+        data = fetch_dict(args.checkpoint)
+        progress = data['_checkpoint']['progress'] if data and '_checkpoint' in data else []
+        if progress:
+            index = progress[0]
+        statistics_manager.resume(args.checkpoint)
+    else:
+        statistics_manager.clear_record(args.checkpoint)
+        save_progress(index, len(configs), args.checkpoint)
+
+    statistics_manager.save_sensors(SENSOR_ICONS, args.checkpoint)
+
+    while index < len(configs):
+        config = configs[index]
+        print("========= Stand in run of {} (repetition {}) on port {} =========".format(
+            config.name, config.repetition_index, args.port))
+
+        statistics_manager.set_route(config.name, config.index)
+        statistics_manager.set_scenario(StandInScenario(config, args.trafficManagerSeed))
+
+        start_time = time.time()
+        time.sleep(args.route_time)
+        duration = time.time() - start_time
+
+        route_record = statistics_manager.compute_route_statistics(config, duration, duration)
+        statistics_manager.save_record(route_record, config.index, args.checkpoint)
+        statistics_manager.save_entry_status("Started", False, args.checkpoint)
+
+        index += 1
+        save_progress(index, len(configs), args.checkpoint)
+
+    global_stats_record = statistics_manager.compute_global_statistics(len(configs))
+    StatisticsManager.save_global_record(global_stats_record, SENSOR_ICONS, len(configs), args.checkpoint)
+    server.close()
+
+
+def main():
+    description = "Stand in for the CARLA AD Leaderboard Evaluation, without simulator and agent\n"
+
+    parser = argparse.ArgumentParser(description=description, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default='2000')
+    parser.add_argument('--trafficManagerPort', default='8000')
+    parser.add_argument('--trafficManagerSeed', default='0')
+    parser.add_argument('--debug', type=int, default=0)
+    parser.add_argument('--record', type=str, default='')
+    parser.add_argument('--timeout', default="600.0")
+    parser.add_argument('--routes', required=True)
+    parser.add_argument('--scenarios', required=True)
+    parser.add_argument('--repetitions', type=int, default=1)
+    parser.add_argument("-a", "--agent", type=str, required=True)
+    parser.add_argument("--agent-config", type=str, default="")
+    parser.add_argument("--track", type=str, default='SENSORS')
+    parser.add_argument('--resume', type=bool, default=False)
+    parser.add_argument("--checkpoint", type=str, default='./simulation_results.json')
+    parser.add_argument("--weather", type=str, default='ClearNoon')
+    parser.add_argument('--route_time', type=float, default=0.0, help='Seconds every route takes')
+
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
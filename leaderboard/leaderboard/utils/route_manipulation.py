@@ -8,37 +8,68 @@
 """
 Module to manipulate the routes, by making then more or less dense (Up to a certain parameter).
 It also contains functions to convert the CARLA world location do GPS coordinates.
+
+The conversions work on whole routes as arrays. If the environment variable ROUTE_CACHE_DIR is set, the interpolated
+routes are stored there and reused by later runs on the same town, trajectory and hop resolution.
 """
 
+import hashlib
 import math
+import os
 import xml.etree.ElementTree as ET
 
+import numpy as np
+
+import carla
 from agents.navigation.global_route_planner import GlobalRoutePlanner
 from agents.navigation.global_route_planner_dao import GlobalRoutePlannerDAO
 from agents.navigation.local_planner import RoadOption
 
 
-def _location_to_gps(lat_ref, lon_ref, location):
+EARTH_RADIUS_EQUA = 6378137.0
+
+
+def locations_to_gps(lat_ref, lon_ref, locations):
     """
-    Convert from world coordinates to GPS coordinates
+    Convert an array of world locations [N, 3] to GPS coordinates
     :param lat_ref: latitude reference for the current map
     :param lon_ref: longitude reference for the current map
-    :param location: location to translate
-    :return: dictionary with lat, lon and height
+    :param locations: locations to translate
+    :return: arrays with the lat, lon and height of the locations
     """
+    locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
 
-    EARTH_RADIUS_EQUA = 6378137.0   # pylint: disable=invalid-name
     scale = math.cos(lat_ref * math.pi / 180.0)
     mx = scale * lon_ref * math.pi * EARTH_RADIUS_EQUA / 180.0
     my = scale * EARTH_RADIUS_EQUA * math.log(math.tan((90.0 + lat_ref) * math.pi / 360.0))
-    mx += location.x
-    my -= location.y
+    mx = mx + locations[:, 0]
+    my = my - locations[:, 1]
 
     lon = mx * 180.0 / (math.pi * EARTH_RADIUS_EQUA * scale)
-    lat = 360.0 * math.atan(math.exp(my / (EARTH_RADIUS_EQUA * scale))) / math.pi - 90.0
-    z = location.z
+    lat = 360.0 * np.arctan(np.exp(my / (EARTH_RADIUS_EQUA * scale))) / math.pi - 90.0
+
+    return lat, lon, locations[:, 2]
+
+
+def _location_to_gps(lat_ref, lon_ref, location):
+    """
+    Convert from world coordinates to GPS coordinates
+    :param lat_ref: latitude reference for the current map
+    :param lon_ref: longitude reference for the current map
+    :param location: location to translate
+    :return: dictionary with lat, lon and height
+    """
+    lat, lon, z = locations_to_gps(lat_ref, lon_ref, [location.x, location.y, location.z])
+
+    return {'lat': float(lat[0]), 'lon': float(lon[0]), 'z': float(z[0])}
 
-    return {'lat': lat, 'lon': lon, 'z': z}
+
+def route_locations(route):
+    """
+    Array [N, 3] with the locations of the transforms of a route
+    """
+    locations = [transform.location for transform, _ in route]
+    return np.array([[location.x, location.y, location.z] for location in locations], dtype=np.float64).reshape(-1, 3)
 
 
 def location_route_to_gps(route, lat_ref, lon_ref):
@@ -49,11 +80,11 @@ def location_route_to_gps(route, lat_ref, lon_ref):
     :param lon_ref:
     :return:
     """
-    gps_route = []
+    lat, lon, z = locations_to_gps(lat_ref, lon_ref, route_locations(route))
 
-    for transform, connection in route:
-        gps_point = _location_to_gps(lat_ref, lon_ref, transform.location)
-        gps_route.append((gps_point, connection))
+    gps_route = []
+    for lat_i, lon_i, z_i, (_, connection) in zip(lat.tolist(), lon.tolist(), z.tolist(), route):
+        gps_route.append(({'lat': lat_i, 'lon': lon_i, 'z': z_i}, connection))
 
     return gps_route
 
@@ -90,43 +121,89 @@ def downsample_route(route, sample_factor):
     :param sample_factor: Maximum distance between samples
     :return: returns the ids of the final route that can
     """
+    if len(route) == 0:
+        return []
+
+    lane_changes = (RoadOption.CHANGELANELEFT, RoadOption.CHANGELANERIGHT)
+    options = [point[1] for point in route]
+    is_lane_change = np.array([option in lane_changes for option in options], dtype=bool)
+
+    # Samples that do not depend on the distance: lane changes, changes of the road option and the end
+    forced = is_lane_change.copy()
+    forced[0] = True
+    forced[1:] |= np.array([prev_option != curr_option for prev_option, curr_option in zip(options[:-1], options[1:])],
+                           dtype=bool) \
+        & ~is_lane_change[:-1]
+    forced[-1] = True
+    forced_ids = np.flatnonzero(forced)
+
+    # Distances between consecutive points, in single precision like carla.Location.distance
+    locations = route_locations(route).astype(np.float32)
+    offset = locations[1:] - locations[:-1]
+    distances = np.zeros(len(route), dtype=np.float64)
+    distances[1:] = np.sqrt(offset[:, 0] * offset[:, 0] + offset[:, 1] * offset[:, 1] + offset[:, 2] * offset[:, 2])
+
+    # Between two forced samples, a point is sampled once the distance summed up since the last sample exceeds the
+    # factor. np.cumsum adds in the same order as a running sum, so the result matches it exactly.
+    ids_to_sample = [0]
+    last = 0
+    while last < len(route) - 1:
+        next_forced = int(forced_ids[np.searchsorted(forced_ids, last, side='right')])
+        sample = next_forced
+        window = 64
+        while True:
+            end = min(next_forced, last + 1 + window)
+            exceeded = np.flatnonzero(np.cumsum(distances[last + 1:end]) > sample_factor)
+            if len(exceeded) > 0:
+                sample = min(last + 2 + int(exceeded[0]), next_forced)
+                break
+            if end == next_forced:
+                break
+            window *= 2
+
+        ids_to_sample.append(sample)
+        last = sample
 
-    ids_to_sample = []
-    prev_option = None
-    dist = 0
+    return ids_to_sample
 
-    for i, point in enumerate(route):
-        curr_option = point[1]
 
-        # Lane changing
-        if curr_option in (RoadOption.CHANGELANELEFT, RoadOption.CHANGELANERIGHT):
-            ids_to_sample.append(i)
-            dist = 0
+def _route_cache_path(town, waypoints_trajectory, hop_resolution):
+    cache_dir = os.environ.get('ROUTE_CACHE_DIR')
+    if not cache_dir:
+        return None
+    keypoints = np.array([[waypoint.x, waypoint.y, waypoint.z] for waypoint in waypoints_trajectory], dtype=np.float64)
+    digest = hashlib.sha1(keypoints.tobytes()).hexdigest()
+    return os.path.join(cache_dir, '{}_{}_{}.npz'.format(os.path.basename(town), hop_resolution, digest))
 
-        # When road option changes
-        elif prev_option != curr_option and prev_option not in (RoadOption.CHANGELANELEFT, RoadOption.CHANGELANERIGHT):
-            ids_to_sample.append(i)
-            dist = 0
 
-        # After a certain max distance
-        elif dist > sample_factor:
-            ids_to_sample.append(i)
-            dist = 0
+def _load_route(path):
+    """
+    Returns the route and the GPS reference stored in a route cache file
+    """
+    with np.load(path) as data:
+        transforms = data['transforms'].tolist()
+        options = data['options'].tolist()
+        lat_ref, lon_ref = data['latlon_ref'].tolist()
 
-        # At the end
-        elif i == len(route) - 1:
-            ids_to_sample.append(i)
-            dist = 0
+    route = []
+    for (x, y, z, pitch, yaw, roll), option in zip(transforms, options):
+        route.append((carla.Transform(carla.Location(x=x, y=y, z=z), carla.Rotation(pitch=pitch, yaw=yaw, roll=roll)),
+                      RoadOption(option)))
+    return route, lat_ref, lon_ref
 
-        # Compute the distance traveled
-        else:
-            curr_location = point[0].location
-            prev_location = route[i-1][0].location
-            dist += curr_location.distance(prev_location)
 
-        prev_option = curr_option
+def _save_route(path, route, lat_ref, lon_ref):
+    rotations = [transform.rotation for transform, _ in route]
+    rotations = np.array([[rotation.pitch, rotation.yaw, rotation.roll] for rotation in rotations],
+                         dtype=np.float64).reshape(-1, 3)
+    transforms = np.concatenate([route_locations(route), rotations], axis=1)
+    options = np.array([option.value for _, option in route], dtype=np.int64)
 
-    return ids_to_sample
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fd:
+        np.savez(fd, transforms=transforms, options=options, latlon_ref=np.array([lat_ref, lon_ref]))
+    os.replace(tmp_path, path)
 
 
 def interpolate_trajectory(world, waypoints_trajectory, hop_resolution=1.0):
@@ -140,7 +217,13 @@ def interpolate_trajectory(world, waypoints_trajectory, hop_resolution=1.0):
         - hop_resolution: is the resolution, how dense is the provided trajectory going to be made
     """
 
-    dao = GlobalRoutePlannerDAO(world.get_map(), hop_resolution)
+    world_map = world.get_map()
+    cache_path = _route_cache_path(world_map.name, waypoints_trajectory, hop_resolution)
+    if cache_path is not None and os.path.exists(cache_path):
+        route, lat_ref, lon_ref = _load_route(cache_path)
+        return location_route_to_gps(route, lat_ref, lon_ref), route
+
+    dao = GlobalRoutePlannerDAO(world_map, hop_resolution)
     grp = GlobalRoutePlanner(dao)
     grp.setup()
     # Obtain route plan
@@ -155,4 +238,7 @@ def interpolate_trajectory(world, waypoints_trajectory, hop_resolution=1.0):
 
     lat_ref, lon_ref = _get_latlon_ref(world)
 
+    if cache_path is not None:
+        _save_route(cache_path, route, lat_ref, lon_ref)
+
     return location_route_to_gps(route, lat_ref, lon_ref), route
@@ -13,11 +13,13 @@ from __future__ import print_function
 
 from dictor import dictor
 import math
+import os
 import sys
 
 from srunner.scenariomanager.traffic_events import TrafficEventType
 
-from leaderboard.utils.checkpoint_tools import fetch_dict, save_dict, create_default_json_msg
+from leaderboard.utils.checkpoint_tools import fetch_dict, save_dict, create_default_json_msg, is_remote, \
+    record_log_path, append_record, fetch_records, write_record_log, compact_records
 
 PENALTY_COLLISION_PEDESTRIAN = 0.50
 PENALTY_COLLISION_VEHICLE = 0.60
@@ -76,25 +78,102 @@ def compute_route_length(config):
     return route_length
 
 
+class StatisticsSummary(object):
+
+    """
+    Running sums over the route records that the global statistics are computed from.
+    Adding a record only touches the sums, so the summary is kept up to date after every route.
+    """
+
+    def __init__(self):
+        self.num_records = 0
+        self.scores = {
+            'score_route': 0,
+            'score_penalty': 0,
+            'score_composed': 0
+        }
+        self.infractions = {key: 0.0 for key in RouteRecord().infractions}
+        self.exceptions = []
+
+    @classmethod
+    def from_records(cls, route_records):
+        summary = cls()
+        for route_record in route_records:
+            summary.add(route_record)
+        return summary
+
+    def add(self, route_record):
+        self.num_records += 1
+        for key in self.scores:
+            self.scores[key] += route_record.scores[key]
+
+        route_length_kms = max(route_record.scores['score_route'] * route_record.meta['route_length'] / 1000.0, 0.001)
+        for key in self.infractions:
+            self.infractions[key] += len(route_record.infractions[key]) / route_length_kms
+
+        if route_record.status != 'Completed':
+            self.exceptions.append((route_record.route_id, route_record.index, route_record.status))
+
+    def global_record(self, total_routes):
+        global_record = RouteRecord()
+        global_record.route_id = -1
+        global_record.index = -1
+        global_record.status = 'Completed'
+
+        if self.num_records:
+            global_record.scores = dict(self.scores)
+            global_record.infractions = dict(self.infractions)
+            if self.exceptions:
+                global_record.status = 'Failed'
+                global_record.meta['exceptions'] = list(self.exceptions)
+
+        global_record.scores['score_route'] /= float(total_routes)
+        global_record.scores['score_penalty'] /= float(total_routes)
+        global_record.scores['score_composed'] /= float(total_routes)
+
+        return global_record
+
+    def to_dict(self):
+        return {
+            'num_records': self.num_records,
+            'scores': self.scores,
+            'infractions': self.infractions,
+            'num_exceptions': len(self.exceptions)
+        }
+
+
 class StatisticsManager(object):
 
     """
     This is the statistics manager for the CARLA leaderboard.
     It gathers data at runtime via the scenario evaluation criteria.
+
+    The records of local checkpoints are appended to a record log next to the checkpoint (see checkpoint_tools),
+    while the checkpoint itself only keeps a summary of the records, so saving a record does not rewrite all the
+    previous ones. save_global_record compacts the log back into the checkpoint.
     """
 
     def __init__(self):
         self._master_scenario = None
         self._registry_route_records = []
+        self._saved_indices = set()
+        self._summary = StatisticsSummary()
 
     def resume(self, endpoint):
         data = fetch_dict(endpoint)
-
-        if data and dictor(data, '_checkpoint.records'):
-            records = data['_checkpoint']['records']
-
-            for record in records:
-                self._registry_route_records.append(to_route_record(record))
+        records = fetch_records(endpoint, data)
+
+        for record in records:
+            self._registry_route_records.append(to_route_record(record))
+        self._saved_indices = set(record['index'] for record in records)
+        self._summary = StatisticsSummary.from_records(self._registry_route_records)
+
+        # Records of a compacted checkpoint go back into the log, so they are not rewritten after every route
+        if not is_remote(endpoint) and data and dictor(data, '_checkpoint.records'):
+            write_record_log(endpoint, records)
+            data['_checkpoint']['records'] = []
+            data['_checkpoint']['summary'] = self._summary.to_dict()
+            save_dict(endpoint, data)
 
     def set_route(self, route_id, index):
 
@@ -202,61 +281,41 @@ class StatisticsManager(object):
         return route_record
 
     def compute_global_statistics(self, total_routes):
-        global_record = RouteRecord()
-        global_record.route_id = -1
-        global_record.index = -1
-        global_record.status = 'Completed'
-
-        if self._registry_route_records:
-            for route_record in self._registry_route_records:
-                global_record.scores['score_route'] += route_record.scores['score_route']
-                global_record.scores['score_penalty'] += route_record.scores['score_penalty']
-                global_record.scores['score_composed'] += route_record.scores['score_composed']
-
-                for key in global_record.infractions.keys():
-                    route_length_kms = max(route_record.scores['score_route'] * route_record.meta['route_length'] / 1000.0, 0.001)
-                    if isinstance(global_record.infractions[key], list):
-                        global_record.infractions[key] = len(route_record.infractions[key]) / route_length_kms
-                    else:
-                        global_record.infractions[key] += len(route_record.infractions[key]) / route_length_kms
-
-                if route_record.status is not 'Completed':
-                    global_record.status = 'Failed'
-                    if 'exceptions' not in global_record.meta:
-                        global_record.meta['exceptions'] = []
-                    global_record.meta['exceptions'].append((route_record.route_id,
-                                                             route_record.index,
-                                                             route_record.status))
+        return StatisticsSummary.from_records(self._registry_route_records).global_record(total_routes)
 
-        global_record.scores['score_route'] /= float(total_routes)
-        global_record.scores['score_penalty'] /= float(total_routes)
-        global_record.scores['score_composed'] /= float(total_routes)
-
-        return global_record
-
-    @staticmethod
-    def save_record(route_record, index, endpoint):
+    def save_record(self, route_record, index, endpoint):
         data = fetch_dict(endpoint)
         if not data:
             data = create_default_json_msg()
 
         stats_dict = route_record.__dict__
-        record_list = data['_checkpoint']['records']
-        if index > len(record_list):
+        if index > len(self._saved_indices) and index not in self._saved_indices:
             print('Error! No enough entries in the list')
             sys.exit(-1)
-        elif index == len(record_list):
-            record_list.append(stats_dict)
+
+        if index in self._saved_indices:
+            # A route that was run again replaces its record, the sums are recomputed
+            self._summary = StatisticsSummary.from_records(
+                [record for record in self._registry_route_records if record.index in self._saved_indices])
+        else:
+            self._summary.add(route_record)
+            self._saved_indices.add(index)
+
+        if is_remote(endpoint):
+            record_list = data['_checkpoint']['records']
+            if index == len(record_list):
+                record_list.append(stats_dict)
+            else:
+                record_list[index] = stats_dict
         else:
-            record_list[index] = stats_dict
+            append_record(endpoint, stats_dict)
 
+        data['_checkpoint']['summary'] = self._summary.to_dict()
         save_dict(endpoint, data)
 
     @staticmethod
     def save_global_record(route_record, sensors, total_routes, endpoint):
-        data = fetch_dict(endpoint)
-        if not data:
-            data = create_default_json_msg()
+        data = compact_records(endpoint)
 
         stats_dict = route_record.__dict__
         data['_checkpoint']['global_record'] = stats_dict
@@ -336,6 +395,8 @@ class StatisticsManager(object):
 
     @staticmethod
     def clear_record(endpoint):
-        if not endpoint.startswith(('http:', 'https:', 'ftp:')):
+        if not is_remote(endpoint):
             with open(endpoint, 'w') as fd:
                 fd.truncate(0)
+            if os.path.exists(record_log_path(endpoint)):
+                os.remove(record_log_path(endpoint))
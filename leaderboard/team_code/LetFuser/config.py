@@ -12,6 +12,7 @@ class GlobalConfig:
     attn = True # comment model forward path TODO 1
     augment_control_data = True  # comment model forward path TODO 2
     MGN = True
+    inference_only = True  # True: forward only computes the outputs used by the agent (no distillation branches and losses)
 
     save_depth_rgb_seg_sem = False  # to run faster in evaluation, it only save meta
 	
@@ -197,6 +198,7 @@ class GlobalConfig:
     fusion_drop_rate = 0
     fusion_attn_drop_rate = 0
     fusion_dpr = [0,0,0,0] # [0.1,0.2,0.3,0.4]
+    attention_backend = 'sdpa' # 'sdpa': fused torch scaled_dot_product_attention (torch >= 2.0), 'math': explicit softmax attention
 
     def __init__(self, **kwargs):
         for k,v in kwargs.items():
@@ -241,7 +241,7 @@ class GeometricFusionAgent(autonomous_agent.AutonomousAgent):
 		for i, lidar_point_cloud in enumerate(self.input_buffer['lidar']):
 			curr_theta = self.input_buffer['thetas'][i]
 			curr_x, curr_y = self.input_buffer['gps'][i]
-			lidar_point_cloud[:,1] *= -1 # inverts x, y
+			lidar_point_cloud = lidar_point_cloud * np.array([1, -1, 1], dtype=np.float32) # inverts x, y
 			lidar_transformed_np = transform_2d_points(lidar_point_cloud,
 					np.pi/2-curr_theta, -curr_x, -curr_y, np.pi/2-ego_theta, -ego_x, -ego_y)
 			lidar_transformed = torch.from_numpy(lidar_to_histogram_features(lidar_transformed_np, crop=self.config.input_resolution)).unsqueeze(0)
@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+class PendingFrame(object):
+    def __init__(self, future):
+        self._future = future
+
+    def result(self):
+        """
+        Waits for the preprocessing of the frame. Returns (data, inputs): data holds the host side values returned by
+        the preprocessing function, inputs the uploaded tensors. The current CUDA stream is made to wait for the
+        uploads, so the host does not block on the copies.
+        """
+        data, inputs, event = self._future.result()
+        if event is not None:
+            stream = torch.cuda.current_stream()
+            stream.wait_event(event)
+            for tensor in inputs.values():
+                tensor.record_stream(stream)
+        return data, inputs
+
+
+class SensorPipeline(object):
+    """
+    Runs the sensor preprocessing of an agent (decoding, cv2/PIL scaling and cropping, LiDAR splatting) on a worker
+    thread, so it overlaps with the work that stays on the main thread (GPS, route planning) and with GPU work that is
+    still in flight. Arrays that are fed to the network are copied into pinned host buffers and uploaded with
+    non blocking copies on a dedicated CUDA stream.
+    A pinned buffer is only refilled once its previous copy has finished. The host never waits for a copy, while all
+    buffers of an input are still being read another one is allocated.
+    """
+
+    def __init__(self, device='cuda:0'):
+        self.device = torch.device(device)
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        self._buffers = {} # name -> list of [pinned tensor, event of the last copy out of it]
+
+    def submit(self, fn, *args, upload=()):
+        """
+        Schedules fn(*args) on the worker thread. fn returns a dict, the numpy arrays listed in upload are moved to the
+        device (names that fn did not return are skipped) and everything else stays on the host.
+        """
+        return PendingFrame(self._pool.submit(self._run, fn, args, upload))
+
+    def close(self):
+        self._pool.shutdown()
+
+    def _run(self, fn, args, upload):
+        data = fn(*args)
+        upload = [name for name in upload if name in data]
+        inputs = {}
+        if self._stream is None:
+            for name in upload:
+                inputs[name] = torch.from_numpy(np.ascontiguousarray(data.pop(name))).to(self.device)
+            return data, inputs, None
+
+        with torch.cuda.stream(self._stream):
+            for name in upload:
+                array = data.pop(name)
+                buffer = self._get_buffer(name, array)
+                np.copyto(buffer[0].numpy(), array)
+                inputs[name] = buffer[0].to(self.device, non_blocking=True)
+                buffer[1].record(self._stream)
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return data, inputs, event
+
+    def _get_buffer(self, name, array):
+        # Buffers of another shape are dropped, the caching host allocator keeps them alive until their copy finished
+        buffers = [buffer for buffer in self._buffers.get(name, [])
+                   if buffer[0].shape == array.shape and buffer[0].numpy().dtype == array.dtype]
+        self._buffers[name] = buffers
+        for buffer in buffers:
+            # Do not overwrite a buffer while the upload of an older frame still reads from it
+            if buffer[1].query():
+                return buffer
+        buffer = [torch.from_numpy(np.empty(array.shape, dtype=array.dtype)).pin_memory(), torch.cuda.Event()]
+        buffers.append(buffer)
+        return buffer
@@ -110,6 +110,7 @@ class GlobalConfig:
     embd_pdrop = 0.1
     resid_pdrop = 0.1
     attn_pdrop = 0.1
+    attention_backend = 'sdpa' # 'sdpa': fused torch scaled_dot_product_attention (torch >= 2.0), 'math': explicit softmax attention
 
     # Controller
     turn_KP = 1.25
@@ -158,6 +158,7 @@ class GlobalConfig:
     carla_fps = 20 # Simulator Frames per second
     iou_treshold_nms = 0.2  # Iou threshold used for Non Maximum suppression on the Bounding Box predictions for the ensembles
     steer_damping = 0.5 # Damping factor by which the steering will be multiplied when braking
+    ensemble_streams = True # Run the models of an ensemble concurrently, each on its own CUDA stream
     route_planner_min_distance = 7.5
     route_planner_max_distance = 50.0
     action_repeat = 2 # Number of times we repeat the networks action. It's 2 because the LiDAR operates at half the frame rate of the simulation
@@ -187,6 +188,7 @@ class GlobalConfig:
     embd_pdrop = 0.1
     resid_pdrop = 0.1
     attn_pdrop = 0.1
+    attention_backend = 'sdpa' # 'sdpa': fused torch scaled_dot_product_attention (torch >= 2.0), 'math': explicit softmax attention
     gpt_linear_layer_init_mean = 0.0 # Mean of the normal distribution with which the linear layers in the GPT are initialized
     gpt_linear_layer_init_std  = 0.02 # Std  of the normal distribution with which the linear layers in the GPT are initialized
     gpt_layer_norm_init_weight = 1.0 # Initial weight of the layer norms in the gpt.
@@ -2,6 +2,7 @@ import os
 import ujson
 from skimage.transform import rotate
 import numpy as np
+import torch
 from torch.utils.data import Dataset
 from tqdm import tqdm
 import sys
@@ -11,8 +12,12 @@ import random
 from copy import deepcopy
 import io
 
+from .lidar_splat import LidarSplatter, sample_cell_points, sample_cell_points_torch
 from .utils import get_vehicle_to_virtual_lidar_transform, get_vehicle_to_lidar_transform, get_lidar_to_vehicle_transform, get_lidar_to_bevimage_transform
 
+# 256 x 256 grid, 8 pixels per meter, 16m to the sides and 32m to the front
+LIDAR_SPLATTER = LidarSplatter()
+
 class CARLA_Data(Dataset):
 
     def __init__(self, root, config, shared_dict=None):
@@ -447,27 +452,7 @@ def lidar_to_histogram_features(lidar):
     """
     Convert LiDAR point cloud into 2-bin histogram over 256x256 grid
     """
-    def splat_points(point_cloud):
-        # 256 x 256 grid
-        pixels_per_meter = 8
-        hist_max_per_pixel = 5
-        x_meters_max = 16
-        y_meters_max = 32
-        xbins = np.linspace(-x_meters_max, x_meters_max, 32*pixels_per_meter+1)
-        ybins = np.linspace(-y_meters_max, 0, 32*pixels_per_meter+1)
-        hist = np.histogramdd(point_cloud[..., :2], bins=(xbins, ybins))[0]
-        hist[hist>hist_max_per_pixel] = hist_max_per_pixel
-        overhead_splat = hist/hist_max_per_pixel
-        return overhead_splat
-
-    below = lidar[lidar[...,2]<=-2.3]
-    above = lidar[lidar[...,2]>-2.3]
-    below_features = splat_points(below)
-    above_features = splat_points(above)
-    features = np.stack([above_features, below_features], axis=-1)
-    features = np.transpose(features, (2, 0, 1)).astype(np.float32)
-    features = np.rot90(features, -1, axes=(1,2)).copy()
-    return features
+    return LIDAR_SPLATTER(lidar)
 
 def get_bbox_label(bbox, rad=0):
     # dx, dy, dz, x, y, z, yaw
@@ -629,57 +614,35 @@ def draw_target_point(target_point, color = (255, 255, 255)):
     image = image.reshape(1, 256, 256)
     return image.astype(np.float) / 255.
 
-def correspondences_at_one_scale(valid_bev_points, valid_cam_points, lidar_x, lidar_y, camera_x, camera_y, scale):
+def correspondences_at_one_scale(valid_bev_points, valid_cam_points, lidar_x, lidar_y, camera_x, camera_y, scale, device=None):
     """
     Compute projections between LiDAR BEV and image space
+    If device is given the sampling runs with torch on that device and tensors are returned.
     """
-    cam_to_bev_proj_locs = np.zeros((lidar_x, lidar_y, 5, 2))
-    bev_to_cam_proj_locs = np.zeros((camera_x, camera_y, 5, 2))
-
-    tmp_bev = np.empty((lidar_x, lidar_y, ), dtype=object)
-    tmp_cam = np.empty((camera_x, camera_y, ), dtype=object)
-    for i in range(lidar_x):
-        for j in range(lidar_y):
-            tmp_bev[i,j] = []
-
-    for i in range(camera_x):
-        for j in range(camera_y):
-            tmp_cam[i, j] = []
-
-    for i in range(valid_bev_points.shape[0]):
-        tmp_bev[valid_bev_points[i][0]//scale, valid_bev_points[i][1]//scale].append(valid_cam_points[i]//scale)
-        tmp_cam[valid_cam_points[i][0]//scale, valid_cam_points[i][1]//scale].append(valid_bev_points[i]//scale)
-
-    for i in range(lidar_x):
-        for j in range(lidar_y):
-            cam_to_bev_points = tmp_bev[i,j]
-
-            if len(cam_to_bev_points) > 5:
-                cam_to_bev_proj_locs[i,j] = np.array(random.sample(cam_to_bev_points, 5))
-            elif len(cam_to_bev_points) > 0:
-                num_points = len(cam_to_bev_points)
-                cam_to_bev_proj_locs[i,j,:num_points] = np.array(cam_to_bev_points)
-
-    for i in range(camera_x):
-        for j in range(camera_y):
-            bev_to_cam_points = tmp_cam[i,j]
-
-            if len(bev_to_cam_points) > 5:
-                bev_to_cam_proj_locs[i,j] = np.array(random.sample(bev_to_cam_points, 5))
-            elif len(bev_to_cam_points) > 0:
-                num_points = len(bev_to_cam_points)
-                bev_to_cam_proj_locs[i,j,:num_points] = np.array(bev_to_cam_points)
+    valid_bev_points = np.asarray(valid_bev_points, dtype=np.int64).reshape(-1, 2) // scale
+    valid_cam_points = np.asarray(valid_cam_points, dtype=np.int64).reshape(-1, 2) // scale
+
+    if device is not None:
+        valid_bev_points = torch.from_numpy(valid_bev_points).to(device)
+        valid_cam_points = torch.from_numpy(valid_cam_points).to(device)
+        cam_to_bev_proj_locs = sample_cell_points_torch(valid_bev_points, valid_cam_points, lidar_x, lidar_y)
+        bev_to_cam_proj_locs = sample_cell_points_torch(valid_cam_points, valid_bev_points, camera_x, camera_y)
+    else:
+        cam_to_bev_proj_locs = sample_cell_points(valid_bev_points, valid_cam_points, lidar_x, lidar_y)
+        bev_to_cam_proj_locs = sample_cell_points(valid_cam_points, valid_bev_points, camera_x, camera_y)
 
     return cam_to_bev_proj_locs, bev_to_cam_proj_locs
 
-def lidar_bev_cam_correspondences(world, lidar_vis=None, image_vis=None, step=None, debug=False):
+def lidar_bev_cam_correspondences(world, lidar_vis=None, image_vis=None, step=None, debug=False, device=None):
     """
     Convert LiDAR point cloud to camera co-ordinates
+
     world: Expects the point cloud from CARLA in the CARLA coordinate system: x left, y forward, z up (LiDAR rotated by 90 degree)
     lidar_vis: lidar prjected to BEV
     image_vis: RGB input image to the network
     step: current timestep
     debug: Whether to save the debug images. If false only world is required
+    device: If given, the correspondences are sampled with torch on this device and returned as tensors
     """
 
     pixels_per_meter = 8
@@ -796,27 +759,23 @@ def lidar_bev_cam_correspondences(world, lidar_vis=None, image_vis=None, step=No
         vis_original_lidar[np.greater(lidar_vis[0,1], 0)] = 255
 
 
-    valid_bev_points = []
-    valid_cam_points = []
-    for i in range(results_total.shape[0]):
-        # Project the LiDAR point to BEV and save index of the BEV image pixel.
-        lidar_index = int(results_total[i, 2])
-        bev_x = int((lidar[lidar_index][0] + lidar_meters_x) * pixels_per_meter)
-        # The network input images use a top left coordinate system, we need to convert the bottom left coordinates by inverting the y axis
-        bev_y = (int(lidar[lidar_index][1] * pixels_per_meter) - (lidar_height-1)) * -1
+    # Project the LiDAR points to BEV and save index of the BEV image pixel.
+    lidar_indices = results_total[:, 2].astype(np.int64)
+    bev_x = ((lidar[lidar_indices, 0] + lidar_meters_x) * pixels_per_meter).astype(np.int64)
+    # The network input images use a top left coordinate system, we need to convert the bottom left coordinates by inverting the y axis
+    bev_y = ((lidar[lidar_indices, 1] * pixels_per_meter).astype(np.int64) - (lidar_height-1)) * -1
+    valid_bev_points = np.stack([bev_x, bev_y], axis=1)
 
-        valid_bev_points.append([bev_x, bev_y])
-        # Calculate index in the final image by rounding down
-        img_x = int(results_total[i][0])
-        # The network input images use a top left coordinate system, we need to convert the bottom left coordinates by inverting the y axis
-        img_y = (int(results_total[i][1]) - (img_height - 1)) * -1
-        valid_cam_points.append([img_x, img_y])
+    # Calculate index in the final image by rounding down
+    img_x = results_total[:, 0].astype(np.int64)
+    # The network input images use a top left coordinate system, we need to convert the bottom left coordinates by inverting the y axis
+    img_y = (results_total[:, 1].astype(np.int64) - (img_height - 1)) * -1
+    valid_cam_points = np.stack([img_x, img_y], axis=1)
 
-
-        if (debug == True):
-            vis_original_image[img_y, img_x] = np.array([0.0,1.0,0.0])
-            vis_bev[bev_y, bev_x] = 255 #Debug visualization
-            vis[img_y, img_x] = 255
+    if (debug == True):
+        vis_original_image[img_y, img_x] = np.array([0.0,1.0,0.0])
+        vis_bev[bev_y, bev_x] = 255 #Debug visualization
+        vis[img_y, img_x] = 255
 
     if (debug == True):
         # NOTE add the paths you want the images to land in here before debugging
@@ -831,12 +790,9 @@ def lidar_bev_cam_correspondences(world, lidar_vis=None, image_vis=None, step=No
         plt.ioff()
 
 
-    valid_bev_points = np.array(valid_bev_points)
-    valid_cam_points = np.array(valid_cam_points)
-
     bev_points, cam_points = correspondences_at_one_scale(valid_bev_points, valid_cam_points,  (lidar_width // downscale_factor),
                                                           (lidar_height // downscale_factor), (img_width // downscale_factor) * 2,
-                                                          (img_height // downscale_factor), downscale_factor)
+                                                          (img_height // downscale_factor), downscale_factor, device=device)
 
     return bev_points, cam_points
 
@@ -249,7 +249,7 @@ class GPT(nn.Module):
 
         # transformer
         self.blocks = nn.Sequential(*[Block(n_embd, n_head, 
-                        block_exp, attn_pdrop, resid_pdrop)
+                        block_exp, attn_pdrop, resid_pdrop, config.attention_backend)
                         for layer in range(n_layer)])
         
         # decoder head
@@ -424,7 +424,7 @@ class SelfAttention(nn.Module):
     A vanilla multi-head masked self-attention layer with a projection at the end.
     """
 
-    def __init__(self, n_embd, n_head, attn_pdrop, resid_pdrop):
+    def __init__(self, n_embd, n_head, attn_pdrop, resid_pdrop, attention_backend='math'):
         super().__init__()
         assert n_embd % n_head == 0
         # key, query, value projections for all heads
@@ -437,6 +437,8 @@ class SelfAttention(nn.Module):
         # output projection
         self.proj = nn.Linear(n_embd, n_embd)
         self.n_head = n_head
+        # The fused kernel needs torch >= 2.0, older versions fall back to the explicit attention
+        self.use_sdpa = attention_backend == 'sdpa' and hasattr(F, 'scaled_dot_product_attention')
 
     def forward(self, x):
         B, T, C = x.size()
@@ -446,11 +448,15 @@ class SelfAttention(nn.Module):
         q = self.query(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        # self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        att = F.softmax(att, dim=-1)
-        att = self.attn_drop(att)
-        y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        if self.use_sdpa:
+            # Fused flash / memory efficient kernel, the (T, T) attention matrix is never materialized
+            y = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.0)
+        else:
+            # self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+            att = F.softmax(att, dim=-1)
+            att = self.attn_drop(att)
+            y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
@@ -461,11 +467,11 @@ class SelfAttention(nn.Module):
 class Block(nn.Module):
     """ an unassuming Transformer block """
 
-    def __init__(self, n_embd, n_head, block_exp, attn_pdrop, resid_pdrop):
+    def __init__(self, n_embd, n_head, block_exp, attn_pdrop, resid_pdrop, attention_backend='math'):
         super().__init__()
         self.ln1 = nn.LayerNorm(n_embd)
         self.ln2 = nn.LayerNorm(n_embd)
-        self.attn = SelfAttention(n_embd, n_head, attn_pdrop, resid_pdrop)
+        self.attn = SelfAttention(n_embd, n_head, attn_pdrop, resid_pdrop, attention_backend)
         self.mlp = nn.Sequential(
             nn.Linear(n_embd, block_exp * n_embd),
             nn.ReLU(True), # changed from GELU
@@ -15,13 +15,14 @@ from torchvision import models
 # Copyright (c) OpenMMLab. All rights reserved.
 import torch
 import torch.nn as nn
+from torch_scatter import scatter_max
 from mmcv.cnn import bias_init_with_prob, normal_init
 from mmcv.ops import batched_nms
 from mmcv.runner import force_fp32
 
 from mmdet.core import multi_apply
 from mmdet.models import HEADS, build_loss
-from mmdet.models.utils import gaussian_radius, gen_gaussian_target
+from mmdet.models.utils.gaussian_target import gaussian2D
 from mmdet.models.utils.gaussian_target import (get_local_maximum, get_topk_from_heatmap,
                                      transpose_and_gather_feat)
 from mmdet.models.dense_heads.base_dense_head import BaseDenseHead
@@ -281,6 +282,28 @@ class LidarCenterNetHead(BaseDenseHead, BBoxTestMixin):
             angle[angle > np.pi] -= 2 * np.pi
         return angle
 
+    @staticmethod
+    def gaussian_radii(height, width, min_overlap):
+        """gaussian_radius of mmdet for tensors of box sizes, with the same
+        operations in the same order, so the radii are identical.
+        """
+        a1 = 1
+        b1 = (height + width)
+        c1 = width * height * (1 - min_overlap) / (1 + min_overlap)
+        sq1 = torch.sqrt(b1**2 - 4 * a1 * c1)
+        r1 = (b1 - sq1) / (2 * a1)
+        a2 = 4
+        b2 = 2 * (height + width)
+        c2 = (1 - min_overlap) * width * height
+        sq2 = torch.sqrt(b2**2 - 4 * a2 * c2)
+        r2 = (b2 - sq2) / (2 * a2)
+        a3 = 4 * min_overlap
+        b3 = -2 * min_overlap * (height + width)
+        c3 = (min_overlap - 1) * width * height
+        sq3 = torch.sqrt(b3**2 - 4 * a3 * c3)
+        r3 = (b3 + sq3) / (2 * a3)
+        return torch.min(torch.min(r1, r2), r3)
+
     def get_targets(self, gt_bboxes, gt_labels, gt_ignores, feat_shape):
         """Compute regression and classification targets in multiple images.
 
@@ -321,44 +344,57 @@ class LidarCenterNetHead(BaseDenseHead, BBoxTestMixin):
         wh_offset_target_weight = gt_bboxes[-1].new_zeros(
             [bs, 2, feat_h, feat_w])
 
-        for batch_id in range(bs):
-            gt_bbox = gt_bboxes[0][batch_id]
-            gt_label = gt_labels[0][batch_id]
-            gt_ignore = gt_ignores[0][batch_id]
-
-            center_x = gt_bbox[:, [0]] * width_ratio
-            center_y = gt_bbox[:, [1]] * width_ratio
-            gt_centers = torch.cat((center_x, center_y), dim=1)
-
-            for j, ct in enumerate(gt_centers):
-                if gt_ignore[j]:
-                    continue
-
-                ctx_int, cty_int = ct.int()
-                ctx, cty = ct
-                scale_box_h = gt_bbox[j, 3] * height_ratio
-                scale_box_w = gt_bbox[j, 2] * width_ratio
-                
-                radius = gaussian_radius([scale_box_h, scale_box_w], min_overlap=0.1)
-                radius = max(2, int(radius))
-                ind = gt_label[j].long()
-                
-                gen_gaussian_target(center_heatmap_target[batch_id, ind], [ctx_int, cty_int], radius)
-
-                wh_target[batch_id, 0, cty_int, ctx_int] = scale_box_w
-                wh_target[batch_id, 1, cty_int, ctx_int] = scale_box_h
-                
-                yaw_class, yaw_res = self.angle2class(gt_bbox[j, 4])
-
-                yaw_class_target[batch_id, 0, cty_int, ctx_int] = yaw_class
-                yaw_res_target[batch_id, 0, cty_int, ctx_int] = yaw_res
-
-                velocity_target[batch_id, 0, cty_int, ctx_int] = gt_bbox[j, 5]
-                brake_target[batch_id, 0, cty_int, ctx_int] = gt_bbox[j, 6].long()
-                 
-                offset_target[batch_id, 0, cty_int, ctx_int] = ctx - ctx_int
-                offset_target[batch_id, 1, cty_int, ctx_int] = cty - cty_int
-                wh_offset_target_weight[batch_id, :, cty_int, ctx_int] = 1
+        # All boxes of the batch at once, the ignored ones are dropped
+        gt_bbox = torch.cat([gt_bboxes[0][batch_id] for batch_id in range(bs)])
+        gt_label = torch.cat([gt_labels[0][batch_id] for batch_id in range(bs)])
+        gt_ignore = torch.cat([gt_ignores[0][batch_id] for batch_id in range(bs)])
+        batch_ids = torch.cat([torch.full((len(gt_bboxes[0][batch_id]),), batch_id, dtype=torch.long, device=gt_bbox.device)
+                               for batch_id in range(bs)])
+        valid = ~gt_ignore.bool()
+        gt_bbox, gt_label, batch_ids = gt_bbox[valid], gt_label[valid].long(), batch_ids[valid]
+
+        if len(gt_bbox) > 0:
+            ctx = gt_bbox[:, 0] * width_ratio
+            cty = gt_bbox[:, 1] * width_ratio
+            ctx_int, cty_int = ctx.int().long(), cty.int().long()
+            scale_box_h = gt_bbox[:, 3] * height_ratio
+            scale_box_w = gt_bbox[:, 2] * width_ratio
+
+            radius = self.gaussian_radii(scale_box_h, scale_box_w, min_overlap=0.1).long().clamp(min=2)
+
+            # Every box splats the gaussian of its radius, padded to the largest one. Overlapping gaussians keep the
+            # maximum like gen_gaussian_target, the zero padding never wins.
+            radii, kernel_ids = torch.unique(radius, return_inverse=True)
+            max_radius = int(radii[-1])
+            kernels = center_heatmap_target.new_zeros([len(radii), 2 * max_radius + 1, 2 * max_radius + 1])
+            for i, r in enumerate(radii.tolist()):
+                kernels[i, max_radius - r:max_radius + r + 1, max_radius - r:max_radius + r + 1] = gaussian2D(
+                    r, sigma=(2 * r + 1) / 6, dtype=center_heatmap_target.dtype, device=center_heatmap_target.device)
+
+            offsets = torch.arange(-max_radius, max_radius + 1, device=gt_bbox.device)
+            ys = (cty_int[:, None] + offsets)[:, :, None]
+            xs = (ctx_int[:, None] + offsets)[:, None, :]
+            inside = (ys >= 0) & (ys < feat_h) & (xs >= 0) & (xs < feat_w)
+            channels = (batch_ids * self.num_classes + gt_label)[:, None, None]
+            heatmap_ids = ((channels * feat_h + ys) * feat_w + xs)[inside]
+            scatter_max(kernels[kernel_ids][inside], heatmap_ids, dim=0, out=center_heatmap_target.view(-1))
+
+            # Boxes with the same center cell overwrite each other, the last one wins
+            cell_ids = (batch_ids * feat_h + cty_int) * feat_w + ctx_int
+            order = torch.arange(len(cell_ids), device=gt_bbox.device)
+            last = scatter_max(order, cell_ids, dim=0, dim_size=bs * feat_h * feat_w)[0]
+            last = last[cell_ids] == order
+            batch_ids, ctx_int, cty_int = batch_ids[last], ctx_int[last], cty_int[last]
+
+            yaw_class, yaw_res = self.angle2class(gt_bbox[last, 4])
+
+            wh_target[batch_ids, :, cty_int, ctx_int] = torch.stack((scale_box_w[last], scale_box_h[last]), dim=1)
+            yaw_class_target[batch_ids, 0, cty_int, ctx_int] = yaw_class
+            yaw_res_target[batch_ids, 0, cty_int, ctx_int] = yaw_res
+            velocity_target[batch_ids, 0, cty_int, ctx_int] = gt_bbox[last, 5]
+            brake_target[batch_ids, 0, cty_int, ctx_int] = gt_bbox[last, 6].long()
+            offset_target[batch_ids, :, cty_int, ctx_int] = torch.stack((ctx[last] - ctx_int, cty[last] - cty_int), dim=1)
+            wh_offset_target_weight[batch_ids, :, cty_int, ctx_int] = 1
 
         avg_factor = max(1, center_heatmap_target.eq(1).sum())
         target_result = dict(
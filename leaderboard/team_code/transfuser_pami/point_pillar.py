@@ -3,7 +3,7 @@ Credit: Tianwei Yin
 Copied from LAV repo
 """
 
-from torch_scatter import scatter_mean, scatter_max
+from torch_scatter import scatter_max
 from torch import nn
 import torch
 
@@ -30,7 +30,6 @@ class DynamicPointNet(nn.Module):
         """
         feat = self.net(points)
         feat_max = scatter_max(feat, inverse_indices, dim=0)[0]
-        # feat_max = scatter_max(points, inverse_indices, dim=0)[0]
         return feat_max
 
 
@@ -43,8 +42,8 @@ class PointPillarNet(nn.Module):
         super().__init__()
         self.point_net = DynamicPointNet(num_input, num_features)
 
-        self.nx = (max_x-min_x) * pixels_per_meter
-        self.ny = (max_y-min_y) * pixels_per_meter
+        self.nx = int((max_x-min_x) * pixels_per_meter)
+        self.ny = int((max_y-min_y) * pixels_per_meter)
         self.min_x = min_x 
         self.min_y = min_y 
         self.max_x = max_x 
@@ -53,12 +52,16 @@ class PointPillarNet(nn.Module):
 
     def decorate(self, points, unique_coords, inverse_indices):
         dtype = points.dtype
-        x_centers = unique_coords[inverse_indices][:, 2:3].to(dtype) / self.pixels_per_meter + self.min_x 
-        y_centers = unique_coords[inverse_indices][:, 1:2].to(dtype) / self.pixels_per_meter + self.min_y 
+        point_coords = unique_coords[inverse_indices]
+        x_centers = point_coords[:, 2:3].to(dtype) / self.pixels_per_meter + self.min_x 
+        y_centers = point_coords[:, 1:2].to(dtype) / self.pixels_per_meter + self.min_y 
 
         xyz = points[:, :3]
 
-        points_cluster = xyz - scatter_mean(xyz, inverse_indices, dim=0)[inverse_indices]
+        # Mean of the points of every pillar as a segment sum over the pillar indices
+        pillar_sum = xyz.new_zeros((unique_coords.shape[0], 3)).index_add_(0, inverse_indices, xyz)
+        pillar_count = torch.bincount(inverse_indices, minlength=unique_coords.shape[0]).clamp(min=1)
+        points_cluster = xyz - (pillar_sum / pillar_count[:, None].to(dtype))[inverse_indices]
 
         points_xp = xyz[:, :1] - x_centers 
         points_yp = xyz[:, 1:2] - y_centers
@@ -66,26 +69,32 @@ class PointPillarNet(nn.Module):
         features = torch.cat([points, points_cluster, points_xp, points_yp], dim=-1)
         return features 
 
-    def grid_locations(self, points):
-        keep = (points[:, 0] >= self.min_x) & (points[:, 0] < self.max_x) & \
-            (points[:, 1] >= self.min_y) & (points[:, 1] < self.max_y)
-        points = points[keep, :]
-
-        #Visualize
-        #import open3d as o3d
-        #pcd = o3d.geometry.PointCloud()
-        #pcd.points = o3d.utility.Vector3dVector(points[...,:3].detach().cpu().numpy())
-        #o3d.visualization.draw_geometries([pcd])
-
+    def grid_locations(self, points, num_points):
+        """
+        Points of a padded batch [B, N, C] that are valid (index < num_points) and inside of the grid, packed into [P, C],
+        and their grid coordinates [P, 3] (batch index, x cell, y cell).
+        """
+        batch_size, max_points = points.shape[0], points.shape[1]
+        keep = torch.arange(max_points, device=points.device)[None, :] < num_points.to(points.device)[:, None]
+        keep &= (points[..., 0] >= self.min_x) & (points[..., 0] < self.max_x) & \
+            (points[..., 1] >= self.min_y) & (points[..., 1] < self.max_y)
+        batch_ids = torch.arange(batch_size, device=points.device)[:, None].expand(batch_size, max_points)[keep]
+        points = points[keep]
 
         coords = (points[:, [0, 1]] - torch.tensor([self.min_x, self.min_y], 
             device=points.device)) * self.pixels_per_meter
-        coords = coords.long()
+        coords = torch.cat((batch_ids[:, None], coords.long()), dim=1)
 
         return points, coords 
 
     def pillar_generation(self, points, coords):
-        unique_coords, inverse_indices = coords.unique(return_inverse=True, dim=0)
+        # Unique over one linear index per pillar instead of the rows of coords. Every coordinate gets one cell of slack
+        # for points that round onto the upper border, and the strides keep the order of coords.unique(dim=0).
+        size_x, size_y = self.nx + 1, self.ny + 1
+        linear = (coords[:, 0] * size_x + coords[:, 1]) * size_y + coords[:, 2]
+        unique_linear, inverse_indices = torch.unique(linear, return_inverse=True)
+        unique_coords = torch.stack((unique_linear // (size_x * size_y), (unique_linear // size_y) % size_x,
+                                     unique_linear % size_y), dim=1)
         decorated_points = self.decorate(points, unique_coords, inverse_indices)
 
         return decorated_points, unique_coords, inverse_indices
@@ -96,24 +105,18 @@ class PointPillarNet(nn.Module):
         return canvas 
 
     def forward(self, lidar_list, num_points):
+        """
+        lidar_list: padded batch of point clouds [B, N, C] with num_points [B] valid points each,
+        or a list of [N_i, C] point clouds and their number of points.
+        """
         batch_size = len(lidar_list)
         with torch.no_grad():
-            coords = [] 
-            filtered_points = [] 
-            for batch_id, points in enumerate(lidar_list):
-                points = points[:num_points[batch_id]]
-                points, grid_yx= self.grid_locations(points)
-
-                # batch indices 
-                grid_byx = torch.nn.functional.pad(grid_yx, 
-                    (1, 0), mode='constant', value=batch_id)
-
-                coords.append(grid_byx)
-                filtered_points.append(points)
+            if isinstance(lidar_list, (list, tuple)):
+                lidar_list = torch.nn.utils.rnn.pad_sequence(list(lidar_list), batch_first=True)
+                num_points = torch.stack([torch.as_tensor(n, device=lidar_list.device) for n in num_points])
 
             # batch_size, grid_y, grid_x 
-            coords = torch.cat(coords, dim=0)
-            filtered_points = torch.cat(filtered_points, dim=0)
+            filtered_points, coords = self.grid_locations(lidar_list, num_points)
 
             decorated_points, unique_coords, inverse_indices = self.pillar_generation(filtered_points, coords)
 
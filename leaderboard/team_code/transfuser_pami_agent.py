@@ -13,6 +13,7 @@ import numpy as np
 import math
 
 from leaderboard.autoagents import autonomous_agent
+from team_code.sensor_pipeline import SensorPipeline
 from transfuser_pami.model import LidarCenterNet
 from transfuser_pami.config import GlobalConfig
 from transfuser_pami.data import lidar_to_histogram_features, draw_target_point, lidar_bev_cam_correspondences
@@ -22,6 +23,7 @@ from matplotlib import cm
 
 import itertools
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 from torchvision.utils import save_image
 
@@ -107,8 +109,21 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
 
         self.use_lidar_safe_check = True
         self.aug_degrees = [0] # Test time data augmentation. Unused we only augment by 0 degree.
+        # Inverse rotation of every test time augmentation, applied to the waypoints as wp @ matrix
+        aug_rads = np.deg2rad(self.aug_degrees)
+        self.aug_inverse_rotations = torch.tensor(np.array([[[np.cos(rad), np.sin(rad)], [-np.sin(rad), np.cos(rad)]] for rad in aug_rads]),
+                                                  dtype=torch.float32, device='cuda')
+
+        # Every model of the ensemble runs in its own thread on its own CUDA stream. forward_ego synchronizes with the
+        # host to read the bounding boxes, so a single thread would serialize the models.
+        self.ensemble_streams = None
+        if self.config.ensemble_streams and self.model_count > 1:
+            self.ensemble_streams = [torch.cuda.Stream() for _ in range(self.model_count)]
+            self.ensemble_pool = ThreadPoolExecutor(max_workers=self.model_count)
         self.steer_damping = self.config.steer_damping
         self.rgb_back = None #For debugging
+        self.sensor_pipeline = SensorPipeline('cuda:0')
+        self.pending_frame = None # (preprocessing of the last network frame, its tick data)
 
         self.save_path = None
         if SAVE_PATH is not None:
@@ -198,7 +213,8 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
                            
         return sensors
 
-    def tick(self, input_data):
+    def preprocess_sensors(self, input_data):
+        # Runs on the sensor pipeline worker thread
         rgb = []
         for pos in ['left', 'front', 'right']:
         	rgb_cam = 'rgb_' + pos
@@ -207,6 +223,23 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
         	rgb.append(rgb_pos)
         rgb = np.concatenate(rgb, axis=1)
 
+        result = {
+                'rgb': rgb,
+                'image': self.prepare_image(rgb),
+                }
+
+        if (self.backbone != 'latentTF'):
+            lidar = input_data['lidar'][1][:, :3]
+            result['lidar'] = lidar
+            if (self.config.use_point_pillars == False):
+                result['lidar_bev'] = self.prepare_lidar(lidar)
+            else:
+                # The sensor data is read-only, inverting makes the one copy that is uploaded
+                result['lidar_cloud'] = input_data['lidar'][1] * np.array([1, -1, 1, 1], dtype=np.float32)  # invert
+
+        return result
+
+    def tick(self, input_data):
         if(SAVE_PATH != None): #Debug camera for visualizations
             # don't need buffer for it always use the latest one
             self.rgb_back = input_data["rgb_back"][1][:, :, :3]
@@ -218,16 +251,11 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
             compass = 0.0
 
         result = {
-                'rgb': rgb,
                 'gps': gps,
                 'speed': speed,
                 'compass': compass,
                 }
 
-        if (self.backbone != 'latentTF'):
-            lidar = input_data['lidar'][1][:, :3]
-            result['lidar'] = lidar
-
         pos = self._get_position(result)
         result['gps'] = pos
 
@@ -263,15 +291,25 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
             self.control = control        
 
         # Need to run this every step for GPS denoising
-        tick_data = self.tick(input_data)
+        current_tick = self.tick(input_data)
 
         # repeat actions twice to ensure LiDAR data availability
-        if self.step % self.config.action_repeat == 1:
-            self.update_gps_buffer(self.control, tick_data['compass'], tick_data['speed'])
+        # The cameras and the LiDAR of the frames that the networks use are preprocessed on the sensor pipeline while
+        # the simulator computes the next frame. The networks then run on the next step, which only repeats the action.
+        if self.step % self.config.action_repeat == 0:
+            pending = self.sensor_pipeline.submit(self.preprocess_sensors, input_data, upload=('image', 'lidar_bev'))
+            self.pending_frame = (pending, current_tick)
+        if self.pending_frame is None or (self.config.action_repeat > 1 and self.step % self.config.action_repeat != 1):
+            self.update_gps_buffer(self.control, current_tick['compass'], current_tick['speed'])
             return self.control
 
+        pending, tick_data = self.pending_frame
+        self.pending_frame = None
+        sensors, inputs = pending.result()
+        tick_data.update(sensors)
+
         # prepare image input
-        image = self.prepare_image(tick_data)
+        image = inputs['image'].to(dtype=torch.float32)
 
 
         num_points = None
@@ -280,12 +318,11 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
         else:
             # prepare LiDAR input
             if (self.config.use_point_pillars == True):
-                lidar_cloud = deepcopy(input_data['lidar'][1])
-                lidar_cloud[:, 1] *= -1  # invert
-                lidar_bev = [torch.tensor(lidar_cloud).to('cuda', dtype=torch.float32)]
+                lidar_cloud = tick_data['lidar_cloud']
+                lidar_bev = [torch.from_numpy(lidar_cloud).to('cuda', dtype=torch.float32)]
                 num_points = [torch.tensor(len(lidar_cloud)).to('cuda', dtype=torch.int32)]
             else:
-                lidar_bev = self.prepare_lidar(tick_data)
+                lidar_bev = inputs['lidar_bev'].to(dtype=torch.float32)
 
         
         # prepare goal location input
@@ -306,35 +343,28 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
 
 
         # forward pass
-        with torch.no_grad():
-            pred_wps = []
-            bounding_boxes = []
-            for i in range(self.model_count):
-                rotated_bb = []
-                if (self.backbone == 'transFuser'):
-                    pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity,
-                                                          num_points=num_points, save_path=SAVE_PATH, stuck_detector=self.stuck_detector,
-                                                          forced_move=is_stuck, debug=self.config.debug, rgb_back=self.rgb_back)
-                elif (self.backbone == 'late_fusion'):
-                    pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, num_points=num_points)
-                elif (self.backbone == 'geometric_fusion'):
-                    bev_points = list()
-                    cam_points = list()
-
-                    curr_bev_points, curr_cam_points = lidar_bev_cam_correspondences(deepcopy(tick_data['lidar']), lidar_bev, image, self.step, False)
-                    bev_points.append(torch.from_numpy(curr_bev_points).unsqueeze(0))
-                    cam_points.append(torch.from_numpy(curr_cam_points).unsqueeze(0))
-
-                    bev_points = bev_points[0].long().to('cuda', dtype=torch.int64)
-                    cam_points = cam_points[0].long().to('cuda', dtype=torch.int64)
-                    pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, bev_points, cam_points, num_points=num_points)
-                elif (self.backbone == 'latentTF'):
-                    pred_wp, rotated_bb = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, num_points=num_points)
-                else:
-                    raise ("The chosen vision backbone does not exist. The options are: transFuser, late_fusion, geometric_fusion, latentTF")
-
-                pred_wps.append(pred_wp)
-                bounding_boxes.append(rotated_bb)
+        bev_points, cam_points = None, None
+        if (self.backbone == 'geometric_fusion'):
+            # The correspondences are the same for every model of the ensemble
+            bev_points, cam_points = lidar_bev_cam_correspondences(deepcopy(tick_data['lidar']), lidar_bev, image, self.step, False, device='cuda')
+            bev_points = bev_points.unsqueeze(0).to('cuda', dtype=torch.int64)
+            cam_points = cam_points.unsqueeze(0).to('cuda', dtype=torch.int64)
+
+        inputs = (image, lidar_bev, target_point, target_point_image, velocity, bev_points, cam_points, num_points, is_stuck)
+        if self.ensemble_streams is None:
+            outputs = [self.forward_net(i, *inputs) for i in range(self.model_count)]
+        else:
+            main_stream = torch.cuda.current_stream()
+            for stream in self.ensemble_streams:
+                stream.wait_stream(main_stream)
+            jobs = [self.ensemble_pool.submit(self.forward_net, i, *inputs, stream=self.ensemble_streams[i]) for i in range(self.model_count)]
+            outputs = [job.result() for job in jobs]
+            for stream in self.ensemble_streams:
+                main_stream.wait_stream(stream)
+            for pred_wp, _ in outputs:
+                pred_wp.record_stream(main_stream) # Allocated on a side stream but used on the main stream
+        pred_wps = [pred_wp for pred_wp, _ in outputs]
+        bounding_boxes = [rotated_bb for _, rotated_bb in outputs]
 
         bbs_vehicle_coordinate_system = self.non_maximum_suppression(bounding_boxes, self.iou_treshold_nms)
 
@@ -342,19 +372,9 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
         self.pred_wp = torch.stack(pred_wps, dim=0).mean(dim=0) #Average the predictions from the ensembles
 
         # transform to local coordinates
-        pred_wp_transformed = []
-        for i, degree in enumerate(self.aug_degrees):
-            rad = np.deg2rad(degree)
-            degree_matrix = np.array([[np.cos(rad), np.sin(rad)],
-                                [-np.sin(rad), np.cos(rad)]])
-            # inverse
-            degree_matrix = degree_matrix.T
-            cur_pred_wp = self.pred_wp[i].detach().cpu().numpy()
-            transformed_wp = (degree_matrix @ cur_pred_wp.T).T
-            pred_wp_transformed.append(transformed_wp)
-
-        self.pred_wp = np.stack(pred_wp_transformed, axis=0)
-        self.pred_wp = torch.median(torch.from_numpy(self.pred_wp).to('cuda', dtype=torch.float32), dim=0, keepdims=True)[0]
+        num_augs = len(self.aug_degrees)
+        pred_wp_transformed = torch.bmm(self.pred_wp[:num_augs].float(), self.aug_inverse_rotations)
+        self.pred_wp = torch.median(pred_wp_transformed, dim=0, keepdim=True)[0]
 
         if (self.backbone == 'latentTF'):
             safety_box = []
@@ -362,8 +382,7 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
                 safety_box.append(True)
         else:
             # safety check
-            safety_box = deepcopy(tick_data['lidar'])
-            safety_box[:, 1] *= -1  # invert
+            safety_box = tick_data['lidar'] * np.array([1, -1, 1], dtype=np.float32)  # invert
 
             # z-axis
             safety_box      = safety_box[safety_box[..., 2] > self.config.safety_box_z_min]
@@ -412,8 +431,29 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
                 self.save(tick_data,lidar_bev)
 
 			
-        self.update_gps_buffer(self.control, tick_data['compass'], tick_data['speed'])
+        self.update_gps_buffer(self.control, current_tick['compass'], current_tick['speed'])
         return control
+
+    def forward_net(self, i, image, lidar_bev, target_point, target_point_image, velocity, bev_points, cam_points, num_points, is_stuck, stream=None):
+        """
+        Runs model i of the ensemble. When a stream is given the model is executed on it, the caller has to synchronize.
+        """
+        with torch.no_grad(), torch.cuda.stream(stream):
+            rotated_bb = []
+            if (self.backbone == 'transFuser'):
+                pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity,
+                                                      num_points=num_points, save_path=SAVE_PATH, stuck_detector=self.stuck_detector,
+                                                      forced_move=is_stuck, debug=self.config.debug, rgb_back=self.rgb_back)
+            elif (self.backbone == 'late_fusion'):
+                pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, num_points=num_points)
+            elif (self.backbone == 'geometric_fusion'):
+                pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, bev_points, cam_points, num_points=num_points)
+            elif (self.backbone == 'latentTF'):
+                pred_wp, rotated_bb = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, num_points=num_points)
+            else:
+                raise ("The chosen vision backbone does not exist. The options are: transFuser, late_fusion, geometric_fusion, latentTF")
+
+        return pred_wp, rotated_bb
         
     def save(self, tick_data,lidar_bev):
         frame = self.step // 10
@@ -507,14 +547,13 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
 
         return rotation_yaw
 
-    def prepare_image(self, tick_data):
-        image = Image.fromarray(tick_data['rgb'])
+    def prepare_image(self, rgb):
+        image = Image.fromarray(rgb)
         image_degrees = []
         for degree in self.aug_degrees:
             crop_shift = degree / 60 * self.config.img_width
-            rgb = torch.from_numpy(self.shift_x_scale_crop(image, scale=self.config.scale, crop=self.config.img_resolution, crop_shift=crop_shift)).unsqueeze(0)
-            image_degrees.append(rgb.to('cuda', dtype=torch.float32))
-        image = torch.cat(image_degrees, dim=0)
+            image_degrees.append(self.shift_x_scale_crop(image, scale=self.config.scale, crop=self.config.img_resolution, crop_shift=crop_shift))
+        image = np.stack(image_degrees, axis=0)
         return image
 
     def iou_bbs(self, bb1, bb2):
@@ -567,12 +606,9 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
 
 
 
-    def prepare_lidar(self, tick_data):
-        lidar_transformed = deepcopy(tick_data['lidar']) 
-        lidar_transformed[:, 1] *= -1  # invert
-        lidar_transformed = torch.from_numpy(lidar_to_histogram_features(lidar_transformed)).unsqueeze(0)
-        lidar_transformed_degrees = [lidar_transformed.to('cuda', dtype=torch.float32)]
-        lidar_bev = torch.cat(lidar_transformed_degrees[::-1], dim=1)
+    def prepare_lidar(self, lidar):
+        lidar_transformed = lidar * np.array([1, -1, 1], dtype=np.float32)  # invert
+        lidar_bev = lidar_to_histogram_features(lidar_transformed)[np.newaxis]
         return lidar_bev
 
     def prepare_goal_location(self, tick_data):
@@ -628,6 +664,9 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
         return cropped_image
 
     def destroy(self):
+        self.sensor_pipeline.close()
+        if self.ensemble_streams is not None:
+            self.ensemble_pool.shutdown()
         del self.nets
 
 # Taken from LBC
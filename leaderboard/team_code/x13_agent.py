@@ -19,6 +19,7 @@ from x13.model import x13
 from x13.config import GlobalConfig
 from x13.data import scale_and_crop_image, scale_and_crop_image_cv, rgb_to_depth, swap_RGB2BGR
 from team_code.planner import RoutePlanner
+from team_code.sensor_pipeline import SensorPipeline
 import torchvision.transforms as T
 from torchvision.utils import save_image
 
@@ -45,6 +46,8 @@ class x13Agent(autonomous_agent.AutonomousAgent):
 		self.net.load_state_dict(torch.load(os.path.join(path_to_conf_file, 'best_model.pth')))
 		self.net.cuda()
 		self.net.eval()
+		self.sensor_pipeline = SensorPipeline('cuda:0')
+		self.pending_frame = None
 
 		#control weights untuk PID dan MLP dari tuningan MGN
 		#urutan steer, throttle, brake
@@ -170,8 +173,8 @@ class x13Agent(autonomous_agent.AutonomousAgent):
 					'id': 'speed'
 					}]
 		
-	def tick(self, input_data):
-		self.step += 1
+	def preprocess_sensors(self, input_data):
+		# Runs on the sensor pipeline worker thread
 		rgb = []
 		for pos in ['left','front', 'right']:
 			rgb_cam = 'rgb_' + pos
@@ -190,6 +193,16 @@ class x13Agent(autonomous_agent.AutonomousAgent):
 			depth.append(depth_pos)
 		depth = np.concatenate(depth, axis=1)
 
+		rgb_input = scale_and_crop_image(Image.fromarray(rgb), scale=self.config.scale, crop=self.config.input_resolution)
+		# swap_RGB2BGR works in place, the saved depth image relies on that
+		depth_input = np.array(rgb_to_depth(scale_and_crop_image_cv(swap_RGB2BGR(depth), scale=self.config.scale, crop=self.config.input_resolution)))
+		return {'rgb': rgb, 'depth': depth, 'rgb_input': rgb_input, 'depth_input': depth_input}
+
+	def tick(self, input_data):
+		self.step += 1
+		# collected in run_step right before the forward pass, the other inputs are built while the worker preprocesses
+		self.pending_frame = self.sensor_pipeline.submit(self.preprocess_sensors, input_data, upload=('rgb_input', 'depth_input'))
+
 	#prv	rgb_left = cv2.cvtColor(input_data['rgb_left'][1][:, :, :3], cv2.COLOR_BGR2RGB)
       #prv		rgb_right = cv2.cvtColor(input_data['rgb_right'][1][:, :, :3], cv2.COLOR_BGR2RGB)
 	#prv	rgb_rear = cv2.cvtColor(input_data['rgb_rear'][1][:, :, :3], cv2.COLOR_BGR2RGB)
@@ -197,8 +210,6 @@ class x13Agent(autonomous_agent.AutonomousAgent):
 		speed = input_data['speed'][1]['speed']
 		compass = input_data['imu'][1][-1]
 		result = {
-				'rgb': rgb, # rgb
-				'depth': depth, # depth
 				#'rgb_left': rgb_left,
 				#'rgb_right': rgb_right,
 				# 'rgb_rear': rgb_rear,
@@ -265,8 +276,12 @@ class x13Agent(autonomous_agent.AutonomousAgent):
 		tick_data['target_point'] = [torch.FloatTensor([tick_data['target_point'][0]]), torch.FloatTensor([tick_data['target_point'][1]])]
 		target_point = torch.stack(tick_data['target_point'], dim=1).to('cuda', dtype=torch.float32)
 
+		sensors, inputs = self.pending_frame.result()
+		tick_data.update(sensors)
+		tick_data.update(inputs)
+
 		# encoding = []
-		rgb = torch.from_numpy(scale_and_crop_image(Image.fromarray(tick_data['rgb']), scale=self.config.scale, crop=self.config.input_resolution)).unsqueeze(0)
+		rgb = tick_data['rgb_input'].unsqueeze(0)
 		# torch.save(rgb, 'rgb.pt')
 		self.input_buffer['rgb'] = rgb.to('cuda', dtype=torch.float32)
 		
@@ -274,7 +289,7 @@ class x13Agent(autonomous_agent.AutonomousAgent):
 		# self.input_buffer['rgb'].append(rgb.to('cuda', dtype=torch.float32))
 		# encoding.append(self.net.image_encoder(list(self.input_buffer['rgb'])))
 
-		depth = torch.from_numpy(np.array(rgb_to_depth(scale_and_crop_image_cv(swap_RGB2BGR(tick_data['depth']), scale=self.config.scale, crop=self.config.input_resolution))))
+		depth = tick_data['depth_input']
 		# torch.save(depth, 'depth.pt')
 		self.input_buffer['depth'] = depth.to('cuda', dtype=torch.float32)
 
@@ -400,4 +415,5 @@ class x13Agent(autonomous_agent.AutonomousAgent):
 
 
 	def destroy(self):
+		self.sensor_pipeline.close()
 		del self.net
@@ -15,11 +15,94 @@ specific information
 """
 
 import fnmatch
+
+import numpy as np
+
+import carla
+
 from srunner.metrics.tools.metrics_parser import MetricsParser
 
+TRAFFIC_LIGHT_STATES = (
+    carla.TrafficLightState.Red,
+    carla.TrafficLightState.Yellow,
+    carla.TrafficLightState.Green,
+    carla.TrafficLightState.Off,
+    carla.TrafficLightState.Unknown,
+)
+
+VEHICLE_LIGHTS = (
+    carla.VehicleLightState.Position,
+    carla.VehicleLightState.LowBeam,
+    carla.VehicleLightState.HighBeam,
+    carla.VehicleLightState.Brake,
+    carla.VehicleLightState.RightBlinker,
+    carla.VehicleLightState.LeftBlinker,
+    carla.VehicleLightState.Reverse,
+    carla.VehicleLightState.Fog,
+    carla.VehicleLightState.Interior,
+    carla.VehicleLightState.Special1,
+    carla.VehicleLightState.Special2,
+)
+
+
+def to_transform(values):
+    """
+    Returns the carla.Transform of an (x, y, z, pitch, yaw, roll) row
+    """
+    x, y, z, pitch, yaw, roll = [float(value) for value in values]
+    return carla.Transform(carla.Location(x, y, z), carla.Rotation(pitch, yaw, roll))
+
+
+def to_vector(values):
+    """
+    Returns the carla.Vector3D of an (x, y, z) row
+    """
+    x, y, z = [float(value) for value in values]
+    return carla.Vector3D(x, y, z)
+
+
+def to_control(table, row):
+    """
+    Returns the carla.VehicleControl of a row of the vehicle animations
+    """
+    throttle, steer, brake = [float(value) for value in table.data["control"][row]]
+    gear = int(table.data["gear"][row])
+    return carla.VehicleControl(throttle, steer, brake, bool(table.data["hand_brake"][row]), gear < 0, False, gear)
+
+
+def to_vehicle_lights(mask):
+    """
+    Returns the list of carla.VehicleLightState of a bit mask
+    """
+    mask = int(mask)
+    if mask == 0:
+        return [carla.VehicleLightState.NONE]
+    return [light for light in VEHICLE_LIGHTS if mask & int(light)]
+
+
+# State name -> (state table, column, function that turns a row of the table into the state)
+ACTOR_STATES = {
+    "transform": ("positions", "transform", lambda table, row: to_transform(table.data["transform"][row])),
+    "velocity": ("dynamic_actors", "velocity", lambda table, row: to_vector(table.data["velocity"][row])),
+    "angular_velocity": ("dynamic_actors", "angular_velocity",
+                         lambda table, row: to_vector(table.data["angular_velocity"][row])),
+    "acceleration": ("dynamic_actors", "acceleration", lambda table, row: to_vector(table.data["acceleration"][row])),
+    "control": ("vehicle_animations", "control", to_control),
+    "speed": ("walker_animations", "speed", lambda table, row: float(table.data["speed"][row])),
+    "lights": ("vehicle_lights", "lights", lambda table, row: to_vehicle_lights(table.data["lights"][row])),
+    "state": ("traffic_lights", "state", lambda table, row: TRAFFIC_LIGHT_STATES[table.data["state"][row]]),
+    "frozen": ("traffic_lights", "frozen", lambda table, row: bool(table.data["frozen"][row])),
+    "elapsed_time": ("traffic_lights", "elapsed_time", lambda table, row: float(table.data["elapsed_time"][row])),
+}
+
+
 class MetricsLog(object):  # pylint: disable=too-many-public-methods
     """
     Utility class to query the log.
+
+    The actor states are stored as columns (see MetricsParser). Queries of one actor at one frame return carla
+    objects, queries over a frame interval (get_all_*) return NumPy arrays that are slices of the columns, with one
+    row per frame the state was recorded at. get_actor_state_frames returns the frame numbers of these rows.
     """
 
     def __init__(self, recorder):
@@ -29,6 +112,8 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
         # Parse the information
         parser = MetricsParser(recorder)
         self._simulation, self._actors, self._frames = parser.parse_recorder_info()
+        self._states = self._frames["states"]
+        self._events = self._frames["events"]
 
     ### Functions used to get general info of the simulation ###
     def get_actor_collisions(self, actor_id):
@@ -41,11 +126,10 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
         """
         actor_collisions = {}
 
-        for i, frame in enumerate(self._frames):
-            collisions = frame["events"]["collisions"]
-
-            if actor_id in collisions:
-                actor_collisions.update({i: collisions[actor_id]})
+        collisions = self._events["collisions"]
+        rows = collisions.actor_rows(actor_id)
+        for frame, other_id in zip(collisions.frame[rows], collisions.data["other_id"][rows]):
+            actor_collisions.setdefault(int(frame) - 1, []).append(int(other_id))
 
         return actor_collisions
 
@@ -61,21 +145,22 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
         Returns a float with the elapsed time of a specific frame.
         """
 
-        return self._frames[frame]["frame"]["elapsed_time"]
+        return float(self._frames["elapsed_time"][frame])
 
     def get_delta_time(self, frame):
         """
         Returns a float with the delta time of a specific frame.
         """
 
-        return self._frames[frame]["frame"]["delta_time"]
+        return float(self._frames["delta_time"][frame])
 
     def get_platform_time(self, frame):
         """
         Returns a float with the platform time time of a specific frame.
         """
 
-        return self._frames[frame]["frame"]["platform_time"]
+        platform_time = self._frames["platform_time"][frame]
+        return None if np.isnan(platform_time) else float(platform_time)
 
     ### Functions used to get info about the actors ###
     def get_ego_vehicle_id(self):
@@ -191,24 +276,36 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
             frame: (int): frame number of the simulation.
             attribute (str): name of the actor's attribute to be returned.
         """
-        frame_state = self._frames[frame - 1]["actors"]
+        if state not in ACTOR_STATES:
+            return None
+
+        table_name, _, to_state = ACTOR_STATES[state]
+        table = self._states[table_name]
+        row = table.row(actor_id, frame)
+        if row is None:
+            return None
 
-        # Check if the actor exists
-        if actor_id in frame_state:
+        return to_state(table, row)
 
-            # Check if the state exists
-            if state not in frame_state[actor_id]:
-                return None
+    def _get_actor_rows(self, actor_id, state, first_frame=None, last_frame=None):
+        """
+        Returns the state table and the slice of its rows of an actor during a frame interval.
+        """
+        if first_frame is None:
+            first_frame = 1
+        if last_frame is None:
+            last_frame = self.get_total_frame_count()
 
-            state_info = frame_state[actor_id][state]
-            return state_info
+        table_name, _, _ = ACTOR_STATES[state]
+        table = self._states[table_name]
 
-        return None
+        return table, table.actor_rows(actor_id, first_frame, last_frame)
 
     def _get_all_actor_states(self, actor_id, state, first_frame=None, last_frame=None):
         """
-        Given an actor id, returns a list of the specific variable of that actor during
-        a frame interval. Some elements might be None.
+        Given an actor id, returns an array with the specific variable of that actor during
+        a frame interval, with one row per frame the variable was recorded at. It is a view of
+        the log, so it must not be modified.
 
         By default, first_frame and last_frame are the start and end of the simulation, respectively.
 
@@ -218,37 +315,32 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
             first_frame (int): First frame checked. By default, 0.
             last_frame (int): Last frame checked. By default, max number of frames.
         """
-        if first_frame is None:
-            first_frame = 1
-        if last_frame is None:
-            last_frame = self.get_total_frame_count()
-
-        state_list = []
+        table, rows = self._get_actor_rows(actor_id, state, first_frame, last_frame)
+        return table.data[ACTOR_STATES[state][1]][rows]
 
-        for frame_number in range(first_frame, last_frame + 1):
-            state_info = self._get_actor_state(actor_id, state, frame_number)
-            state_list.append(state_info)
-
-        return state_list
+    def get_actor_state_frames(self, actor_id, state, first_frame=None, last_frame=None):
+        """
+        Returns an array with the frame numbers of the rows returned by the get_all_* functions
+        for the same actor, state (e.g. "transform", "velocity") and frame interval.
+        """
+        table, rows = self._get_actor_rows(actor_id, state, first_frame, last_frame)
+        return table.frame[rows]
 
     def _get_states_at_frame(self, frame, state, actor_list=None):
         """
-        Returns a dict where the keys are the frame number, and the values are the
-        carla.Transform of the actor at the given frame.
+        Returns a dict where the keys are the actor ids, and the values are the
+        state of the actor at the given frame.
 
         By default, all actors will be considered.
         """
         states = {}
-        actor_info = self._frames[frame]["actors"]
+        table_name, _, to_state = ACTOR_STATES[state]
+        table = self._states[table_name]
 
-        for actor_id in actor_info:
-            if not actor_list:
-                _state = self._get_actor_state(actor_id, state, frame)
-                if _state:
-                    states.update({actor_id: _state})
-            elif actor_id in actor_list:
-                _state = self._get_actor_state(actor_id, state, frame)
-                states.update({actor_id: _state})
+        for row in table.frame_rows(frame):
+            actor_id = int(table.actor_id[row])
+            if not actor_list or actor_id in actor_list:
+                states.update({actor_id: to_state(table, row)})
 
         return states
 
@@ -261,7 +353,7 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
 
     def get_all_actor_transforms(self, actor_id, first_frame=None, last_frame=None):
         """
-        Returns a list with all the transforms of the actor at the frame interval.
+        Returns an array [N, 6] with all the transforms (x, y, z, pitch, yaw, roll) of the actor at the frame interval.
         """
         return self._get_all_actor_states(actor_id, "transform", first_frame, last_frame)
 
@@ -281,7 +373,7 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
 
     def get_all_actor_velocities(self, actor_id, first_frame=None, last_frame=None):
         """
-        Returns a list with all the velocities of the actor at the frame interval.
+        Returns an array [N, 3] with all the velocities of the actor at the frame interval.
         """
         return self._get_all_actor_states(actor_id, "velocity", first_frame, last_frame)
 
@@ -301,7 +393,7 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
 
     def get_all_actor_angular_velocities(self, actor_id, first_frame=None, last_frame=None):
         """
-        Returns a list with all the angular velocities of the actor at the frame interval.
+        Returns an array [N, 3] with all the angular velocities of the actor at the frame interval.
         """
         return self._get_all_actor_states(actor_id, "angular_velocity", first_frame, last_frame)
 
@@ -321,7 +413,7 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
 
     def get_all_actor_accelerations(self, actor_id, first_frame=None, last_frame=None):
         """
-        Returns a list with all the accelerations of the actor at the frame interval.
+        Returns an array [N, 3] with all the accelerations of the actor at the frame interval.
         """
         return self._get_all_actor_states(actor_id, "acceleration", first_frame, last_frame)
 
@@ -339,19 +431,18 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
         """
         return self._get_actor_state(vehicle_id, "control", frame)
 
+    def get_all_vehicle_controls(self, vehicle_id, first_frame=None, last_frame=None):
+        """
+        Returns an array [N, 3] with all the controls (throttle, steer, brake) of the vehicle at the frame interval.
+        """
+        return self._get_all_actor_states(vehicle_id, "control", first_frame, last_frame)
+
     def get_vehicle_physics_control(self, vehicle_id, frame):
         """
         Returns the carla.VehiclePhysicsControl of a vehicle at a given frame.
         Returns None if the id can't be found.
         """
-
-        for i in range(frame - 1, -1, -1):  # Go backwards from the frame until 0
-            physics_info = self._frames[i]["events"]["physics_control"]
-
-            if vehicle_id in physics_info:
-                return physics_info[vehicle_id]
-
-        return None
+        return self._events["physics_control"].latest(vehicle_id, frame)
 
     def get_walker_speed(self, walker_id, frame):
         """
@@ -383,14 +474,9 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
         Returns the state time of the traffic light at a specific frame.
         Returns None if the id can't be found.
         """
-
-        for i in range(frame - 1, -1, -1):  # Go backwards from the frame until 0
-            state_times_info = self._frames[i]["events"]["traffic_light_state_time"]
-
-            if traffic_light_id in state_times_info:
-                states = state_times_info[traffic_light_id]
-                if state in states:
-                    return state_times_info[traffic_light_id][state]
+        states = self._events["traffic_light_state_time"].latest(traffic_light_id, frame)
+        if states is not None and state in states:
+            return states[state]
 
         return None
 
@@ -418,11 +504,4 @@ class MetricsLog(object):  # pylint: disable=too-many-public-methods
         Returns the state of the scene light at a specific frame.
         Returns None if the id can't be found.
         """
-
-        for i in range(frame - 1, -1, -1):  # Go backwards from the frame until 0
-            scene_lights_info = self._frames[i]["events"]["scene_lights"]
-
-            if light_id in scene_lights_info:
-                return scene_lights_info[light_id]
-
-        return None
+        return self._events["scene_lights"].latest(light_id, frame)
@@ -26,6 +26,7 @@ import carla
 from srunner.scenariomanager.carla_data_provider import CarlaDataProvider
 from srunner.scenariomanager.timer import GameTime
 from srunner.scenariomanager.traffic_events import TrafficEvent, TrafficEventType
+from srunner.scenariomanager.trigger_volumes import TriggerVolumes, location_distances
 
 
 class Criterion(py_trees.behaviour.Behaviour):
@@ -1486,6 +1487,8 @@ class InRouteTest(Criterion):
         self._world = CarlaDataProvider.get_world()
         self._waypoints, _ = zip(*self._route)
         self._route_length = len(self._route)
+        # Route locations as an array, the closest waypoint of the window is found with a single vectorized query
+        self._route_xy = np.array([[wp.x, wp.y] for wp in self._waypoints])
         self._current_index = 0
         self._out_route_distance = 0
         self._in_safe_route = True
@@ -1501,6 +1504,7 @@ class InRouteTest(Criterion):
 
             self._accum_meters.append(d + accum)
             prev_wp = wp
+        self._accum_meters = np.array(self._accum_meters)
 
         # Blackboard variable
         blackv = py_trees.blackboard.Blackboard()
@@ -1523,19 +1527,15 @@ class InRouteTest(Criterion):
 
             off_route = True
 
-            shortest_distance = float('inf')
-            closest_index = -1
+            # Get the closest distance, on ties the furthest waypoint along the route is used
+            window_end = min(self._current_index + self.WINDOWS_SIZE + 1, self._route_length)
+            offset = self._route_xy[self._current_index:window_end] - (location.x, location.y)
+            distances = np.sqrt(offset[:, 0] ** 2 + offset[:, 1] ** 2)
+            distances[np.isnan(distances)] = float('inf')
+            closest_index = window_end - 1 - int(np.argmin(distances[::-1]))
+            shortest_distance = float(distances[closest_index - self._current_index])
 
-            # Get the closest distance
-            for index in range(self._current_index,
-                               min(self._current_index + self.WINDOWS_SIZE + 1, self._route_length)):
-                ref_waypoint = self._waypoints[index]
-                distance = math.sqrt(((location.x - ref_waypoint.x) ** 2) + ((location.y - ref_waypoint.y) ** 2))
-                if distance <= shortest_distance:
-                    closest_index = index
-                    shortest_distance = distance
-
-            if closest_index == -1 or shortest_distance == float('inf'):
+            if shortest_distance == float('inf'):
                 return new_status
 
             # Check if the actor is out of route
@@ -1612,6 +1612,15 @@ class RouteCompletionTest(Criterion):
         self._waypoints, _ = zip(*self._route)
         self.target = self._waypoints[-1]
 
+        # The map is static, so the forward vectors of the route waypoints are looked up once instead of every tick.
+        # carla.Location is single precision, the locations are kept in float32 so the offsets to the actor are the same.
+        self._route_locations = np.array([[wp.x, wp.y, wp.z] for wp in self._waypoints], dtype=np.float32)
+        self._route_forward = []
+        for ref_waypoint in self._waypoints:
+            wp_dir = self._map.get_waypoint(ref_waypoint).transform.get_forward_vector()
+            self._route_forward.append([wp_dir.x, wp_dir.y, wp_dir.z])
+        self._route_forward = np.array(self._route_forward)
+
         self._accum_meters = []
         prev_wp = self._waypoints[0]
         for i, wp in enumerate(self._waypoints):
@@ -1623,6 +1632,7 @@ class RouteCompletionTest(Criterion):
 
             self._accum_meters.append(d + accum)
             prev_wp = wp
+        self._accum_meters = np.array(self._accum_meters)
 
         self._traffic_event = TrafficEvent(event_type=TrafficEventType.ROUTE_COMPLETION)
         self.list_traffic_events.append(self._traffic_event)
@@ -1643,24 +1653,24 @@ class RouteCompletionTest(Criterion):
 
         elif self.test_status == "RUNNING" or self.test_status == "INIT":
 
-            for index in range(self._current_index, min(self._current_index + self._wsize + 1, self._route_length)):
-                # Get the dot product to know if it has passed this location
-                ref_waypoint = self._waypoints[index]
-                wp = self._map.get_waypoint(ref_waypoint)
-                wp_dir = wp.transform.get_forward_vector()          # Waypoint's forward vector
-                wp_veh = location - ref_waypoint                    # vector waypoint - vehicle
-                dot_ve_wp = wp_veh.x * wp_dir.x + wp_veh.y * wp_dir.y + wp_veh.z * wp_dir.z
-
-                if dot_ve_wp > 0:
-                    # good! segment completed!
-                    self._current_index = index
-                    self._percentage_route_completed = 100.0 * float(self._accum_meters[self._current_index]) \
-                        / float(self._accum_meters[-1])
-                    self._traffic_event.set_dict({
-                        'route_completed': self._percentage_route_completed})
-                    self._traffic_event.set_message(
-                        "Agent has completed > {:.2f}% of the route".format(
-                            self._percentage_route_completed))
+            # Get the dot product to know if it has passed the locations of the window
+            window_end = min(self._current_index + self._wsize + 1, self._route_length)
+            wp_dir = self._route_forward[self._current_index:window_end]     # Waypoint's forward vector
+            wp_veh = (np.array([location.x, location.y, location.z], dtype=np.float32)
+                      - self._route_locations[self._current_index:window_end]).astype(np.float64)  # vector waypoint - vehicle
+            dot_ve_wp = wp_veh[:, 0] * wp_dir[:, 0] + wp_veh[:, 1] * wp_dir[:, 1] + wp_veh[:, 2] * wp_dir[:, 2]
+
+            passed = np.flatnonzero(dot_ve_wp > 0)
+            if len(passed) > 0:
+                # good! segment completed!
+                self._current_index = self._current_index + int(passed[-1])
+                self._percentage_route_completed = 100.0 * float(self._accum_meters[self._current_index]) \
+                    / float(self._accum_meters[-1])
+                self._traffic_event.set_dict({
+                    'route_completed': self._percentage_route_completed})
+                self._traffic_event.set_message(
+                    "Agent has completed > {:.2f}% of the route".format(
+                        self._percentage_route_completed))
 
             if self._percentage_route_completed > 99.0 and location.distance(self.target) < self.DISTANCE_THRESHOLD:
                 route_completion_event = TrafficEvent(event_type=TrafficEventType.ROUTE_COMPLETED)
@@ -1698,6 +1708,9 @@ class RunningRedLightTest(Criterion):
     """
     DISTANCE_LIGHT = 15  # m
 
+    # Stop lines of the traffic lights of the current episode, they are shared by all instances of the criterion
+    _stop_lines_cache = {}
+
     def __init__(self, actor, name="RunningRedLightTest", terminate_on_failure=False):
         """
         Init
@@ -1707,16 +1720,18 @@ class RunningRedLightTest(Criterion):
         self._actor = actor
         self._world = actor.get_world()
         self._map = CarlaDataProvider.get_map()
-        self._list_traffic_lights = []
         self._last_red_light_id = None
         self.actual_value = 0
         self.debug = False
 
-        all_actors = self._world.get_actors()
-        for _actor in all_actors:
-            if 'traffic_light' in _actor.type_id:
-                center, waypoints = self.get_traffic_light_waypoints(_actor)
-                self._list_traffic_lights.append((_actor, center, waypoints))
+        self._traffic_lights = TriggerVolumes.get(self._world, '*traffic_light*')
+        if self._world.id not in self._stop_lines_cache:
+            self._stop_lines_cache.clear()
+            self._stop_lines_cache[self._world.id] = [self.get_traffic_light_stop_lines(_actor)
+                                                      for _actor in self._traffic_lights.actors]
+        self._stop_lines = self._stop_lines_cache[self._world.id]
+        self._list_traffic_lights = [(_actor, stop_lines['center'], stop_lines['waypoints'])
+                                     for _actor, stop_lines in zip(self._traffic_lights.actors, self._stop_lines)]
 
     # pylint: disable=no-self-use
     def is_vehicle_crossing_line(self, seg1, seg2):
@@ -1748,9 +1763,8 @@ class RunningRedLightTest(Criterion):
         tail_far_pt = self.rotate_point(carla.Vector3D(-veh_extent - 1, 0.0, location.z), transform.rotation.yaw)
         tail_far_pt = location + carla.Location(tail_far_pt)
 
-        for traffic_light, center, waypoints in self._list_traffic_lights:
-
-            if self.debug:
+        if self.debug:
+            for traffic_light, center, waypoints in self._list_traffic_lights:
                 z = 2.1
                 if traffic_light.state == carla.TrafficLightState.Red:
                     color = carla.Color(155, 0, 0)
@@ -1766,58 +1780,56 @@ class RunningRedLightTest(Criterion):
                     self._world.debug.draw_point(
                         wp.transform.location + carla.Location(z=z), size=0.1, color=color, life_time=0.01)
 
-            center_loc = carla.Location(center)
+        # Only the lights close to the actor can affect it, they are selected with one query over all lights
+        distances = location_distances(location, self._traffic_lights.centers)
+        tail_wp = None
+        for index in np.flatnonzero(~(distances > self.DISTANCE_LIGHT)):
+            traffic_light = self._traffic_lights.actors[index]
+            stop_lines = self._stop_lines[index]
 
             if self._last_red_light_id and self._last_red_light_id == traffic_light.id:
                 continue
-            if center_loc.distance(location) > self.DISTANCE_LIGHT:
-                continue
             if traffic_light.state != carla.TrafficLightState.Red:
                 continue
+            if not stop_lines['waypoints']:
+                continue
 
-            for wp in waypoints:
-
+            if tail_wp is None:
                 tail_wp = self._map.get_waypoint(tail_far_pt)
-
-                # Calculate the dot product (Might be unscaled, as only its sign is important)
                 ve_dir = CarlaDataProvider.get_transform(self._actor).get_forward_vector()
-                wp_dir = wp.transform.get_forward_vector()
-                dot_ve_wp = ve_dir.x * wp_dir.x + ve_dir.y * wp_dir.y + ve_dir.z * wp_dir.z
-
-                # Check the lane until all the "tail" has passed
-                if tail_wp.road_id == wp.road_id and tail_wp.lane_id == wp.lane_id and dot_ve_wp > 0:
-                    # This light is red and is affecting our lane
-                    yaw_wp = wp.transform.rotation.yaw
-                    lane_width = wp.lane_width
-                    location_wp = wp.transform.location
-
-                    lft_lane_wp = self.rotate_point(carla.Vector3D(0.4 * lane_width, 0.0, location_wp.z), yaw_wp + 90)
-                    lft_lane_wp = location_wp + carla.Location(lft_lane_wp)
-                    rgt_lane_wp = self.rotate_point(carla.Vector3D(0.4 * lane_width, 0.0, location_wp.z), yaw_wp - 90)
-                    rgt_lane_wp = location_wp + carla.Location(rgt_lane_wp)
-
-                    # Is the vehicle traversing the stop line?
-                    if self.is_vehicle_crossing_line((tail_close_pt, tail_far_pt), (lft_lane_wp, rgt_lane_wp)):
-
-                        self.test_status = "FAILURE"
-                        self.actual_value += 1
-                        location = traffic_light.get_transform().location
-                        red_light_event = TrafficEvent(event_type=TrafficEventType.TRAFFIC_LIGHT_INFRACTION)
-                        red_light_event.set_message(
-                            "Agent ran a red light {} at (x={}, y={}, z={})".format(
-                                traffic_light.id,
-                                round(location.x, 3),
-                                round(location.y, 3),
-                                round(location.z, 3)))
-                        red_light_event.set_dict({
-                            'id': traffic_light.id,
-                            'x': location.x,
-                            'y': location.y,
-                            'z': location.z})
-
-                        self.list_traffic_events.append(red_light_event)
-                        self._last_red_light_id = traffic_light.id
-                        break
+
+            # Calculate the dot product (Might be unscaled, as only its sign is important)
+            wp_dir = stop_lines['directions']
+            dot_ve_wp = ve_dir.x * wp_dir[:, 0] + ve_dir.y * wp_dir[:, 1] + ve_dir.z * wp_dir[:, 2]
+
+            # Check the lane until all the "tail" has passed
+            affected = (stop_lines['road_ids'] == tail_wp.road_id) & (stop_lines['lane_ids'] == tail_wp.lane_id) & (dot_ve_wp > 0)
+            for wp_index in np.flatnonzero(affected):
+                # This light is red and is affecting our lane
+                lft_lane_wp, rgt_lane_wp = stop_lines['lines'][wp_index]
+
+                # Is the vehicle traversing the stop line?
+                if self.is_vehicle_crossing_line((tail_close_pt, tail_far_pt), (lft_lane_wp, rgt_lane_wp)):
+
+                    self.test_status = "FAILURE"
+                    self.actual_value += 1
+                    location = traffic_light.get_transform().location
+                    red_light_event = TrafficEvent(event_type=TrafficEventType.TRAFFIC_LIGHT_INFRACTION)
+                    red_light_event.set_message(
+                        "Agent ran a red light {} at (x={}, y={}, z={})".format(
+                            traffic_light.id,
+                            round(location.x, 3),
+                            round(location.y, 3),
+                            round(location.z, 3)))
+                    red_light_event.set_dict({
+                        'id': traffic_light.id,
+                        'x': location.x,
+                        'y': location.y,
+                        'z': location.z})
+
+                    self.list_traffic_events.append(red_light_event)
+                    self._last_red_light_id = traffic_light.id
+                    break
 
         if self._terminate_on_failure and (self.test_status == "FAILURE"):
             new_status = py_trees.common.Status.FAILURE
@@ -1873,6 +1885,34 @@ class RunningRedLightTest(Criterion):
 
         return area_loc, wps
 
+    def get_traffic_light_stop_lines(self, traffic_light):
+        """
+        get the waypoints of a given traffic light with their lanes, directions and stop lines as arrays
+        """
+        center, waypoints = self.get_traffic_light_waypoints(traffic_light)
+
+        lines = []
+        for wp in waypoints:
+            yaw_wp = wp.transform.rotation.yaw
+            lane_width = wp.lane_width
+            location_wp = wp.transform.location
+
+            lft_lane_wp = self.rotate_point(carla.Vector3D(0.4 * lane_width, 0.0, location_wp.z), yaw_wp + 90)
+            lft_lane_wp = location_wp + carla.Location(lft_lane_wp)
+            rgt_lane_wp = self.rotate_point(carla.Vector3D(0.4 * lane_width, 0.0, location_wp.z), yaw_wp - 90)
+            rgt_lane_wp = location_wp + carla.Location(rgt_lane_wp)
+            lines.append((lft_lane_wp, rgt_lane_wp))
+
+        directions = [wp.transform.get_forward_vector() for wp in waypoints]
+        return {
+            'center': center,
+            'waypoints': waypoints,
+            'road_ids': np.array([wp.road_id for wp in waypoints], dtype=np.int64),
+            'lane_ids': np.array([wp.lane_id for wp in waypoints], dtype=np.int64),
+            'directions': np.array([[v.x, v.y, v.z] for v in directions], dtype=np.float64).reshape(-1, 3),
+            'lines': lines,
+        }
+
 
 class RunningStopTest(Criterion):
 
@@ -1895,16 +1935,13 @@ class RunningStopTest(Criterion):
         self._actor = actor
         self._world = CarlaDataProvider.get_world()
         self._map = CarlaDataProvider.get_map()
-        self._list_stop_signs = []
         self._target_stop_sign = None
         self._stop_completed = False
         self._affected_by_stop = False
         self.actual_value = 0
 
-        all_actors = self._world.get_actors()
-        for _actor in all_actors:
-            if 'traffic.stop' in _actor.type_id:
-                self._list_stop_signs.append(_actor)
+        self._stop_signs = TriggerVolumes.get(self._world, '*traffic.stop*')
+        self._list_stop_signs = self._stop_signs.actors
 
     @staticmethod
     def point_inside_boundingbox(point, bb_center, bb_extent):
@@ -1932,19 +1969,49 @@ class RunningStopTest(Criterion):
 
         return am_ab > 0 and am_ab < ab_ab and am_ad > 0 and am_ad < ad_ad
 
+    @staticmethod
+    def points_inside_boundingboxes(points, bb_centers, bb_extents):
+        """
+        point_inside_boundingbox for all pairs of points [L, 2] and boxes (bb_centers [N, 3], bb_extents [N, 3]).
+        Returns a boolean array [L, N]. The corners are single precision, like the carla.Vector2D of the scalar version.
+        """
+        # pylint: disable=invalid-name
+        centers = bb_centers[:, :2].astype(np.float64)
+        extents = bb_extents[:, :2].astype(np.float64)
+        A = np.stack([centers[:, 0] - extents[:, 0], centers[:, 1] - extents[:, 1]], axis=1).astype(np.float32)
+        B = np.stack([centers[:, 0] + extents[:, 0], centers[:, 1] - extents[:, 1]], axis=1).astype(np.float32)
+        D = np.stack([centers[:, 0] - extents[:, 0], centers[:, 1] + extents[:, 1]], axis=1).astype(np.float32)
+        M = points.astype(np.float32)
+
+        AB = (B - A).astype(np.float64)
+        AD = (D - A).astype(np.float64)
+        AM = (M[:, np.newaxis] - A[np.newaxis]).astype(np.float64)
+        am_ab = AM[..., 0] * AB[:, 0] + AM[..., 1] * AB[:, 1]
+        ab_ab = AB[:, 0] * AB[:, 0] + AB[:, 1] * AB[:, 1]
+        am_ad = AM[..., 0] * AD[:, 0] + AM[..., 1] * AD[:, 1]
+        ad_ad = AD[:, 0] * AD[:, 0] + AD[:, 1] * AD[:, 1]
+
+        return (am_ab > 0) & (am_ab < ab_ab) & (am_ad > 0) & (am_ad < ad_ad)
+
     def is_actor_affected_by_stop(self, actor, stop, multi_step=20):
         """
         Check if the given actor is affected by the stop
         """
-        affected = False
+        index = self._stop_signs.index(stop.id)
+        if index is None:
+            return False
+        return len(self.get_affected_stops(actor, np.array([index]), multi_step)) > 0
+
+    def get_affected_stops(self, actor, indices, multi_step=20):
+        """
+        Returns the indices (rows of the stop sign volumes) of the stops that affect the given actor
+        """
         # first we run a fast coarse test
         current_location = actor.get_location()
-        stop_location = stop.get_transform().location
-        if stop_location.distance(current_location) > self.PROXIMITY_THRESHOLD:
-            return affected
-
-        stop_t = stop.get_transform()
-        transformed_tv = stop_t.transform(stop.trigger_volume.location)
+        distances = location_distances(current_location, self._stop_signs.locations[indices])
+        indices = indices[~(distances > self.PROXIMITY_THRESHOLD)]
+        if len(indices) == 0:
+            return indices
 
         # slower and accurate test based on waypoint's horizon and geometric test
         list_locations = [current_location]
@@ -1959,11 +2026,9 @@ class RunningStopTest(Criterion):
                     break
                 list_locations.append(waypoint.transform.location)
 
-        for actor_location in list_locations:
-            if self.point_inside_boundingbox(actor_location, transformed_tv, stop.trigger_volume.extent):
-                affected = True
-
-        return affected
+        points = np.array([[actor_location.x, actor_location.y] for actor_location in list_locations])
+        inside = self.points_inside_boundingboxes(points, self._stop_signs.centers[indices], self._stop_signs.extents[indices])
+        return indices[np.any(inside, axis=0)]
 
     def _scan_for_stop_sign(self):
         target_stop_sign = None
@@ -1977,11 +2042,10 @@ class RunningStopTest(Criterion):
         dot_ve_wp = ve_dir.x * wp_dir.x + ve_dir.y * wp_dir.y + ve_dir.z * wp_dir.z
 
         if dot_ve_wp > 0:  # Ignore all when going in a wrong lane
-            for stop_sign in self._list_stop_signs:
-                if self.is_actor_affected_by_stop(self._actor, stop_sign):
-                    # this stop sign is affecting the vehicle
-                    target_stop_sign = stop_sign
-                    break
+            affected = self.get_affected_stops(self._actor, np.arange(len(self._list_stop_signs)))
+            if len(affected) > 0:
+                # this stop sign is affecting the vehicle
+                target_stop_sign = self._list_stop_signs[affected[0]]
 
         return target_stop_sign
 
@@ -73,5 +73,89 @@ def save_dict(endpoint, data):
         else:
             _ = requests.patch(url=endpoint, headers={'content-type':'application/json'}, data=json.dumps(data, indent=4, sort_keys=True))
     else:
-        with open(endpoint, 'w') as fd:
+        # Write a temporary file that replaces the checkpoint, so a crash never leaves a truncated checkpoint
+        tmp_endpoint = endpoint + '.tmp'
+        with open(tmp_endpoint, 'w') as fd:
             json.dump(data, fd, indent=4, sort_keys=True)
+        os.replace(tmp_endpoint, endpoint)
+
+
+def is_remote(endpoint):
+    return endpoint.startswith(('http:', 'https:', 'ftp:'))
+
+
+def record_log_path(endpoint):
+    """
+    Path of the append-only route record log of a local checkpoint: one JSON route record per line. A record of a
+    route index replaces the records of that index in earlier lines and in the checkpoint.
+    """
+    return endpoint + '.records.jsonl'
+
+
+def append_record(endpoint, record):
+    with open(record_log_path(endpoint), 'ab+') as fd:
+        # A run that crashed while writing leaves a partial last line, cut it off so the record starts on its own line
+        end = fd.seek(0, os.SEEK_END)
+        if end > 0:
+            fd.seek(end - 1)
+            if fd.read(1) != b'\n':
+                fd.seek(0)
+                fd.truncate(fd.read().rfind(b'\n') + 1)
+        fd.write((json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def fetch_records(endpoint, data=None):
+    """
+    Returns the route records of a checkpoint sorted by index: the records stored in the checkpoint itself,
+    replaced or extended by the ones in its record log.
+    """
+    if data is None:
+        data = fetch_dict(endpoint)
+
+    records = {}
+    if data and '_checkpoint' in data:
+        for record in data['_checkpoint'].get('records', []):
+            records[record['index']] = record
+
+    if not is_remote(endpoint) and os.path.exists(record_log_path(endpoint)):
+        with open(record_log_path(endpoint)) as fd:
+            for line in fd:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of a log that was interrupted while writing
+                    continue
+                records[record['index']] = record
+
+    return [records[index] for index in sorted(records)]
+
+
+def write_record_log(endpoint, records):
+    """
+    Replaces the record log of a checkpoint with the given records
+    """
+    tmp_path = record_log_path(endpoint) + '.tmp'
+    with open(tmp_path, 'w') as fd:
+        for record in records:
+            fd.write(json.dumps(record, sort_keys=True) + '\n')
+    os.replace(tmp_path, record_log_path(endpoint))
+
+
+def compact_records(endpoint):
+    """
+    Moves the records of the record log into the checkpoint (the legacy format, where all records are stored in
+    '_checkpoint.records') and removes the log. Returns the checkpoint data.
+    """
+    data = fetch_dict(endpoint)
+    if not data:
+        data = create_default_json_msg()
+    if is_remote(endpoint) or not os.path.exists(record_log_path(endpoint)):
+        return data
+
+    data['_checkpoint']['records'] = fetch_records(endpoint, data)
+    save_dict(endpoint, data)
+    os.remove(record_log_path(endpoint))
+
+    return data
@@ -11,8 +11,29 @@ Support class of the MetricsManager to parse the information of
 the CARLA recorder into a readable dictionary
 """
 
+import io
+import array
+import bisect
+
+import numpy as np
+
 import carla
 
+STR_TO_VLIGHT = {
+    "None": carla.VehicleLightState.NONE,
+    "Position": carla.VehicleLightState.Position,
+    "LowBeam": carla.VehicleLightState.LowBeam,
+    "HighBeam": carla.VehicleLightState.HighBeam,
+    "Brake": carla.VehicleLightState.Brake,
+    "RightBlinker": carla.VehicleLightState.RightBlinker,
+    "LeftBlinker": carla.VehicleLightState.LeftBlinker,
+    "Reverse": carla.VehicleLightState.Reverse,
+    "Fog": carla.VehicleLightState.Fog,
+    "Interior": carla.VehicleLightState.Interior,
+    "Special1": carla.VehicleLightState.Special1,
+    "Special2": carla.VehicleLightState.Special2,
+}
+
 
 def parse_actor(info):
     """
@@ -36,131 +57,88 @@ def parse_actor(info):
 
 def parse_transform(info):
     """
-    Parses a list into a carla.Transform
+    Parses a list into the (x, y, z, pitch, yaw, roll) values of a carla.Transform
 
     Args:
         info (list): list corresponding to a row of the recorder
     """
-    transform = carla.Transform(
-        carla.Location(
-            float(info[3][1:-1]) / 100,
-            float(info[4][:-1]) / 100,
-            float(info[5][:-1]) / 100,
-        ),
-        carla.Rotation(
-            float(info[8][:-1]),   # pitch
-            float(info[9][:-1]),   # yaw
-            float(info[7][1:-1])   # roll
-        )
+    return (
+        float(info[3][1:-1]) / 100,
+        float(info[4][:-1]) / 100,
+        float(info[5][:-1]) / 100,
+        float(info[8][:-1]),   # pitch
+        float(info[9][:-1]),   # yaw
+        float(info[7][1:-1])   # roll
     )
 
-    return transform
-
 
 def parse_control(info):
     """
-    Parses a list into a carla.VehicleControl
+    Parses a list into the (throttle, steer, brake) values, the hand brake and the gear of a carla.VehicleControl
 
     Args:
         info (list): list corresponding to a row of the recorder
     """
-    control = carla.VehicleControl(
+    control = (
         float(info[5]),         # throttle
         float(info[3]),         # steer
         float(info[7]),         # brake
-        bool(int(info[9])),     # hand_brake
-        int(info[11]) < 0,      # reverse
-        False,                  # manual_gear_shift
-        int(info[11]),          # gear
     )
 
-    return control
+    return control, int(info[9]), int(info[11])
 
 
 def parse_vehicle_lights(info):
     """
-    Parses a list into a carla.VehicleLightState
+    Parses a list into the bit mask of a carla.VehicleLightState
 
     Args:
         info (list): list corresponding to a row of the recorder
     """
-    srt_to_vlight = {
-        "None": carla.VehicleLightState.NONE,
-        "Position": carla.VehicleLightState.Position,
-        "LowBeam": carla.VehicleLightState.LowBeam,
-        "HighBeam": carla.VehicleLightState.HighBeam,
-        "Brake": carla.VehicleLightState.Brake,
-        "RightBlinker": carla.VehicleLightState.RightBlinker,
-        "LeftBlinker": carla.VehicleLightState.LeftBlinker,
-        "Reverse": carla.VehicleLightState.Reverse,
-        "Fog": carla.VehicleLightState.Fog,
-        "Interior": carla.VehicleLightState.Interior,
-        "Special1": carla.VehicleLightState.Special1,
-        "Special2": carla.VehicleLightState.Special2,
-    }
-
-    lights = []
+    lights = 0
     for i in range(2, len(info)):
-        lights.append(srt_to_vlight[info[i]])
+        lights |= int(STR_TO_VLIGHT[info[i]])
 
     return lights
 
 
 def parse_traffic_light(info):
     """
-    Parses a list into a dictionary with all the traffic light's information
+    Parses a list into the state (as numbered by carla.TrafficLightState), frozen flag and elapsed time of a traffic light
 
     Args:
         info (list): list corresponding to a row of the recorder
     """
-    number_to_state = {
-        "0": carla.TrafficLightState.Red,
-        "1": carla.TrafficLightState.Yellow,
-        "2": carla.TrafficLightState.Green,
-        "3": carla.TrafficLightState.Off,
-        "4": carla.TrafficLightState.Unknown,
-    }
-
-    traffic_light = {
-        "state": number_to_state[info[3]],
-        "frozen": bool(int(info[5])),
-        "elapsed_time": float(info[7]),
-    }
-
-    return traffic_light
+    return int(info[3]), int(info[5]), float(info[7])
 
 
 def parse_velocity(info):
     """
-    Parses a list into a carla.Vector3D with the velocity
+    Parses a list into the (x, y, z) values of the velocity
 
     Args:
         info (list): list corresponding to a row of the recorder
     """
-    velocity = carla.Vector3D(
+    return (
         float(info[3][1:-1]),
         float(info[4][:-1]),
         float(info[5][:-1])
     )
 
-    return velocity
-
 
 def parse_angular_velocity(info):
     """
-    Parses a list into a carla.Vector3D with the angular velocity
+    Parses a list into the (x, y, z) values of the angular velocity
 
     Args:
         info (list): list corresponding to a row of the recorder
     """
-    velocity = carla.Vector3D(
+    return (
         float(info[7][1:-1]),
         float(info[8][:-1]),
         float(info[9][:-1])
     )
 
-    return velocity
-
 
 def parse_scene_lights(info):
     """
@@ -279,340 +257,393 @@ def parse_wheels_control(info):
     return gears_control
 
 
-class MetricsParser(object):
+class StateTable(object):
     """
-    Class used to parse the CARLA recorder into readable information
+    Columns of one kind of actor state, with one row per actor and frame the state was recorded at.
+    While parsing, the rows are appended to compact buffers. finalize() turns them into NumPy arrays sorted by
+    actor and frame, so all the states of an actor during a frame interval are a slice of the columns.
     """
 
-    def __init__(self, recorder_info):
-
-        self.recorder_info = recorder_info
-        self.frame_list = None
-        self.frame_row = None
-        self.i = 0
-
-    def get_row_elements(self, indent_num, split_string):
+    def __init__(self, **columns):
         """
-        returns a list with the elements of the row
+        Args:
+            columns: name=(typecode, width) of every column, the typecode is the one of the array module
         """
-        return self.frame_row[indent_num:].split(split_string)
-
-    def next_row(self):
+        self.columns = columns
+        self._frames = array.array('q')
+        self._actor_ids = array.array('q')
+        self._buffers = {name: array.array(typecode) for name, (typecode, _) in columns.items()}
+
+        self.frame = None
+        self.actor_id = None
+        self.data = {}
+        self._actors = None
+        self._actor_starts = None
+        self._actor_ends = None
+        self._frame_order = None
+        self._sorted_frames = None
+
+    def append(self, frame, actor_id, *values):
         """
-        Gets the next row of the recorder
+        Adds a row, values are given in the order of the columns. Columns with a width > 1 take a sequence.
         """
-        self.i += 1
-        self.frame_row = self.frame_list[self.i]
-
-    def parse_recorder_info(self):
+        self._frames.append(frame)
+        self._actor_ids.append(actor_id)
+        for (name, (_, width)), value in zip(self.columns.items(), values):
+            if width == 1:
+                self._buffers[name].append(value)
+            else:
+                self._buffers[name].extend(value)
+
+    def finalize(self):
+        frame = np.frombuffer(self._frames, dtype=np.int64)
+        actor_id = np.frombuffer(self._actor_ids, dtype=np.int64)
+        order = np.lexsort((frame, actor_id))
+
+        self.frame = frame[order]
+        self.actor_id = actor_id[order]
+        for name, (typecode, width) in self.columns.items():
+            column = np.frombuffer(self._buffers[name], dtype=typecode)
+            if width > 1:
+                column = column.reshape(-1, width)
+            self.data[name] = column[order]
+        self._frames = self._actor_ids = self._buffers = None
+
+        self._actors, self._actor_starts = np.unique(self.actor_id, return_index=True)
+        self._actor_ends = np.append(self._actor_starts[1:], len(self.actor_id))
+        # Frame major order of the rows, for the queries of all the actors at a frame
+        self._frame_order = np.argsort(self.frame, kind='stable')
+        self._sorted_frames = self.frame[self._frame_order]
+
+    def actor_rows(self, actor_id, first_frame=None, last_frame=None):
         """
-        Parses the recorder into readable information.
-
-        Args:
-            recorder_info (str): string given by the recorder
+        Returns the slice of the rows of an actor between first_frame and last_frame (both included),
+        by default all of them
         """
+        index = np.searchsorted(self._actors, actor_id)
+        if index == len(self._actors) or self._actors[index] != actor_id:
+            return slice(0, 0)
+
+        start, end = self._actor_starts[index], self._actor_ends[index]
+        if first_frame is None and last_frame is None:
+            return slice(int(start), int(end))
+        frames = self.frame[start:end]
+        first_frame = frames[0] if first_frame is None else first_frame
+        last_frame = frames[-1] if last_frame is None else last_frame
+        first = start + np.searchsorted(frames, first_frame, side='left')
+        last = start + np.searchsorted(frames, last_frame, side='right')
+        return slice(int(first), int(max(first, last)))
+
+    def row(self, actor_id, frame):
+        """
+        Returns the row of an actor at a frame, None if the state was not recorded
+        """
+        rows = self.actor_rows(actor_id, frame, frame)
+        if rows.stop == rows.start:
+            return None
+        return rows.start
 
-        # Divide it into frames
-        recorder_list = self.recorder_info.split("Frame")
-
-        # Get general information
-        header = recorder_list[0].split("\n")
-        sim_map = header[1][5:]
-        sim_date = header[2][6:]
-
-        annex = recorder_list[-1].split("\n")
-        sim_frames = int(annex[0][3:])
-        sim_duration = float(annex[1][10:-8])
-
-        recorder_list = recorder_list[1:-1]
-
-        simulation_info = {
-            "map": sim_map,
-            "date:": sim_date,
-            "total_frames": sim_frames,
-            "duration": sim_duration
-        }
-
-        actors_info = {}
-        frames_info = []
-
-        for frame in recorder_list:
-
-            # Divide the frame in lines
-            self.frame_list = frame.split("\n")
-
-            # Get the general frame information
-            frame_info = self.frame_list[0].split(" ")
-            frame_number = int(frame_info[1])
-            frame_time = float(frame_info[3])
-
-            try:
-                prev_frame = frames_info[frame_number - 2]
-                prev_time = prev_frame["frame"]["elapsed_time"]
-                delta_time = round(frame_time - prev_time, 6)
-            except IndexError:
-                delta_time = 0
-
-            # Variable to store all the information about the frame
-            frame_state = {
-                "frame": {
-                    "elapsed_time": frame_time,
-                    "delta_time": delta_time,
-                    "platform_time": None
-                },
-                "actors": {},
-                "events":{
-                    "scene_lights": {},
-                    "physics_control": {},
-                    "traffic_light_state_time": {},
-                    "collisions": {}
-                }
-            }
-
-            # Loop through all the other rows.
-            self.i = 0
-            self.next_row()
-
-            while self.frame_row.startswith(' Create') or self.frame_row.startswith('  '):
-
-                if self.frame_row.startswith(' Create'):
-                    elements = self.get_row_elements(1, " ")
-                    actor_id = int(elements[1][:-1])
-
-                    actor = parse_actor(elements)
-                    actors_info.update({actor_id: actor})
-                    actors_info[actor_id].update({"created": frame_number})
-                else:
-                    elements = self.get_row_elements(2, " = ")
-                    actors_info[actor_id].update({elements[0]: elements[1]})
-
-                self.next_row()
-
-            while self.frame_row.startswith(' Destroy'):
-
-                elements = self.get_row_elements(1, " ")
-
-                actor_id = int(elements[1])
-                actors_info[actor_id].update({"destroyed": frame_number})
-
-                self.next_row()
-
-            while self.frame_row.startswith(' Collision'):
-
-                elements = self.get_row_elements(1, " ")
-
-                actor_id = int(elements[4])
-                other_id = int(elements[-1])
-
-                if actor_id not in frame_state["events"]["collisions"]:
-                    frame_state["events"]["collisions"][actor_id] = [other_id]
-                else:
-                    collisions = frame_state["events"]["collisions"][actor_id]
-                    collisions.append(other_id)
-                    frame_state["events"]["collisions"].update({actor_id: collisions})
-
-                self.next_row()
-
-            while self.frame_row.startswith(' Parenting'):
-
-                elements = self.get_row_elements(1, " ")
-
-                actor_id = int(elements[1])
-                parent_id = int(elements[3])
-                actors_info[actor_id].update({"parent": parent_id})
-
-                self.next_row()
-
-            if self.frame_row.startswith(' Positions'):
-                self.next_row()
-
-                while self.frame_row.startswith('  '):
-
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
-
-                    transform = parse_transform(elements)
-                    frame_state["actors"].update({actor_id: {"transform": transform}})
-
-                    self.next_row()
-
-            if self.frame_row.startswith(' State traffic lights'):
-                self.next_row()
-
-                while self.frame_row.startswith('  '):
-
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
+    def frame_rows(self, frame):
+        """
+        Returns the rows of all the actors at a frame, sorted by actor id
+        """
+        first = np.searchsorted(self._sorted_frames, frame, side='left')
+        last = np.searchsorted(self._sorted_frames, frame, side='right')
+        return self._frame_order[first:last]
 
-                    traffic_light = parse_traffic_light(elements)
-                    frame_state["actors"].update({actor_id: traffic_light})
-                    self.next_row()
 
-            if self.frame_row.startswith(' Vehicle animations'):
-                self.next_row()
+class EventHistory(object):
+    """
+    Sparse events of an actor type (scene lights, physics controls, traffic light times) as a time ordered
+    list of (frame, value) per actor.
+    """
 
-                while self.frame_row.startswith('  '):
+    def __init__(self):
+        self._frames = {}
+        self._values = {}
 
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
+    def append(self, frame, actor_id, value):
+        self._frames.setdefault(actor_id, []).append(frame)
+        self._values.setdefault(actor_id, []).append(value)
 
-                    control = parse_control(elements)
-                    frame_state["actors"][actor_id].update({"control": control})
-                    self.next_row()
+    def latest(self, actor_id, frame):
+        """
+        Returns the last value of the actor that was recorded at or before frame, None if there is none
+        """
+        if actor_id not in self._frames:
+            return None
+        index = bisect.bisect_right(self._frames[actor_id], frame) - 1
+        if index < 0:
+            return None
+        return self._values[actor_id][index]
 
-            if self.frame_row.startswith(' Walker animations'):
-                self.next_row()
 
-                while self.frame_row.startswith('  '):
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
+class MetricsParser(object):
+    """
+    Class used to parse the CARLA recorder into readable information.
+    The recorder is read line by line, so it is never split into a list of lines or frames. The per frame
+    actor states are stored in StateTable columns instead of one dictionary per frame and actor.
+    """
 
-                    frame_state["actors"][actor_id].update({"speed": elements[3]})
-                    self.next_row()
+    def __init__(self, recorder_info):
+        """
+        Args:
+            recorder_info (str or iterable): string given by the recorder, or any iterable over its lines
+                (e.g. an open text file with a dump of the recorder)
+        """
+        self.recorder_info = recorder_info
 
-            if self.frame_row.startswith(' Vehicle light animations'):
-                self.next_row()
+    def _lines(self):
+        lines = self.recorder_info
+        if isinstance(lines, str):
+            lines = io.StringIO(lines)
+        for line in lines:
+            yield line.rstrip('\r\n')
 
-                while self.frame_row.startswith('  '):
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
+    def parse_recorder_info(self):
+        """
+        Parses the recorder into readable information.
 
-                    lights = parse_vehicle_lights(elements)
-                    frame_state["actors"][actor_id].update({"lights": lights})
-                    self.next_row()
+        Returns:
+            simulation_info (dict): map, date, total frames and duration of the simulation
+            actors_info (dict): static information of every actor, indexed by its id
+            frames_info (dict):
+                - "elapsed_time", "delta_time", "platform_time": arrays with one value per frame
+                  (the platform time is NaN if it was not recorded)
+                - "states": StateTable per kind of state ("positions", "traffic_lights", "vehicle_animations",
+                  "walker_animations", "vehicle_lights", "dynamic_actors")
+                - "events": StateTable of the collisions and EventHistory of the "scene_lights",
+                  "physics_control" and "traffic_light_state_time"
+        """
+        simulation_info = {
+            "map": None,
+            "date:": None,
+            "total_frames": None,
+            "duration": None
+        }
+        actors_info = {}
 
-            if self.frame_row.startswith(' Scene light changes'):
-                self.next_row()
+        states = {
+            "positions": StateTable(transform=('f', 6)),
+            "traffic_lights": StateTable(state=('b', 1), frozen=('b', 1), elapsed_time=('d', 1)),
+            "vehicle_animations": StateTable(control=('f', 3), hand_brake=('b', 1), gear=('b', 1)),
+            "walker_animations": StateTable(speed=('d', 1)),
+            "vehicle_lights": StateTable(lights=('q', 1)),
+            "dynamic_actors": StateTable(velocity=('f', 3), angular_velocity=('f', 3)),
+        }
+        events = {
+            "collisions": StateTable(other_id=('q', 1)),
+            "scene_lights": EventHistory(),
+            "physics_control": EventHistory(),
+            "traffic_light_state_time": EventHistory(),
+        }
+        elapsed_times = array.array('d')
+        delta_times = array.array('d')
+        platform_times = array.array('d')
+
+        # Row handlers of the sections whose rows are the actor states
+        state_sections = {
+            ' Positions': lambda elements: states["positions"].append(
+                frame_number, int(elements[1]), parse_transform(elements)),
+            ' State traffic lights': lambda elements: states["traffic_lights"].append(
+                frame_number, int(elements[1]), *parse_traffic_light(elements)),
+            ' Vehicle animations': lambda elements: states["vehicle_animations"].append(
+                frame_number, int(elements[1]), *parse_control(elements)),
+            ' Walker animations': lambda elements: states["walker_animations"].append(
+                frame_number, int(elements[1]), float(elements[3])),
+            ' Vehicle light animations': lambda elements: states["vehicle_lights"].append(
+                frame_number, int(elements[1]), parse_vehicle_lights(elements)),
+            ' Dynamic actors': lambda elements: states["dynamic_actors"].append(
+                frame_number, int(elements[1]), parse_velocity(elements), parse_angular_velocity(elements)),
+            ' Scene light changes': lambda elements: events["scene_lights"].append(
+                frame_number, int(elements[1]), parse_scene_lights(elements)),
+            ' Traffic Light time events': lambda elements: events["traffic_light_state_time"].append(
+                frame_number, int(elements[1]), parse_state_times(elements)),
+        }
+        actor_sections = {
+            ' Actor bounding boxes': "bounding_box",
+            ' Actor trigger volumes': "trigger_volume",
+        }
 
-                while self.frame_row.startswith('  '):
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
+        header_rows = 0
+        frame_number = None
+        section = None
+        actor_id = None
+        physics = None
 
-                    scene_light = parse_scene_lights(elements)
-                    frame_state["events"]["scene_lights"].update({actor_id: scene_light})
-                    self.next_row()
+        for row in self._lines():
 
-            if self.frame_row.startswith(' Dynamic actors'):
-                self.next_row()
+            # Rows of the current section
+            if row.startswith('  ') and section is not None:
 
-                while self.frame_row.startswith('  '):
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
+                if section == ' Create':
+                    elements = row[2:].split(" = ")
+                    actors_info[actor_id].update({elements[0]: elements[1]})
 
-                    velocity = parse_velocity(elements)
-                    frame_state["actors"][actor_id].update({"velocity": velocity})
+                elif section in state_sections:
+                    state_sections[section](row[2:].split(" "))
 
-                    angular_v = parse_angular_velocity(elements)
-                    frame_state["actors"][actor_id].update({"angular_velocity": angular_v})
+                elif section in actor_sections:
+                    elements = row[2:].split(" ")
+                    actors_info[int(elements[1])].update({actor_sections[section]: parse_bounding_box(elements)})
 
-                    if delta_time == 0:
-                        acceleration = carla.Vector3D(0, 0, 0)
+                elif section == ' Physics Control':
+                    if not row.startswith('   '):
+                        self._add_physics_control(events, frame_number, physics)
+                        physics = (int(row[2:].split(" ")[1]), carla.VehiclePhysicsControl(), [], [])
                     else:
-                        prev_velocity = frame_state["actors"][actor_id]["velocity"]
-                        acceleration = (velocity - prev_velocity) / delta_time
-
-                    frame_state["actors"][actor_id].update({"acceleration": acceleration})
-                    self.next_row()
-
-            if self.frame_row.startswith(' Actor bounding boxes'):
-                self.next_row()
-
-                while self.frame_row.startswith('  '):
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
-
-                    bbox = parse_bounding_box(elements)
-                    actors_info[actor_id].update({"bounding_box": bbox})
-                    self.next_row()
-
-            if self.frame_row.startswith(' Actor trigger volumes'):
-                self.next_row()
-
-                while self.frame_row.startswith('  '):
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
-
-                    trigvol = parse_bounding_box(elements)
-                    actors_info[actor_id].update({"trigger_volume": trigvol})
-                    self.next_row()
-
-            if self.frame_row.startswith(' Current platform time'):
-
-                elements = self.get_row_elements(1, " ")
-
-                platform_time = float(elements[-1])
-                frame_state["frame"]["platform_time"] = platform_time
-                self.next_row()
-
-            if self.frame_row.startswith(' Physics Control'):
-                self.next_row()
-
-                actor_id = None
-                while self.frame_row.startswith('  '):
-
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
-                    physics_control = carla.VehiclePhysicsControl()
-                    self.next_row()
-
-                    forward_gears = []
-                    wheels = []
-                    while self.frame_row.startswith('   '):
-
-                        if self.frame_row.startswith('    '):
-                            elements = self.get_row_elements(4, " ")
-                            if elements[0] == "gear":
-                                forward_gears.append(parse_gears_control(elements))
-                            elif elements[0] == "wheel":
-                                wheels.append(parse_wheels_control(elements))
-
-                        else:
-                            elements = self.get_row_elements(3, " = ")
-                            name = elements[0]
-
-                            if name == "center_of_mass":
-                                values = elements[1].split(" ")
-                                value = carla.Vector3D(
-                                    float(values[0][1:-1]),
-                                    float(values[1][:-1]),
-                                    float(values[2][:-1]),
-                                )
-                                setattr(physics_control, name, value)
-                            elif name == "torque_curve" or name == "steering_curve":
-                                values = elements[1].split(" ")
-                                value = parse_vector_list(values)
-                                setattr(physics_control, name, value)
-
-                            elif name == "use_gear_auto_box":
-                                name = "use_gear_autobox"
-                                value = True if elements[1] == "true" else False
-                                setattr(physics_control, name, value)
-
-                            elif "forward_gears" in name or "wheels" in name:
-                                pass
-
-                            else:
-                                name = name.lower()
-                                value = float(elements[1])
-                                setattr(physics_control, name, value)
-
-                        self.next_row()
-
-                    setattr(physics_control, "forward_gears", forward_gears)
-                    setattr(physics_control, "wheels", wheels)
-                    frame_state["events"]["physics_control"].update({actor_id: physics_control})
+                        self._parse_physics_control_row(row, physics)
+                continue
+
+            if physics is not None:
+                self._add_physics_control(events, frame_number, physics)
+                physics = None
+            section = None
+
+            if row.startswith('Frames:'):
+                simulation_info["total_frames"] = int(row[8:])
+
+            elif row.startswith('Duration:'):
+                simulation_info["duration"] = float(row[10:-8])
+
+            elif row.startswith('Frame '):
+                # Get the general frame information
+                frame_info = row.split(" ")
+                frame_number = int(frame_info[1])
+                frame_time = float(frame_info[3])
+
+                delta_time = round(frame_time - elapsed_times[-1], 6) if elapsed_times else 0
+                elapsed_times.append(frame_time)
+                delta_times.append(delta_time)
+                platform_times.append(float('nan'))
+
+            elif frame_number is None:
+                # Get general information
+                if header_rows == 1:
+                    simulation_info["map"] = row[5:]
+                elif header_rows == 2:
+                    simulation_info["date:"] = row[6:]
+                header_rows += 1
+
+            elif row.startswith(' Create'):
+                elements = row[1:].split(" ")
+                actor_id = int(elements[1][:-1])
+
+                actor = parse_actor(elements)
+                actors_info.update({actor_id: actor})
+                actors_info[actor_id].update({"created": frame_number})
+                section = ' Create'
+
+            elif row.startswith(' Destroy'):
+                elements = row[1:].split(" ")
+                actors_info[int(elements[1])].update({"destroyed": frame_number})
+
+            elif row.startswith(' Collision'):
+                elements = row[1:].split(" ")
+                events["collisions"].append(frame_number, int(elements[4]), int(elements[-1]))
+
+            elif row.startswith(' Parenting'):
+                elements = row[1:].split(" ")
+                actors_info[int(elements[1])].update({"parent": int(elements[3])})
+
+            elif row.startswith(' Current platform time'):
+                elements = row[1:].split(" ")
+                platform_times[-1] = float(elements[-1])
+
+            else:
+                for name in list(state_sections) + list(actor_sections) + [' Physics Control']:
+                    if row.startswith(name):
+                        section = name
+                        break
+
+        if physics is not None:
+            self._add_physics_control(events, frame_number, physics)
+
+        for table in states.values():
+            table.finalize()
+        events["collisions"].finalize()
+
+        delta_times = np.frombuffer(delta_times, dtype=np.float64)
+        self._add_accelerations(states["dynamic_actors"], delta_times)
+
+        frames_info = {
+            "elapsed_time": np.frombuffer(elapsed_times, dtype=np.float64),
+            "delta_time": delta_times,
+            "platform_time": np.frombuffer(platform_times, dtype=np.float64),
+            "states": states,
+            "events": events,
+        }
 
-            if self.frame_row.startswith(' Traffic Light time events'):
-                self.next_row()
+        return simulation_info, actors_info, frames_info
 
-                while self.frame_row.startswith('  '):
-                    elements = self.get_row_elements(2, " ")
-                    actor_id = int(elements[1])
+    @staticmethod
+    def _add_accelerations(table, delta_times):
+        """
+        Adds the acceleration column to the dynamic actors: the difference to the velocity of the previous frame
+        divided by the delta time of the frame, zero if there is no previous velocity or the delta time is zero.
+        """
+        velocity = table.data["velocity"]
+        acceleration = np.zeros_like(velocity)
 
-                    state_times = parse_state_times(elements)
-                    frame_state["events"]["traffic_light_state_time"].update({actor_id: state_times})
-                    self.next_row()
+        # Rows are sorted by actor and frame, so the previous frame of an actor is the previous row
+        has_previous = (table.actor_id[1:] == table.actor_id[:-1]) & (table.frame[1:] == table.frame[:-1] + 1)
+        delta_time = delta_times[table.frame[1:] - 1].astype(np.float32)
+        valid = has_previous & (delta_time != 0)
+        difference = velocity[1:][valid] - velocity[:-1][valid]
+        acceleration[1:][valid] = difference / delta_time[valid][:, np.newaxis]
 
-            frames_info.append(frame_state)
+        table.columns["acceleration"] = ('f', 3)
+        table.data["acceleration"] = acceleration
 
-        return simulation_info, actors_info, frames_info
+    @staticmethod
+    def _parse_physics_control_row(row, physics):
+        """
+        Parses a row of the physics control of an actor into physics (actor id, control, forward gears, wheels)
+        """
+        _, physics_control, forward_gears, wheels = physics
+
+        if row.startswith('    '):
+            elements = row[4:].split(" ")
+            if elements[0] == "gear":
+                forward_gears.append(parse_gears_control(elements))
+            elif elements[0] == "wheel":
+                wheels.append(parse_wheels_control(elements))
+            return
+
+        elements = row[3:].split(" = ")
+        name = elements[0]
+
+        if name == "center_of_mass":
+            values = elements[1].split(" ")
+            value = carla.Vector3D(
+                float(values[0][1:-1]),
+                float(values[1][:-1]),
+                float(values[2][:-1]),
+            )
+            setattr(physics_control, name, value)
+        elif name == "torque_curve" or name == "steering_curve":
+            values = elements[1].split(" ")
+            value = parse_vector_list(values)
+            setattr(physics_control, name, value)
+
+        elif name == "use_gear_auto_box":
+            name = "use_gear_autobox"
+            value = True if elements[1] == "true" else False
+            setattr(physics_control, name, value)
+
+        elif "forward_gears" in name or "wheels" in name:
+            pass
+
+        else:
+            name = name.lower()
+            value = float(elements[1])
+            setattr(physics_control, name, value)
+
+    @staticmethod
+    def _add_physics_control(events, frame_number, physics):
+        if physics is None:
+            return
+        actor_id, physics_control, forward_gears, wheels = physics
+        setattr(physics_control, "forward_gears", forward_gears)
+        setattr(physics_control, "wheels", wheels)
+        events["physics_control"].append(frame_number, actor_id, physics_control)
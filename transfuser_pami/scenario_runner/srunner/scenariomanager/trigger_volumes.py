@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# This work is licensed under the terms of the MIT license.
+# For a copy, see <https://opensource.org/licenses/MIT>.
+
+"""
+This module provides a cache of the trigger volumes of the static traffic actors (traffic lights, stop signs).
+
+The trigger volumes never move during an episode, so they are read from the simulator once and stored as arrays.
+All of them can then be tested against the ego vehicle with a few array operations, instead of rebuilding
+carla.BoundingBox objects and running the geometric tests actor by actor on every tick.
+The tests replicate the single precision arithmetic of the carla types, so they give the same results as the
+per actor versions.
+"""
+
+import numpy as np
+
+import carla
+
+
+def box_arrays(bounding_box):
+    """
+    Returns the center [3], extent [3] and axes [3, 3] (forward, right and up vector) of a carla.BoundingBox
+    """
+    rotation = bounding_box.rotation
+    axes = [rotation.get_forward_vector(), rotation.get_right_vector(), rotation.get_up_vector()]
+    center = np.array([bounding_box.location.x, bounding_box.location.y, bounding_box.location.z], dtype=np.float32)
+    extent = np.array([bounding_box.extent.x, bounding_box.extent.y, bounding_box.extent.z], dtype=np.float32)
+    axes = np.array([[axis.x, axis.y, axis.z] for axis in axes], dtype=np.float32)
+    return center, extent, axes
+
+
+def location_distances(location, locations):
+    """
+    carla.Location.distance between a location and an array of locations [N, 3]
+    """
+    offset = locations - np.array([location.x, location.y, location.z], dtype=np.float32)
+    return np.sqrt(offset[:, 0] * offset[:, 0] + offset[:, 1] * offset[:, 1] + offset[:, 2] * offset[:, 2])
+
+
+def _dot(vectors, planes):
+    return vectors[..., 0] * planes[..., 0] + vectors[..., 1] * planes[..., 1] + vectors[..., 2] * planes[..., 2]
+
+
+def obb_intersection(bounding_box, centers, extents, axes):
+    """
+    Separating axis test of one oriented bounding box against N boxes given as arrays
+    (centers [N, 3], extents [N, 3], axes [N, 3, 3]). Returns a boolean array [N].
+    """
+    center, extent, box_axes = box_arrays(bounding_box)
+    num_boxes = len(centers)
+
+    relative_position = (centers - center).astype(np.float64)
+    half_axes = (box_axes * extent[:, np.newaxis]).astype(np.float64)
+    other_half_axes = (axes * extents[:, :, np.newaxis]).astype(np.float64)
+
+    # Candidate planes: the axes of both boxes and the cross products of all pairs of them
+    box_axes = box_axes.astype(np.float64)
+    other_axes = axes.astype(np.float64)
+    cross = np.cross(box_axes[np.newaxis, :, np.newaxis, :], other_axes[:, np.newaxis, :, :])
+    cross = cross.reshape(num_boxes, 9, 3).astype(np.float32).astype(np.float64)
+    planes = np.concatenate([np.broadcast_to(box_axes, (num_boxes, 3, 3)), other_axes, cross], axis=1)
+
+    projection = np.abs(_dot(half_axes[0], planes))
+    projection = projection + np.abs(_dot(half_axes[1], planes))
+    projection = projection + np.abs(_dot(half_axes[2], planes))
+    for i in range(3):
+        projection = projection + np.abs(_dot(other_half_axes[:, np.newaxis, i], planes))
+
+    separated = np.abs(_dot(relative_position[:, np.newaxis], planes)) > projection
+    return ~np.any(separated, axis=1)
+
+
+class TriggerVolumes(object):
+
+    """
+    Trigger volumes of all the actors of a world that match a type filter, e.g. '*traffic_light*' or '*stop*'.
+    The rows of the arrays follow the order of self.actors:
+    - locations: [N, 3] locations of the actors
+    - centers: [N, 3] world locations of the trigger volume centers
+    - extents: [N, 3] half sizes of the trigger volumes
+    - axes: [N, 3, 3] forward, right and up vector of the trigger volumes
+    - boxes: the trigger volumes as carla.BoundingBox in world coordinates
+    """
+
+    _cache = {}
+
+    def __init__(self, world, type_filter):
+        self.actors = list(world.get_actors().filter(type_filter))
+        self.boxes = []
+        locations = []
+        for actor in self.actors:
+            transform = actor.get_transform()
+            volume = actor.trigger_volume
+            center = transform.transform(volume.location)
+            bounding_box = carla.BoundingBox(carla.Location(center.x, center.y, center.z),
+                                             carla.Vector3D(volume.extent.x, volume.extent.y, volume.extent.z))
+            bounding_box.rotation = carla.Rotation(pitch=volume.rotation.pitch + transform.rotation.pitch,
+                                                   yaw=volume.rotation.yaw + transform.rotation.yaw,
+                                                   roll=volume.rotation.roll + transform.rotation.roll)
+            self.boxes.append(bounding_box)
+            locations.append([transform.location.x, transform.location.y, transform.location.z])
+
+        box_data = [box_arrays(bounding_box) for bounding_box in self.boxes]
+        self.ids = np.array([actor.id for actor in self.actors], dtype=np.int64)
+        self.locations = np.array(locations, dtype=np.float32).reshape(-1, 3)
+        self.centers = np.array([data[0] for data in box_data], dtype=np.float32).reshape(-1, 3)
+        self.extents = np.array([data[1] for data in box_data], dtype=np.float32).reshape(-1, 3)
+        self.axes = np.array([data[2] for data in box_data], dtype=np.float32).reshape(-1, 3, 3)
+
+    @classmethod
+    def get(cls, world, type_filter):
+        """
+        Returns the trigger volumes of the current episode of world, they are only read from the simulator once
+        """
+        key = (world.id, type_filter)
+        if key not in cls._cache:
+            # The actors of older episodes do not exist anymore
+            for old_key in [old_key for old_key in cls._cache if old_key[0] != world.id]:
+                del cls._cache[old_key]
+            cls._cache[key] = cls(world, type_filter)
+        return cls._cache[key]
+
+    def index(self, actor_id):
+        """
+        Row of the actor with the given id, None if it is unknown
+        """
+        rows = np.flatnonzero(self.ids == actor_id)
+        return int(rows[0]) if len(rows) > 0 else None
+
+    def nearby(self, location, radius):
+        """
+        Rows of the trigger volumes whose center is closer than radius to location, in actor order
+        """
+        return np.flatnonzero(location_distances(location, self.centers) < radius)
+
+    def intersects(self, bounding_box, rows):
+        """
+        Boolean array that tells which of the trigger volumes in rows intersect the bounding box
+        """
+        return obb_intersection(bounding_box, self.centers[rows], self.extents[rows], self.axes[rows])
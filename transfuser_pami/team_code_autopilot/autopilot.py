@@ -11,6 +11,7 @@ import numpy as np
 import carla
 
 from srunner.scenariomanager.carla_data_provider import CarlaDataProvider
+from srunner.scenariomanager.trigger_volumes import TriggerVolumes
 from leaderboard.autoagents import autonomous_agent, autonomous_agent_local
 from nav_planner import PIDController, RoutePlanner, interpolate_trajectory
 
@@ -340,6 +341,9 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
                 'ego_matrix': self._vehicle.get_transform().get_matrix()
                 }
 
+        self.save_measurements(frame, data)
+
+    def save_measurements(self, frame, data):
         measurements_file = self.save_path / 'measurements' / ('%04d.json' % frame)
         with open(measurements_file, 'w') as f:
             json.dump(data, f, indent=4)
@@ -469,14 +473,18 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
         if light_hazard is None:
             light_hazard = False
             self._active_traffic_light = None
-            _traffic_lights = self.get_nearby_object(vehicle_location, actors.filter('*traffic_light*'), self.light_radius)
+            # The trigger boxes are static, they are cached per episode and tested all at once
+            traffic_light_volumes = TriggerVolumes.get(self._world, '*traffic_light*')
+            nearby_lights = traffic_light_volumes.nearby(vehicle_location, self.light_radius)
             
             center_light_detector_bb = vehicle_transform.transform(carla.Location(x=self.center_bb_light_x, y=self.center_bb_light_y, z=self.center_bb_light_z))
             extent_light_detector_bb = carla.Vector3D(x=self.extent_bb_light_x, y=self.extent_bb_light_y, z=self.extent_bb_light_z)
             light_detector_bb = carla.BoundingBox(center_light_detector_bb, extent_light_detector_bb)
             light_detector_bb.rotation = vehicle_transform.rotation
+            lights_intersecting = traffic_light_volumes.intersects(light_detector_bb, nearby_lights)
             color2 = carla.Color(255, 255, 255, 255)
-            for light in _traffic_lights:
+            for light_index, intersects in zip(nearby_lights, lights_intersecting):
+                light = traffic_light_volumes.actors[light_index]
                 if   (light.state == carla.libcarla.TrafficLightState.Red):
                     color = carla.Color(255, 0, 0, 255)
                 elif (light.state == carla.libcarla.TrafficLightState.Yellow):
@@ -490,20 +498,11 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
 
                 size = 0.1 # size of the points and bounding boxes used for visualization
                 # box in which we will look for traffic light triggers.            
-                center_bounding_box = light.get_transform().transform(light.trigger_volume.location)
-                center_bounding_box = carla.Location(center_bounding_box.x, center_bounding_box.y, center_bounding_box.z)
-                length_bounding_box = carla.Vector3D(light.trigger_volume.extent.x, light.trigger_volume.extent.y, light.trigger_volume.extent.z)
-                transform = carla.Transform(center_bounding_box) # can only create a bounding box from a transform.location, not from a location
-                bounding_box = carla.BoundingBox(transform.location, length_bounding_box)
-
-                gloabl_rot = light.get_transform().rotation
-                bounding_box.rotation = carla.Rotation(pitch = light.trigger_volume.rotation.pitch + gloabl_rot.pitch,
-                                                    yaw   = light.trigger_volume.rotation.yaw   + gloabl_rot.yaw,
-                                                    roll  = light.trigger_volume.rotation.roll  + gloabl_rot.roll)
+                bounding_box = traffic_light_volumes.boxes[light_index]
                 if (self.visualize == 1):
                     self._world.debug.draw_box(box=bounding_box, rotation= bounding_box.rotation, thickness=0.1, color=color, life_time=(1.0/self.frame_rate_sim))
 
-                if(self.check_obb_intersection(light_detector_bb, bounding_box) == True):
+                if(intersects == True):
                     if ((light.state == carla.libcarla.TrafficLightState.Red)
                         or (light.state == carla.libcarla.TrafficLightState.Yellow)):
                         self._active_traffic_light = light
@@ -519,25 +518,21 @@ class AutoPilot(autonomous_agent_local.AutonomousAgent):
         if stop_sign_hazard is None:
             stop_sign_hazard = False
             if not self.ignore_stop_signs:
-                stop_signs     = self.get_nearby_object(vehicle_location, actors.filter('*stop*'), self.light_radius)
+                stop_sign_volumes = TriggerVolumes.get(self._world, '*stop*')
+                nearby_stop_signs = stop_sign_volumes.nearby(vehicle_location, self.light_radius)
+                stop_signs     = [stop_sign_volumes.actors[index] for index in nearby_stop_signs]
                 center_vehicle_stop_sign_detector_bb   = vehicle_transform.transform(self._vehicle.bounding_box.location)
                 extent_vehicle_stop_sign_detector_bb   = self._vehicle.bounding_box.extent
                 vehicle_stop_sign_detector_bb          = carla.BoundingBox(center_vehicle_stop_sign_detector_bb, extent_vehicle_stop_sign_detector_bb)
                 vehicle_stop_sign_detector_bb.rotation = vehicle_transform.rotation
+                stop_signs_intersecting = stop_sign_volumes.intersects(vehicle_stop_sign_detector_bb, nearby_stop_signs)
                 
-                for stop_sign in stop_signs:
-                    center_bb_stop_sign    = stop_sign.get_transform().transform(stop_sign.trigger_volume.location)            
-                    length_bb_stop_sign    = carla.Vector3D(stop_sign.trigger_volume.extent.x, stop_sign.trigger_volume.extent.y, stop_sign.trigger_volume.extent.z)
-                    transform_stop_sign    = carla.Transform(center_bb_stop_sign)
-                    bounding_box_stop_sign = carla.BoundingBox(transform_stop_sign.location, length_bb_stop_sign)
-                    rotation_stop_sign     = stop_sign.get_transform().rotation
-                    bounding_box_stop_sign.rotation = carla.Rotation(pitch=stop_sign.trigger_volume.rotation.pitch + rotation_stop_sign.pitch, 
-                                                                    yaw  =stop_sign.trigger_volume.rotation.yaw   + rotation_stop_sign.yaw,
-                                                                    roll =stop_sign.trigger_volume.rotation.roll  + rotation_stop_sign.roll)
+                for stop_sign_index, stop_sign, intersects in zip(nearby_stop_signs, stop_signs, stop_signs_intersecting):
+                    bounding_box_stop_sign = stop_sign_volumes.boxes[stop_sign_index]
 
                     color = carla.Color(0, 255, 0, 255)
 
-                    if (self.check_obb_intersection(vehicle_stop_sign_detector_bb, bounding_box_stop_sign) == True):
+                    if (intersects == True):
                         if(not (stop_sign.id in self.cleared_stop_signs)):
                             if((speed * 3.6) > 0.0): #Conversion from m/s to km/h
                                 stop_sign_hazard = True
@@ -0,0 +1,124 @@
+"""
+Converts the LiDAR frames of existing datasets into the compact format (see utils/lidar_format.py).
+Loose routes are converted in place (lidar/*.npy), route shards are rewritten with compact lidar members.
+Frames that are already compact are skipped, so the tool can be run again on a partially converted dataset.
+
+Usage: python compact_lidar.py --root /path/to/dataset --workers 16
+"""
+
+import io
+import os
+import argparse
+import tarfile
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+from utils.frame_shards import ShardWriter, SHARD_FILE
+from utils.lidar_format import encode_lidar, is_compact
+
+
+def find_routes(root):
+    """
+    Returns all route directories below root, either with a lidar folder or with a shard.
+    """
+    routes = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if SHARD_FILE in filenames or ('lidar' in dirnames and 'measurements' in dirnames):
+            routes.append(dirpath)
+            dirnames[:] = [] # Do not descend into the sensor folders
+    return sorted(routes)
+
+
+def compact_bytes(data):
+    """
+    Returns the compact encoding of a LiDAR .npy file, or None if it is already compact.
+    """
+    array = np.load(io.BytesIO(data), allow_pickle=True)
+    if is_compact(array):
+        return None
+    if array.dtype == object: # (frame, points) of the sensor interface
+        array = array[1]
+    compact = io.BytesIO()
+    np.save(compact, encode_lidar(array))
+    return compact.getvalue()
+
+
+def compact_loose(route_dir):
+    lidar_dir = os.path.join(route_dir, 'lidar')
+    num_frames = 0
+    for name in sorted(os.listdir(lidar_dir)):
+        filename = os.path.join(lidar_dir, name)
+        with open(filename, 'rb') as f:
+            data = compact_bytes(f.read())
+        if data is None:
+            continue
+        # Write to a temporary file first, so an interrupted run never leaves a truncated frame
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, filename)
+        num_frames += 1
+    return num_frames
+
+
+def compact_shard(shard_file):
+    num_frames = 0
+    tmp_file = shard_file + '.tmp'
+    writer = ShardWriter(tmp_file)
+    with tarfile.open(shard_file, 'r:') as tar:
+        frame, members = None, {}
+        for member in tar:
+            member_frame, kind = member.name.split('.')[:2]
+            member_frame = int(member_frame)
+            if frame is not None and member_frame != frame:
+                writer.write_frame(frame, members)
+                members = {}
+            frame = member_frame
+            data = tar.extractfile(member).read()
+            if kind == 'lidar':
+                compact = compact_bytes(data)
+                if compact is not None:
+                    data = compact
+                    num_frames += 1
+            members[kind] = data
+        if frame is not None:
+            writer.write_frame(frame, members)
+    writer.close()
+
+    if num_frames > 0:
+        os.replace(tmp_file, shard_file)
+    else:
+        os.remove(tmp_file)
+    return num_frames
+
+
+def compact_route(route_dir):
+    num_frames = 0
+    shard_file = os.path.join(route_dir, SHARD_FILE)
+    if os.path.isfile(shard_file):
+        num_frames += compact_shard(shard_file)
+    if os.path.isdir(os.path.join(route_dir, 'lidar')):
+        num_frames += compact_loose(route_dir)
+    return route_dir, num_frames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, required=True, help='Root directory of the dataset that should be converted.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of routes that are converted in parallel.')
+    args = parser.parse_args()
+
+    routes = find_routes(args.root)
+    print('Converting the LiDAR of %d routes' % len(routes))
+
+    num_frames = 0
+    with Pool(args.workers) as pool:
+        for _, frames in tqdm(pool.imap_unordered(compact_route, routes), total=len(routes)):
+            num_frames += frames
+    print('Converted %d frames' % num_frames)
+
+
+if __name__ == '__main__':
+    main()
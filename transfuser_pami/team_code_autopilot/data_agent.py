@@ -2,6 +2,8 @@ from copy import deepcopy
 import cv2
 import carla
 
+import os
+import io
 import random
 import torch
 import numpy as np
@@ -10,6 +12,8 @@ import json
 
 from utils import lts_rendering
 from utils.map_utils import MapImage, encode_npy_to_pil, PIXELS_PER_METER
+from utils.frame_shards import ShardWriter, SHARD_FILE
+from utils.lidar_format import encode_lidar
 from autopilot import AutoPilot
 
 
@@ -50,13 +54,23 @@ class DataAgent(AutoPilot):
 
         self.weathers_ids = list(self.weathers)
 
+        # SAVE_SHARDS=1 packs all frames of the route into one shard file instead of six files per frame
+        self.save_shards = int(os.environ.get('SAVE_SHARDS', 0))
+        self.shard_writer = None
+        self.pending_measurements = None
+        # COMPACT_LIDAR=0 writes the LiDAR in the original pickled (frame, points) format instead of utils/lidar_format.py
+        self.compact_lidar = int(os.environ.get('COMPACT_LIDAR', 1))
+
         if self.save_path is not None:
-            (self.save_path / 'topdown').mkdir()
-            (self.save_path / 'lidar').mkdir()
-            (self.save_path / 'rgb').mkdir()
-            (self.save_path / 'label_raw').mkdir()
-            (self.save_path / 'semantics').mkdir()
-            (self.save_path / 'depth').mkdir()
+            if self.save_shards:
+                self.shard_writer = ShardWriter(self.save_path / SHARD_FILE)
+            else:
+                (self.save_path / 'topdown').mkdir()
+                (self.save_path / 'lidar').mkdir()
+                (self.save_path / 'rgb').mkdir()
+                (self.save_path / 'label_raw').mkdir()
+                (self.save_path / 'semantics').mkdir()
+                (self.save_path / 'depth').mkdir()
 
         self._active_traffic_light = None
 
@@ -64,9 +78,10 @@ class DataAgent(AutoPilot):
         super()._init(hd_map)
         self._sensors = self.sensor_interface._sensors_objects
 
-        self.vehicle_template = torch.ones(1, 1, 22, 9, device='cuda')
-        self.walker_template = torch.ones(1, 1, 10, 7, device='cuda')
-        self.traffic_light_template = torch.ones(1, 1, 4, 4, device='cuda')
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.vehicle_template = torch.ones(1, 1, 22, 9, device=self.device)
+        self.walker_template = torch.ones(1, 1, 10, 7, device=self.device)
+        self.traffic_light_template = torch.ones(1, 1, 4, 4, device=self.device)
 
         # create map for renderer
         map_image = MapImage(self._world, self.world_map, PIXELS_PER_METER)
@@ -78,8 +93,8 @@ class DataAgent(AutoPilot):
         self.global_map[:, 0, ...] = road / 255.
         self.global_map[:, 1, ...] = lane / 255.
 
-        self.global_map = torch.tensor(self.global_map, device='cuda', dtype=torch.float32)
-        world_offset = torch.tensor(map_image._world_offset, device='cuda', dtype=torch.float32)
+        self.global_map = torch.tensor(self.global_map, device=self.device, dtype=torch.float32)
+        world_offset = torch.tensor(map_image._world_offset, device=self.device, dtype=torch.float32)
         self.map_dims = self.global_map.shape[2:4]
 
         self.renderer = lts_rendering.Renderer(world_offset, self.map_dims, data_generation=True)
@@ -240,9 +255,20 @@ class DataAgent(AutoPilot):
             for vehicle in vehicles:
                 vehicle.set_light_state(carla.VehicleLightState.NONE)
 
+    def save_measurements(self, frame, data):
+        if self.shard_writer is None:
+            super().save_measurements(frame, data)
+        else:
+            # The measurements are written together with the sensors of the same frame in save_sensors
+            self.pending_measurements = json.dumps(data, indent=4).encode('utf-8')
+
     def save_sensors(self, tick_data):
         frame = self.step // self.save_freq
 
+        if self.shard_writer is not None:
+            self.save_shard_frame(frame, tick_data)
+            return
+
         # CV2 uses BGR internally so we need to swap the image channels before saving.
         img = cv2.cvtColor(tick_data['rgb'],cv2.COLOR_RGB2BGR)
         cv2.imwrite(str(self.save_path / 'rgb' / ('%04d.png' % frame)), img)
@@ -257,21 +283,57 @@ class DataAgent(AutoPilot):
         depth = cv2.cvtColor(tick_data['depth'], cv2.COLOR_RGB2BGR)
         cv2.imwrite(str(self.save_path / 'depth' / ('%04d.png' % frame)), depth)
 
-        np.save(self.save_path / 'lidar' / ('%04d.npy' % frame), tick_data['lidar'], allow_pickle=True)
+        self.save_lidar(self.save_path / 'lidar' / ('%04d.npy' % frame), tick_data['lidar'])
         self.save_labels(self.save_path / 'label_raw' / ('%04d.json' % frame), tick_data['cars'])
         
+    def save_shard_frame(self, frame, tick_data):
+        # Encode every sensor exactly like the loose files of save_sensors, so both layouts decode the same way.
+        members = {}
+        if self.pending_measurements is not None:
+            members['measurements'] = self.pending_measurements
+            self.pending_measurements = None
+        members['label_raw'] = json.dumps(tick_data['cars'], indent=4).encode('utf-8')
+
+        img = cv2.cvtColor(tick_data['rgb'],cv2.COLOR_RGB2BGR)
+        members['rgb'] = cv2.imencode('.png', img)[1].tobytes()
+
+        img = encode_npy_to_pil(np.asarray(tick_data['topdown'].squeeze().cpu()))
+        members['topdown'] = cv2.imencode('.png', np.moveaxis(img,0,2))[1].tobytes()
+
+        members['semantics'] = cv2.imencode('.png', tick_data['semantics'])[1].tobytes()
+
+        depth = cv2.cvtColor(tick_data['depth'], cv2.COLOR_RGB2BGR)
+        members['depth'] = cv2.imencode('.png', depth)[1].tobytes()
+
+        lidar = io.BytesIO()
+        self.save_lidar(lidar, tick_data['lidar'])
+        members['lidar'] = lidar.getvalue()
+
+        self.shard_writer.write_frame(frame, members)
+
     def save_labels(self, filename, result):
         with open(filename, 'w') as f:
             json.dump(result, f, indent=4)
         return
 
+    def save_lidar(self, filename, lidar):
+        # lidar is the (frame, points) tuple of the sensor interface
+        if self.compact_lidar:
+            np.save(filename, encode_lidar(lidar[1]))
+        else:
+            np.save(filename, lidar, allow_pickle=True)
+
     def save_points(self, filename, points):
         points_to_save = deepcopy(points[1])
         points_to_save[:, 1] = -points_to_save[:, 1]
+        if self.compact_lidar:
+            points_to_save = encode_lidar(points_to_save)
         np.save(filename, points_to_save)
         return
     
     def destroy(self):
+        if self.shard_writer is not None:
+            self.shard_writer.close()
         del self.global_map
         del self.vehicle_template
         del self.walker_template
@@ -439,122 +501,86 @@ class DataAgent(AutoPilot):
 
     def render_BEV(self):
         semantic_grid = self.global_map
-        
-        vehicle_position = self._vehicle.get_location()
-        ego_pos_list =  [self._vehicle.get_transform().location.x, self._vehicle.get_transform().location.y]
-        ego_yaw_list =  [self._vehicle.get_transform().rotation.yaw/180*np.pi]
+
+        ego_transform = self._vehicle.get_transform()
+        ego_location = ego_transform.location
 
         # fetch local birdview per agent
-        ego_pos =  torch.tensor([self._vehicle.get_transform().location.x, self._vehicle.get_transform().location.y], device='cuda', dtype=torch.float32)
-        ego_yaw =  torch.tensor([self._vehicle.get_transform().rotation.yaw/180*np.pi], device='cuda', dtype=torch.float32)
+        ego_pos =  torch.tensor([ego_location.x, ego_location.y], device=self.device, dtype=torch.float32)
+        ego_yaw =  torch.tensor([ego_transform.rotation.yaw/180*np.pi], device=self.device, dtype=torch.float32)
         birdview = self.renderer.get_local_birdview(
             semantic_grid,
             ego_pos,
             ego_yaw
         )
 
+        # Poses, template sizes (rows, cols) in pixels and channels of all agents, they are rendered with one batched call
+        poses = []
+        sizes = []
+        channels = []
+
         self._actors = self._world.get_actors()
         vehicles = self._actors.filter('*vehicle*')
         for vehicle in vehicles:
-            if (vehicle.get_location().distance(self._vehicle.get_location()) < self.detection_radius):
-                if (vehicle.id != self._vehicle.id):
-                    pos =  torch.tensor([vehicle.get_transform().location.x, vehicle.get_transform().location.y], device='cuda', dtype=torch.float32)
-                    yaw =  torch.tensor([vehicle.get_transform().rotation.yaw/180*np.pi], device='cuda', dtype=torch.float32)
-                    veh_x_extent = int(max(vehicle.bounding_box.extent.x*2, 1) * PIXELS_PER_METER)
-                    veh_y_extent = int(max(vehicle.bounding_box.extent.y*2, 1) * PIXELS_PER_METER)
-
-                    self.vehicle_template = torch.ones(1, 1, veh_x_extent, veh_y_extent, device='cuda')
-                    self.renderer.render_agent_bv(
-                        birdview,
-                        ego_pos,
-                        ego_yaw,
-                        self.vehicle_template,
-                        pos,
-                        yaw,
-                        channel=5
-                    )
-
-        ego_pos_batched = []
-        ego_yaw_batched = []
-        pos_batched = []
-        yaw_batched = []
-        template_batched = []
-        channel_batched = []
+            if vehicle.id == self._vehicle.id:
+                continue
+            transform = vehicle.get_transform()
+            if transform.location.distance(ego_location) < self.detection_radius:
+                extent = vehicle.bounding_box.extent
+                poses.append([transform.location.x, transform.location.y, transform.rotation.yaw/180*np.pi])
+                sizes.append([int(max(extent.x*2, 1) * PIXELS_PER_METER), int(max(extent.y*2, 1) * PIXELS_PER_METER)])
+                channels.append(5)
 
         # -----------------------------------------------------------
         # Pedestrian rendering
         # -----------------------------------------------------------
         walkers = self._actors.filter('*walker*')
         for walker in walkers:
-            ego_pos_batched.append(ego_pos_list)
-            ego_yaw_batched.append(ego_yaw_list)
-            pos_batched.append([walker.get_transform().location.x, walker.get_transform().location.y])
-            yaw_batched.append([walker.get_transform().rotation.yaw/180*np.pi])
-            channel_batched.append(6)
-            template_batched.append(np.ones([20, 7]))
-
-        if len(ego_pos_batched)>0:
-            ego_pos_batched_torch = torch.tensor(ego_pos_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            ego_yaw_batched_torch = torch.tensor(ego_yaw_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            pos_batched_torch = torch.tensor(pos_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            yaw_batched_torch = torch.tensor(yaw_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            template_batched_torch = torch.tensor(template_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            channel_batched_torch = torch.tensor(channel_batched, device='cuda', dtype=torch.float32)
-
-            self.renderer.render_agent_bv_batched(
-                birdview,
-                ego_pos_batched_torch,
-                ego_yaw_batched_torch,
-                template_batched_torch,
-                pos_batched_torch,
-                yaw_batched_torch,
-                channel=channel_batched_torch,
-            )
-
-        ego_pos_batched = []
-        ego_yaw_batched = []
-        pos_batched = []
-        yaw_batched = []
-        template_batched = []
-        channel_batched = []
+            transform = walker.get_transform()
+            poses.append([transform.location.x, transform.location.y, transform.rotation.yaw/180*np.pi])
+            sizes.append([20, 7])
+            channels.append(6)
 
         # -----------------------------------------------------------
         # Traffic light rendering
         # -----------------------------------------------------------
+        light_channels = {'Green': 4, 'Yellow': 3, 'Red': 2}
         traffic_lights = self._actors.filter('*traffic_light*')
         for traffic_light in traffic_lights:
-            trigger_box_global_pos = traffic_light.get_transform().transform(traffic_light.trigger_volume.location)
+            # Lights in any other state (off, unknown) are not rendered
+            channel = light_channels.get(str(traffic_light.state))
+            if channel is None:
+                continue
+            transform = traffic_light.get_transform()
+            trigger_box_global_pos = transform.transform(traffic_light.trigger_volume.location)
             trigger_box_global_pos = carla.Location(x=trigger_box_global_pos.x, y=trigger_box_global_pos.y, z=trigger_box_global_pos.z)
-            if (trigger_box_global_pos.distance(vehicle_position) > self.light_radius):
+            if (trigger_box_global_pos.distance(ego_location) > self.light_radius):
                 continue
-            ego_pos_batched.append(ego_pos_list)
-            ego_yaw_batched.append(ego_yaw_list)
-            pos_batched.append([traffic_light.get_transform().location.x, traffic_light.get_transform().location.y])
-            yaw_batched.append([traffic_light.get_transform().rotation.yaw/180*np.pi])
-            template_batched.append(np.ones([4, 4]))
-            if str(traffic_light.state) == 'Green':
-                channel_batched.append(4)
-            elif str(traffic_light.state) == 'Yellow':
-                channel_batched.append(3)
-            elif str(traffic_light.state) == 'Red':
-                channel_batched.append(2)
-
-        if len(ego_pos_batched)>0:
-            ego_pos_batched_torch = torch.tensor(ego_pos_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            ego_yaw_batched_torch = torch.tensor(ego_yaw_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            pos_batched_torch = torch.tensor(pos_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            yaw_batched_torch = torch.tensor(yaw_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            template_batched_torch = torch.tensor(template_batched, device='cuda', dtype=torch.float32).unsqueeze(1)
-            channel_batched_torch = torch.tensor(channel_batched, device='cuda', dtype=torch.int)
+            poses.append([transform.location.x, transform.location.y, transform.rotation.yaw/180*np.pi])
+            sizes.append([4, 4])
+            channels.append(channel)
+
+        if len(poses) > 0:
+            poses = torch.tensor(poses, device=self.device, dtype=torch.float32)
+            sizes = torch.tensor(sizes, device=self.device, dtype=torch.long)
+            channels = torch.tensor(channels, device=self.device, dtype=torch.long)
+            num_agents = len(poses)
+
+            # Templates of different sizes are zero padded to the largest one
+            max_size = sizes.max(dim=0)[0]
+            rows = torch.arange(int(max_size[0]), device=self.device)
+            cols = torch.arange(int(max_size[1]), device=self.device)
+            templates = (rows[None, :, None] < sizes[:, 0, None, None]) & (cols[None, None, :] < sizes[:, 1, None, None])
 
             self.renderer.render_agent_bv_batched(
                 birdview,
-                ego_pos_batched_torch,
-                ego_yaw_batched_torch,
-                template_batched_torch,
-                pos_batched_torch,
-                yaw_batched_torch,
-                channel=channel_batched_torch,
+                ego_pos.view(1, 1, 2).expand(num_agents, -1, -1),
+                ego_yaw.view(1, 1, 1).expand(num_agents, -1, -1),
+                templates.unsqueeze(1).float(),
+                poses[:, None, 0:2],
+                poses[:, None, 2:3],
+                channel=channels,
+                template_sizes=sizes,
             )
 
         return birdview
@@ -1,5 +1,4 @@
 import os
-import math
 from copy import deepcopy
 from collections import deque
 import xml.etree.ElementTree as ET
@@ -7,6 +6,7 @@ import numpy as np
 
 from agents.navigation.global_route_planner import GlobalRoutePlanner
 from agents.navigation.global_route_planner_dao import GlobalRoutePlannerDAO
+from leaderboard.utils.route_manipulation import location_route_to_gps
 
 DEBUG = False
 
@@ -220,23 +220,6 @@ def interpolate_trajectory(world_map, waypoints_trajectory, hop_resolution=1.0,
     return location_route_to_gps(route, lat_ref, lon_ref), route
 
 
-def location_route_to_gps(route, lat_ref, lon_ref):
-    """
-        Locate each waypoint of the route into gps, (lat long ) representations.
-    :param route:
-    :param lat_ref:
-    :param lon_ref:
-    :return:
-    """
-    gps_route = []
-
-    for transform, connection in route:
-        gps_point = _location_to_gps(lat_ref, lon_ref, transform.location)
-        gps_route.append((gps_point, connection))
-
-    return gps_route
-
-
 def _get_latlon_ref(world_map):
     """
     Convert from waypoints world coordinates to CARLA GPS coordinates
@@ -260,26 +243,3 @@ def _get_latlon_ref(world_map):
                         if '+lon_0' in item:
                             lon_ref = float(item.split('=')[1])
     return lat_ref, lon_ref
-
-
-def _location_to_gps(lat_ref, lon_ref, location):
-    """
-    Convert from world coordinates to GPS coordinates
-    :param lat_ref: latitude reference for the current map
-    :param lon_ref: longitude reference for the current map
-    :param location: location to translate
-    :return: dictionary with lat, lon and height
-    """
-
-    EARTH_RADIUS_EQUA = 6378137.0   # pylint: disable=invalid-name
-    scale = math.cos(lat_ref * math.pi / 180.0)
-    mx = scale * lon_ref * math.pi * EARTH_RADIUS_EQUA / 180.0
-    my = scale * EARTH_RADIUS_EQUA * math.log(math.tan((90.0 + lat_ref) * math.pi / 360.0))
-    mx += location.x
-    my -= location.y
-
-    lon = mx * 180.0 / (math.pi * EARTH_RADIUS_EQUA * scale)
-    lat = 360.0 * math.atan(math.exp(my / (EARTH_RADIUS_EQUA * scale))) / math.pi - 90.0
-    z = location.z
-
-    return {'lat': lat, 'lon': lon, 'z': z}
\ No newline at end of file
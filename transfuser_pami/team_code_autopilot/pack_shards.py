@@ -0,0 +1,93 @@
+"""
+Packs existing datasets that were collected with one file per sensor and frame into route shards (see utils/frame_shards.py).
+
+Usage: python pack_shards.py --root /path/to/dataset --workers 16
+"""
+
+import os
+import argparse
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+from utils.frame_shards import ShardWriter, SHARD_FILE
+
+# Location of every shard member kind in the loose dataset layout
+LOOSE_FILES = {
+    'measurements': ('measurements', '%04d.json'),
+    'label_raw': ('label_raw', '%04d.json'),
+    'rgb': ('rgb', '%04d.png'),
+    'topdown': ('topdown', 'encoded_%04d.png'),
+    'semantics': ('semantics', '%04d.png'),
+    'depth': ('depth', '%04d.png'),
+    'lidar': ('lidar', '%04d.npy'),
+}
+
+
+def find_routes(root):
+    """
+    Returns all route directories below root that are stored in the loose layout.
+    """
+    routes = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if 'lidar' in dirnames and 'measurements' in dirnames:
+            routes.append(dirpath)
+            dirnames[:] = [] # Do not descend into the sensor folders
+    return sorted(routes)
+
+
+def pack_route(args):
+    route_dir, overwrite, remove_loose = args
+    shard_file = os.path.join(route_dir, SHARD_FILE)
+    if os.path.exists(shard_file) and not overwrite:
+        return route_dir, 0
+
+    frames = sorted(int(f.split('.')[0]) for f in os.listdir(os.path.join(route_dir, 'lidar')))
+
+    # Write to a temporary file first, so an interrupted run never leaves a truncated shard that would be preferred over
+    # the loose files.
+    tmp_file = shard_file + '.tmp'
+    writer = ShardWriter(tmp_file)
+    for frame in frames:
+        members = {}
+        for kind, (folder, pattern) in LOOSE_FILES.items():
+            filename = os.path.join(route_dir, folder, pattern % frame)
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    members[kind] = f.read()
+        writer.write_frame(frame, members)
+    writer.close()
+    os.replace(tmp_file, shard_file)
+
+    if remove_loose:
+        for frame in frames:
+            for folder, pattern in LOOSE_FILES.values():
+                filename = os.path.join(route_dir, folder, pattern % frame)
+                if os.path.isfile(filename):
+                    os.remove(filename)
+
+    return route_dir, len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, required=True, help='Root directory of the dataset that should be packed.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of routes that are packed in parallel.')
+    parser.add_argument('--overwrite', type=int, default=0, help='1: Repack routes that already have a shard.')
+    parser.add_argument('--remove_loose', type=int, default=0, help='1: Delete the per frame files after a route was packed. '
+                                                                   'Note that training code without shard support can not read the route anymore.')
+    args = parser.parse_args()
+
+    routes = find_routes(args.root)
+    print('Packing %d routes' % len(routes))
+
+    num_frames = 0
+    with Pool(args.workers) as pool:
+        jobs = [(route, args.overwrite, args.remove_loose) for route in routes]
+        for _, frames in tqdm(pool.imap_unordered(pack_route, jobs), total=len(jobs)):
+            num_frames += frames
+    print('Packed %d frames' % num_frames)
+
+
+if __name__ == '__main__':
+    main()
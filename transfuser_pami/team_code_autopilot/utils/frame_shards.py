@@ -0,0 +1,59 @@
+"""
+Packed shard format for the training frames of one route.
+
+All frames of a route are stored in a single uncompressed tar file (route_dir/frames.tar) instead of six files per frame.
+Every frame is a contiguous block of members named like the WebDataset convention <frame>.<kind>.<ext>, e.g.:
+    0012.measurements.json, 0012.label_raw.json, 0012.rgb.png, 0012.topdown.png, 0012.semantics.png, 0012.depth.png, 0012.lidar.npy
+The member contents are byte for byte the loose files the data agent used to write, so they are decoded the same way.
+The small json members come first, so the labels of a frame can be read without reading its images.
+"""
+
+import io
+import tarfile
+
+SHARD_FILE = 'frames.tar'
+
+# Order of the members inside of a frame block and the file extension of each kind
+SHARD_MEMBERS = [
+    ('measurements', 'json'),
+    ('label_raw', 'json'),
+    ('rgb', 'png'),
+    ('topdown', 'png'),
+    ('semantics', 'png'),
+    ('depth', 'png'),
+    ('lidar', 'npy'),
+]
+
+
+def member_name(frame, kind):
+    return '%04d.%s.%s' % (frame, kind, dict(SHARD_MEMBERS)[kind])
+
+
+class ShardWriter(object):
+    """
+    Appends frames to a route shard.
+    The file is flushed after every frame, so a crashed data collection run still leaves a readable shard with all
+    completed frames.
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self._tar = tarfile.open(self.filename, mode='w', format=tarfile.USTAR_FORMAT)
+
+    def write_frame(self, frame, members):
+        """
+        Write one frame. members maps the kind of each member (see SHARD_MEMBERS) to its encoded bytes.
+        """
+        for kind, _ in SHARD_MEMBERS:
+            if kind not in members:
+                continue
+            data = members[kind]
+            info = tarfile.TarInfo(member_name(frame, kind))
+            info.size = len(data)
+            self._tar.addfile(info, io.BytesIO(data))
+        self._tar.fileobj.flush()
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
@@ -0,0 +1,31 @@
+"""
+Compact storage format of the LiDAR frames.
+
+The original format is a pickled object array (frame, points) with float32 XYZI points, which needs allow_pickle to be
+read and can not be memory-mapped. The compact format is a plain [N, 4] float16 XYZI .npy file: half the size, and it
+can be read with np.load without pickle (or with mmap_mode='r'). Within 32 m the float16 coordinates are spaced at most
+1.6 cm apart (3.1 cm within 64 m), which is well below the 12.5 cm cells of the BEV histogram the models use.
+Keep the format in sync with load_lidar in team_code_transfuser/data.py, which reads both formats.
+"""
+
+import numpy as np
+
+LIDAR_DTYPE = np.float16
+
+
+def encode_lidar(points):
+    """
+    Converts [N, 4] XYZI points into the compact array.
+    """
+    return np.ascontiguousarray(points[:, :4], dtype=LIDAR_DTYPE)
+
+
+def decode_lidar(compact):
+    """
+    Converts a compact array back into [N, 4] float32 XYZI points.
+    """
+    return compact.astype(np.float32)
+
+
+def is_compact(array):
+    return array.dtype == LIDAR_DTYPE and array.ndim == 2
@@ -12,7 +12,7 @@ PIXELS_PER_METER = 5
 
 class Renderer():
     def __init__(self, map_offset, map_dims, data_generation=True):
-        self.args = {'device': 'cuda'}
+        self.args = {'device': 'cuda' if torch.cuda.is_available() else 'cpu'}
         if data_generation:
             self.PIXELS_AHEAD_VEHICLE = 0 # ego car is central
             self.local_view_dims = (500, 500)
@@ -249,8 +249,13 @@ class Renderer():
             position, 
             orientation,
             channel=5,
+            template_sizes=None,
         ):
         """
+        Renders B agents into grid with one grid_sample call, agent i is added to channel[i].
+        Agents with different template sizes can be rendered together: vehicle is then a [B, 1, H, W] batch of templates
+        that are zero padded at the bottom and the right, and template_sizes [B, 2] holds the (rows, cols) of every
+        unpadded template.
         """
         # FIXME: why do we need to do this everywhere?
         orientation = orientation + np.pi / 2
@@ -264,17 +269,30 @@ class Renderer():
         pos_rel_bv = pos_rel_bv * 2 -1  # change domain from [0, 1] to [-1, 1]
         pos_rel_bv = pos_rel_bv * -1  # Because the STN coordinates are weird
 
-        scale_h = torch.tensor([grid.size(2) / vehicle.size(2)], device=self.args['device'])
-        scale_w = torch.tensor([grid.size(3) / vehicle.size(3)], device=self.args['device'])
-        
-        # TODO: build composite transform directly
-        # build individual transforms
-        scale_transform = torch.tensor(
-            [[scale_w, 0, 0],
-            [0, scale_h, 0],
-            [0, 0, 1]],
-            device=self.args['device']
-        ).view(1, 3, 3).expand(batch_size, -1, -1)
+        if template_sizes is None:
+            template_sizes = torch.tensor([[vehicle.size(2), vehicle.size(3)]], device=self.args['device']).expand(batch_size, -1)
+        template_sizes = template_sizes.to(device=self.args['device'], dtype=torch.float32)
+        template_h = template_sizes[:, 0].view(batch_size, 1)
+        template_w = template_sizes[:, 1].view(batch_size, 1)
+
+        zeros = torch.zeros_like(template_h)
+        ones = torch.ones_like(template_h)
+        scale_transform = torch.stack(
+            [grid.size(3) / template_w, zeros, zeros,
+             zeros, grid.size(2) / template_h, zeros,
+             zeros, zeros, ones],
+            dim=-1,
+        ).view(batch_size, 3, 3)
+
+        # maps the normalized coordinates of the unpadded template to the ones of its top left corner in the padded template
+        pad_w = (template_w - 1) / max(vehicle.size(3) - 1, 1)
+        pad_h = (template_h - 1) / max(vehicle.size(2) - 1, 1)
+        padding_transform = torch.stack(
+            [pad_w, zeros, pad_w - 1,
+             zeros, pad_h, pad_h - 1,
+             zeros, zeros, ones],
+            dim=-1,
+        ).view(batch_size, 3, 3)
 
         # this is the inverse of the rotation matrix for the visibility check
         # because now we want crop coordinates instead of world coordinates
@@ -297,7 +315,7 @@ class Renderer():
         ).view(batch_size, 3, 3)
 
         # chain transforms
-        affine_transform = scale_transform @ rotation_transform @ translation_transform
+        affine_transform = padding_transform @ scale_transform @ rotation_transform @ translation_transform
 
         affine_grid = F.affine_grid(
             affine_transform[:, 0:2, :], # expects Nx2x3
@@ -310,9 +328,10 @@ class Renderer():
             affine_grid,
             align_corners=True,
         )
-        
-        for i in range(batch_size):
-            grid[:, int(channel[i].item()), ...] += vehicle_rendering[i].squeeze()
+
+        if not torch.is_tensor(channel):
+            channel = torch.full((batch_size,), channel, device=self.args['device'])
+        grid[0].index_add_(0, channel.to(device=grid.device, dtype=torch.long), vehicle_rendering[:, 0])
 
 
     def get_local_birdview(self, grid, position, orientation):
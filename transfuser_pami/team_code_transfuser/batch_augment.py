@@ -0,0 +1,222 @@
+"""
+Batched version of the augmentation and label parsing of CARLA_Data that runs on the training device.
+With config.device_augment the data loader workers only decode the frames and draw the augmentation (see
+CARLA_Data.add_raw_inputs). The camera crops, the BEV rotation, the LiDAR alignment and splatting and the bounding box
+labels are then computed here for the whole batch, which removes the per sample skimage rotation and Python label loops
+from the workers. The results match the worker path up to floating point rounding.
+"""
+
+import numpy as np
+import torch
+from torch.utils.data.dataloader import default_collate
+
+from data import LIDAR_SPLATTER
+from utils import get_lidar_to_bevimage_transform
+
+PIXELS_PER_METER = 8
+NUM_LABELS = 20
+BEV_SHIFT = 7 # the lidar is + 1.3 in x
+BEV_CROP = 32 * 5 # 32 m at 5 pixels per meter
+
+
+class BatchAugmenter(object):
+    """
+    Turns a collated batch of raw CARLA_Data items into the inputs and labels the Engine expects
+    (rgb, depth, semantic, bev, lidar or lidar_raw + num_points, label, ego_waypoint).
+    """
+
+    def __init__(self, config, device):
+        self.device = device
+        self.crop = tuple(config.img_resolution)
+        self.multitask = config.multitask
+        self.use_point_pillars = config.use_point_pillars
+        self.converter = torch.tensor(np.uint8(config.converter), device=device)
+        self.lidar_to_bev = torch.tensor(get_lidar_to_bevimage_transform(), dtype=torch.float64, device=device)
+
+    def __call__(self, data):
+        degree = data.pop('aug_degree').to(self.device, dtype=torch.float64)
+        rad = torch.deg2rad(degree)
+        cos, sin = torch.cos(rad), torch.sin(rad)
+        crop_shift = data.pop('crop_shift').to(self.device, dtype=torch.long)
+
+        rgb = data.pop('rgb_raw').to(self.device, non_blocking=True)
+        data['rgb'] = self.crop_image(rgb, crop_shift).permute(0, 3, 1, 2).contiguous()
+        if self.multitask:
+            depth = self.crop_image(data.pop('depth_raw').to(self.device, non_blocking=True), crop_shift)
+            data['depth'] = get_depth(depth)
+            semantic = self.crop_image(data.pop('semantic_raw').to(self.device, non_blocking=True), crop_shift)
+            data['semantic'] = self.converter[semantic.long()]
+
+        data['bev'] = rotate_crop_bev(data.pop('bev_raw').to(self.device, non_blocking=True), cos, sin)
+
+        points = data.pop('lidar_raw_points').to(self.device, non_blocking=True)
+        num_points = data.pop('num_points').to(self.device)
+        points = align_points(points, data.pop('lidar_matrix').to(self.device, dtype=torch.float64))
+        if self.use_point_pillars:
+            data['lidar_raw'] = points.float()
+            data['num_points'] = num_points
+        else:
+            data['lidar'] = LIDAR_SPLATTER.splat_torch(points, num_points)
+
+        boxes = data.pop('raw_boxes').to(self.device, dtype=torch.float64)
+        num_boxes = data.pop('num_boxes').to(self.device)
+        data['label'] = self.parse_labels(boxes, num_boxes, rad, cos, sin)
+
+        # for the augmentation we only need to transform the waypoints for ego car
+        waypoints = data.pop('ego_waypoint_raw').to(self.device, dtype=torch.float64)
+        x, y = waypoints[..., 0], waypoints[..., 1]
+        data['ego_waypoint'] = torch.stack((cos[:, None] * x + sin[:, None] * y,
+                                            -sin[:, None] * x + cos[:, None] * y), dim=-1)
+        return data
+
+    def crop_image(self, images, crop_shift):
+        """
+        Crops every image of a [B, H, W, ...] batch around its center, shifted by crop_shift pixels in x.
+        """
+        height, width = images.shape[1], images.shape[2]
+        crop_h, crop_w = self.crop
+        start_y = height // 2 - crop_h // 2
+        start_x = width // 2 - crop_w // 2 + crop_shift
+
+        batch = torch.arange(images.shape[0], device=images.device)[:, None, None]
+        rows = torch.arange(start_y, start_y + crop_h, device=images.device)[None, :, None]
+        cols = (start_x[:, None] + torch.arange(crop_w, device=images.device)[None, :])[:, None, :]
+        return images[batch, rows, cols]
+
+    def parse_labels(self, boxes, num_boxes, rad, cos, sin):
+        """
+        Batched parse_labels with the rotation of the augmentation. boxes: [B, N, 9] (dz, dx, dy, x, y, z, yaw, speed, brake).
+        Returns the labels of the boxes inside of the BEV image, in input order and padded with zeros: [B, 20, 7].
+        """
+        dz, dx, dy, x, y, z, yaw, speed, brake = boxes.unbind(dim=-1)
+
+        # T = lidar_to_bev @ degree_matrix(-rad)
+        degree_matrix = torch.zeros((boxes.shape[0], 3, 3), dtype=torch.float64, device=boxes.device)
+        degree_matrix[:, 0, 0] = cos
+        degree_matrix[:, 0, 1] = -sin
+        degree_matrix[:, 1, 0] = sin
+        degree_matrix[:, 1, 1] = cos
+        degree_matrix[:, 2, 2] = 1.0
+        T = self.lidar_to_bev @ degree_matrix
+        position_x = T[:, 0, 0, None] * x + T[:, 0, 1, None] * y + T[:, 0, 2, None]
+        position_y = T[:, 1, 0, None] * x + T[:, 1, 1, None] * y + T[:, 1, 2, None]
+        position_x = torch.clamp(position_x, 0.0, 255.0)
+        position_y = torch.clamp(position_y, 0.0, 255.0)
+
+        labels = torch.stack((position_x, position_y, dy * PIXELS_PER_METER, dx * PIXELS_PER_METER, yaw - rad[:, None],
+                              speed, brake), dim=-1)
+
+        # Filter bb that are outside of the LiDAR after the random augmentation
+        valid = (position_x > 0.0) & (position_x < 255.0) & (position_y > 0.0) & (position_y < 255.0)
+        valid &= torch.arange(boxes.shape[1], device=boxes.device)[None, :] < num_boxes[:, None]
+        slot = torch.cumsum(valid.long(), dim=1) - 1
+        valid &= slot < NUM_LABELS
+
+        label = torch.zeros((boxes.shape[0], NUM_LABELS, 7), dtype=torch.float32, device=boxes.device)
+        batch = torch.arange(boxes.shape[0], device=boxes.device)[:, None].expand_as(slot)
+        label[batch[valid], slot[valid]] = labels[valid].float()
+        return label
+
+
+def collate_raw(batch):
+    """
+    Collate function of the data loaders with config.device_augment. The raw LiDAR point clouds of the samples have
+    different sizes, they are padded with zeros to the largest cloud of the batch (num_points holds the real sizes).
+    """
+    points = [torch.from_numpy(sample.pop('lidar_raw_points')) for sample in batch]
+    data = default_collate(batch)
+    data['lidar_raw_points'] = torch.nn.utils.rnn.pad_sequence(points, batch_first=True)
+    return data
+
+
+def get_depth(data):
+    """
+    Batched get_depth, data: [B, H, W, 3] uint8. Computes the normalized depth.
+    """
+    data = data.to(torch.float64)
+    normalized = data[..., 0] * 65536.0 + data[..., 1] * 256.0 + data[..., 2]
+    normalized /= (256 * 256 * 256 - 1)
+    #clip to 50 meters
+    normalized = torch.clamp(normalized, 0.0, 0.05)
+    normalized = normalized * 20.0 # Rescale map to lie in [0,1]
+    return normalized.float()
+
+
+def rotate_crop_bev(bev, cos, sin):
+    """
+    Batched load_crop_bev_npy. bev: [B, 2, H, W] uint8, cos, sin of the augmentation angle: [B].
+    Shifts the map, rotates it bilinearly around the image center like skimage.transform.rotate and returns the
+    argmax classes of the crop in front of the car: [B, 160, 160] long. Only the pixels of the crop are sampled.
+    """
+    batch_size, _, height, width = bev.shape
+    start_x = width // 2 - BEV_CROP // 2
+    start_y = height // 2 - BEV_CROP
+
+    # shift the center by 7 because the lidar is + 1.3 in x
+    bev_shift = torch.zeros(bev.shape, dtype=torch.float64, device=bev.device)
+    bev_shift[:, :, BEV_SHIFT:] = bev[:, :, :-BEV_SHIFT]
+
+    # Output pixel -> input pixel, the inverse map that skimage uses for the rotation: T(center) @ R @ T(-center)
+    center_x = width / 2.0 - 0.5
+    center_y = height / 2.0 - 0.5
+    matrix = torch.zeros((batch_size, 3, 3), dtype=torch.float64, device=bev.device)
+    matrix[:, 0, 0] = cos
+    matrix[:, 0, 1] = -sin
+    matrix[:, 1, 0] = sin
+    matrix[:, 1, 1] = cos
+    matrix[:, 2, 2] = 1.0
+    translation = torch.eye(3, dtype=torch.float64, device=bev.device)
+    translation[0, 2], translation[1, 2] = center_x, center_y
+    matrix = translation @ (matrix @ torch.linalg.inv(translation))
+
+    rows = torch.arange(start_y, start_y + BEV_CROP, dtype=torch.float64, device=bev.device)[None, :, None]
+    cols = torch.arange(start_x, start_x + BEV_CROP, dtype=torch.float64, device=bev.device)[None, None, :]
+    matrix = matrix[:, :, :, None, None]
+    input_x = matrix[:, 0, 0] * cols + matrix[:, 0, 1] * rows + matrix[:, 0, 2]
+    input_y = matrix[:, 1, 0] * cols + matrix[:, 1, 1] * rows + matrix[:, 1, 2]
+    cropped = bilinear_sample(bev_shift, input_x, input_y)
+
+    # we need to predict others so append 0 to the first channel
+    cropped = torch.cat((torch.zeros_like(cropped[:, :1]), cropped[:, :1], cropped[:, :1] + cropped[:, 1:2]), dim=1)
+    return torch.argmax(cropped, dim=1)
+
+
+def bilinear_sample(images, x, y):
+    """
+    Bilinear interpolation with zeros outside of the image, like skimage with mode='constant'.
+    images: [B, C, H, W], x, y: [B, h, w] input pixel coordinates. Returns [B, C, h, w].
+    """
+    batch_size, channels, height, width = images.shape
+    x0 = torch.floor(x)
+    y0 = torch.floor(y)
+    dx = x - x0
+    dy = y - y0
+    x0 = x0.long()
+    y0 = y0.long()
+    images = images.reshape(batch_size, channels, height * width)
+
+    def pixel(row, col):
+        inside = (row >= 0) & (row < height) & (col >= 0) & (col < width)
+        index = (torch.clamp(row, 0, height - 1) * width + torch.clamp(col, 0, width - 1)).reshape(batch_size, 1, -1)
+        values = torch.gather(images, 2, index.expand(-1, channels, -1)).reshape(batch_size, channels, *row.shape[1:])
+        return values * inside[:, None]
+
+    dx, dy = dx[:, None], dy[:, None]
+    top = (1 - dx) * pixel(y0, x0) + dx * pixel(y0, x0 + 1)
+    bottom = (1 - dx) * pixel(y0 + 1, x0) + dx * pixel(y0 + 1, x0 + 1)
+    return (1 - dy) * top + dy * bottom
+
+
+def align_points(points, matrix):
+    """
+    Batched align for a transform that is already computed. points: [B, N, 4] float32, matrix: [B, 4, 4] float64.
+    """
+    lidar = points.to(torch.float64)
+    lidar[..., 3] = 1.0
+    #important we should convert the points back to carla format because when we save the data we negatived y component
+    lidar[..., 1] *= -1.0
+    lidar = lidar @ matrix.transpose(1, 2)
+    lidar[..., 3] = points[..., 3]
+    # and we change back here
+    lidar[..., 1] *= -1.0
+    return lidar
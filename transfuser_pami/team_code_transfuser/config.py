@@ -8,6 +8,7 @@ class GlobalConfig:
     img_seq_len = 1 
     lidar_seq_len = 1
     pred_len = 4 # future waypoints predicted
+    index_workers = 8 # Number of processes that scan the route directories when the dataset is created
     scale = 1 # image pre-processing
     img_resolution = (160, 704) # image pre-processing in H, W
     img_width = 320 # important this should be consistent with scale, e.g. scale = 1, img_width 320, scale=2, image_width 640
@@ -32,6 +33,7 @@ class GlobalConfig:
     augment = True
     inv_augment_prob = 0.1 # Probablity that data augmentation is applied is 1.0 - inv_augment_prob
     aug_max_rotation = 20 # degree
+    device_augment = False # If true the augmentation and label parsing run batched on the training device, see batch_augment.py
     debug = False # If true the model in and outputs will be visualized and saved into Os variable Save_Path
     sync_batch_norm = False # If this is true we convert the batch norms, to synced bach norms.
     train_debug_save_freq = 50 # At which interval to save debug files to disk during training
@@ -151,6 +153,7 @@ class GlobalConfig:
     carla_fps = 20 # Simulator Frames per second
     iou_treshold_nms = 0.2  # Iou threshold used for Non Maximum suppression on the Bounding Box predictions for the ensembles
     steer_damping = 0.5 # Damping factor by which the steering will be multiplied when braking
+    ensemble_streams = True # Run the models of an ensemble concurrently, each on its own CUDA stream
     route_planner_min_distance = 7.5
     route_planner_max_distance = 50.0
     action_repeat = 2 # Number of times we repeat the networks action. It's 2 because the LiDAR operates at half the frame rate of the simulation
@@ -180,6 +183,7 @@ class GlobalConfig:
     embd_pdrop = 0.1
     resid_pdrop = 0.1
     attn_pdrop = 0.1
+    attention_backend = 'sdpa' # 'sdpa': fused torch scaled_dot_product_attention (torch >= 2.0), 'math': explicit softmax attention
     gpt_linear_layer_init_mean = 0.0 # Mean of the normal distribution with which the linear layers in the GPT are initialized
     gpt_linear_layer_init_std  = 0.02 # Std  of the normal distribution with which the linear layers in the GPT are initialized
     gpt_layer_norm_init_weight = 1.0 # Initial weight of the layer norms in the gpt.
@@ -2,20 +2,29 @@ import os
 import ujson
 from skimage.transform import rotate
 import numpy as np
+import torch
 from torch.utils.data import Dataset
 from tqdm import tqdm
 import sys
-from pathlib import Path
+from multiprocessing import Pool
 import cv2
 import random
 from copy import deepcopy
 import io
+import tarfile
 
+from lidar_splat import LidarSplatter, sample_cell_points, sample_cell_points_torch
 from utils import get_vehicle_to_virtual_lidar_transform, get_vehicle_to_lidar_transform, get_lidar_to_vehicle_transform, get_lidar_to_bevimage_transform
 
+# 256 x 256 grid, 8 pixels per meter, 16m to the sides and 32m to the front
+LIDAR_SPLATTER = LidarSplatter()
+# Raw boxes that are passed to the BatchAugmenter per sample, and the distance in meters of the LiDAR range corners
+MAX_RAW_BOXES = 64
+RAW_BOX_RANGE = 36.0
+
 class CARLA_Data(Dataset):
 
-    def __init__(self, root, config, shared_dict=None):
+    def __init__(self, root, config, shared_dict=None, sample_cache=None):
 
         self.seq_len = np.array(config.seq_len)
         assert (config.img_seq_len == 1)
@@ -26,12 +35,17 @@ class CARLA_Data(Dataset):
         self.scale = np.array(config.scale)
         self.multitask = np.array(config.multitask)
         self.data_cache = shared_dict
+        self.sample_cache = sample_cache
         self.augment = np.array(config.augment)
         self.aug_max_rotation = np.array(config.aug_max_rotation)
         self.use_point_pillars = np.array(config.use_point_pillars)
         self.max_lidar_points = np.array(config.max_lidar_points)
         self.backbone = np.array(config.backbone).astype(np.string_)
         self.inv_augment_prob = np.array(config.inv_augment_prob)
+        # Leaves the augmentation and label parsing to a BatchAugmenter that runs on the training device
+        self.device_augment = np.array(config.device_augment)
+        if self.device_augment:
+            assert (config.seq_len == 1)
         
         self.converter = np.uint8(config.converter)
 
@@ -42,60 +56,124 @@ class CARLA_Data(Dataset):
         self.lidars = []
         self.labels = []
         self.measurements = []
-
-        for sub_root in tqdm(root, file=sys.stdout):
-            sub_root = Path(sub_root)
-
-            # list sub-directories in root
-            root_files = os.listdir(sub_root)
-            routes = [folder for folder in root_files if not os.path.isfile(os.path.join(sub_root,folder))]
-            for route in routes:
-                route_dir = sub_root / route
-                num_seq = len(os.listdir(route_dir / "lidar"))
-
-                # ignore the first two and last two frame
-                for seq in range(2, num_seq - self.pred_len - self.seq_len - 2):
-                    # load input seq and pred seq jointly
-                    image = []
-                    bev = []
-                    depth = []
-                    semantic = []
-                    lidar = []
-                    label = []
-                    measurement= []
-                    # Loads the current (and past) frames (if seq_len > 1)
-                    for idx in range(self.seq_len):
-                        image.append(route_dir / "rgb" / ("%04d.png" % (seq + idx)))
-                        bev.append(route_dir / "topdown" / ("encoded_%04d.png" % (seq + idx)))
-                        depth.append(route_dir / "depth" / ("%04d.png" % (seq + idx)))
-                        semantic.append(route_dir / "semantics" / ("%04d.png" % (seq + idx)))
-                        lidar.append(route_dir / "lidar" / ("%04d.npy" % (seq + idx)))
-                        measurement.append(route_dir / "measurements" / ("%04d.json"%(seq+idx)))
-
-                    # Additionally load future labels of the waypoints
-                    for idx in range(self.seq_len + self.pred_len):
-                        label.append(route_dir / "label_raw" / ("%04d.json" % (seq + idx)))
-
-                    self.images.append(image)
-                    self.bevs.append(bev)
-                    self.depths.append(depth)
-                    self.semantics.append(semantic)
-                    self.lidars.append(lidar)
-                    self.labels.append(label)
-                    self.measurements.append(measurement)
+        # Routes that were packed into a shard (see team_code_autopilot/utils/frame_shards.py) are read from there.
+        # For every sample we store the shard file (empty for loose routes) and the byte ranges of its frames.
+        self.shards = []
+        self.shard_ranges = []
+        # Integer key of every loaded frame, used by the sample cache
+        self.frame_keys = []
+        num_frames = 0
+
+        # Scanning the routes is dominated by file system latency (especially on network file systems), so it is done by a
+        # pool of processes and the frame count of unchanged routes is read back from their manifest.
+        routes = []
+        with Pool(config.index_workers) as pool:
+            for sub_routes in pool.imap(list_routes, root):
+                routes += sub_routes
+            scanned_routes = list(tqdm(pool.imap(scan_route, routes, chunksize=16), total=len(routes), file=sys.stdout))
+
+        for route_dir, num_seq, frame_ranges in scanned_routes:
+            # ignore the first two and last two frame
+            seqs = np.arange(2, num_seq - self.pred_len - self.seq_len - 2)
+            if frame_ranges is not None:
+                # Byte ranges by frame number, frames that are missing in the shard have a start of -1
+                shard_rows = np.array(frame_ranges, dtype=np.int64).reshape(-1, 4)
+                route_ranges = np.full((num_seq, 3), -1, dtype=np.int64)
+                route_ranges[shard_rows[:, 0]] = shard_rows[:, 1:]
+                # Only keep the samples whose frames are all in the shard
+                label_offsets = np.arange(self.seq_len + self.pred_len)
+                seqs = seqs[(route_ranges[seqs[:, None] + label_offsets[None, :], 0] >= 0).all(axis=1)]
+            if len(seqs) == 0:
+                continue
+            # Loads the current (and past) frames (if seq_len > 1)
+            frames = seqs[:, None] + np.arange(self.seq_len)[None, :]
+            # Additionally load future labels of the waypoints
+            label_frames = seqs[:, None] + np.arange(self.seq_len + self.pred_len)[None, :]
+
+            self.images.append(route_paths(route_dir, "rgb", "%04d.png", frames))
+            self.bevs.append(route_paths(route_dir, "topdown", "encoded_%04d.png", frames))
+            self.depths.append(route_paths(route_dir, "depth", "%04d.png", frames))
+            self.semantics.append(route_paths(route_dir, "semantics", "%04d.png", frames))
+            self.lidars.append(route_paths(route_dir, "lidar", "%04d.npy", frames))
+            self.labels.append(route_paths(route_dir, "label_raw", "%04d.json", label_frames))
+            self.measurements.append(route_paths(route_dir, "measurements", "%04d.json", frames))
+            self.frame_keys.append(num_frames + frames)
+            num_frames += num_seq
+            if frame_ranges is None:
+                self.shards.append(np.full(len(seqs), b'', dtype=np.string_))
+                self.shard_ranges.append(np.zeros(label_frames.shape + (3,), dtype=np.int64))
+            else:
+                self.shards.append(np.full(len(seqs), os.path.join(route_dir, SHARD_FILE)).astype(np.string_))
+                self.shard_ranges.append(route_ranges[label_frames])
 
         # There is a complex "memory leak"/performance issue when using Python objects like lists in a Dataloader that is loaded with multiprocessing, num_workers > 0
         # A summary of that ongoing discussion can be found here https://github.com/pytorch/pytorch/issues/13246#issuecomment-905703662
         # A workaround is to store the string lists as numpy byte objects because they only have 1 refcount.
-        self.images       = np.array(self.images      ).astype(np.string_)
-        self.bevs         = np.array(self.bevs        ).astype(np.string_)
-        self.depths       = np.array(self.depths      ).astype(np.string_)
-        self.semantics    = np.array(self.semantics   ).astype(np.string_)
-        self.lidars       = np.array(self.lidars      ).astype(np.string_)
-        self.labels       = np.array(self.labels      ).astype(np.string_)
-        self.measurements = np.array(self.measurements).astype(np.string_)
+        self.images       = concatenate_paths(self.images,       self.seq_len)
+        self.bevs         = concatenate_paths(self.bevs,         self.seq_len)
+        self.depths       = concatenate_paths(self.depths,       self.seq_len)
+        self.semantics    = concatenate_paths(self.semantics,    self.seq_len)
+        self.lidars       = concatenate_paths(self.lidars,       self.seq_len)
+        self.labels       = concatenate_paths(self.labels,       self.seq_len + self.pred_len)
+        self.measurements = concatenate_paths(self.measurements, self.seq_len)
+        self.shards       = np.concatenate(self.shards) if len(self.shards) > 0 else np.zeros(0, dtype=np.string_)
+        self.shard_ranges = np.concatenate(self.shard_ranges) if len(self.shard_ranges) > 0 else np.zeros((0, self.seq_len + self.pred_len, 3), dtype=np.int64)
+        self.frame_keys   = np.concatenate(self.frame_keys) if len(self.frame_keys) > 0 else np.zeros((0, self.seq_len), dtype=np.int64)
         print("Loading %d lidars from %d folders"%(len(self.lidars), len(root)))
 
+        if self.sample_cache is not None:
+            self.frame_keys += self.sample_cache.reserve(num_frames)
+            if len(self.lidars) > 0:
+                # The slots of the cache have the layout of the decoded frames
+                self.sample_cache.set_layout(self.load_camera_frame(*self.frame_sources(0, 0)[1]))
+
+    def frame_sources(self, index, i):
+        """
+        Returns the sources of frame i of sample index as ((measurements, lidar), (rgb, bev, depth, semantics)).
+        A source is the path of the file for loose routes and the bytes of the member for packed routes.
+        """
+        if len(self.shards[index]) > 0:
+            # All sensors of a frame are stored next to each other in the shard, so this is one sequential read
+            shard_ranges = self.shard_ranges[index]
+            frame = read_shard_frame(str(self.shards[index], encoding='utf-8'), shard_ranges[i][0], shard_ranges[i][2])
+            return (frame['measurements'], frame['lidar']), (frame['rgb'], frame['topdown'], frame.get('depth'), frame.get('semantics'))
+
+        return ((str(self.measurements[index][i], encoding='utf-8'), str(self.lidars[index][i], encoding='utf-8')),
+                (str(self.images[index][i], encoding='utf-8'), str(self.bevs[index][i], encoding='utf-8'),
+                 str(self.depths[index][i], encoding='utf-8'), str(self.semantics[index][i], encoding='utf-8')))
+
+    def load_camera_frame(self, images_src, bevs_src, depths_src, semantics_src):
+        """
+        Decodes the camera images of a frame before augmentation. Returns a dict with rgb, bev, depth and semantics
+        (depth and semantics are None if the model is not multitask).
+        """
+        images_i = load_image(images_src, cv2.IMREAD_COLOR)
+        if(images_i is None):
+            print("Error loading file: ", images_src if isinstance(images_src, str) else "rgb shard member")
+        images_i = scale_image_cv2(cv2.cvtColor(images_i, cv2.COLOR_BGR2RGB), self.scale)
+
+        bev_array = load_image(bevs_src, cv2.IMREAD_UNCHANGED)
+        bev_array = cv2.cvtColor(bev_array, cv2.COLOR_BGR2RGB)
+        if (bev_array is None):
+            print("Error loading file: ", bevs_src if isinstance(bevs_src, str) else "topdown shard member")
+        bev_array = np.moveaxis(bev_array, -1, 0)
+        bevs_i = decode_pil_to_npy(bev_array).astype(np.uint8)
+        if self.multitask:
+            depths_i = load_image(depths_src, cv2.IMREAD_COLOR)
+            if (depths_i is None):
+                print("Error loading file: ", depths_src if isinstance(depths_src, str) else "depth shard member")
+            depths_i = scale_image_cv2(cv2.cvtColor(depths_i, cv2.COLOR_BGR2RGB), self.scale)
+
+            semantics_i = load_image(semantics_src, cv2.IMREAD_UNCHANGED)
+            if (semantics_i is None):
+                print("Error loading file: ", semantics_src if isinstance(semantics_src, str) else "semantics shard member")
+            semantics_i = scale_seg(semantics_i, self.scale)
+        else:
+            depths_i = None
+            semantics_i = None
+
+        return {'rgb': images_i, 'bev': bevs_i, 'depth': depths_i, 'semantics': semantics_i}
+
     def __len__(self):
         """Returns the length of the dataset. """
         return self.lidars.shape[0]
@@ -114,6 +192,8 @@ class CARLA_Data(Dataset):
         lidars = self.lidars[index]
         labels = self.labels[index]
         measurements = self.measurements[index]
+        shard = str(self.shards[index], encoding='utf-8') if len(self.shards[index]) > 0 else None
+        shard_ranges = self.shard_ranges[index]
 
         # load measurements
         loaded_images = []
@@ -133,9 +213,12 @@ class CARLA_Data(Dataset):
             if ((not (self.data_cache is None)) and (str(labels[i], encoding='utf-8') in self.data_cache)):
                     labels_i = self.data_cache[str(labels[i], encoding='utf-8')]
             else:
-
-                with open(str(labels[i], encoding='utf-8'), 'r') as f2:
-                    labels_i = ujson.load(f2)
+                if shard is not None:
+                    # The labels are at the start of the frame block, so the images don't need to be read
+                    labels_i = ujson.loads(read_shard_frame(shard, shard_ranges[i][0], shard_ranges[i][1])['label_raw'])
+                else:
+                    with open(str(labels[i], encoding='utf-8'), 'r') as f2:
+                        labels_i = ujson.load(f2)
 
                 if not self.data_cache is None:
                     self.data_cache[str(labels[i], encoding='utf-8')] = labels_i
@@ -152,40 +235,27 @@ class CARLA_Data(Dataset):
                     bevs_i.seek(0) # Set the point to the start of the file like object
                     bevs_i = np.load(bevs_i)['arr_0']
             else:
-                with open(str(measurements[i], encoding='utf-8'), 'r') as f1:
-                    measurements_i = ujson.load(f1)
+                (measurements_src, lidars_src), camera_sources = self.frame_sources(index, i)
 
-                lidars_i = np.load(str(lidars[i], encoding='utf-8'), allow_pickle=True)[1]  # [...,:3] # lidar: XYZI
+                measurements_i = load_json(measurements_src)
+
+                lidars_i = load_lidar(lidars_src)  # [...,:3] # lidar: XYZI
                 if (backbone == 'geometric_fusion'):
-                    lidars_raw_i = np.load(str(lidars[i], encoding='utf-8'), allow_pickle=True)[1][..., :3]  # lidar: XYZI
+                    lidars_raw_i = lidars_i[..., :3].copy()  # lidar: XYZI
                 else:
                     lidars_raw_i = None
                 lidars_i[:, 1] *= -1
 
-                images_i = cv2.imread(str(images[i], encoding='utf-8'), cv2.IMREAD_COLOR)
-                if(images_i is None):
-                    print("Error loading file: ", str(images[i], encoding='utf-8'))
-                images_i = scale_image_cv2(cv2.cvtColor(images_i, cv2.COLOR_BGR2RGB), self.scale)
-
-                bev_array = cv2.imread(str(bevs[i], encoding='utf-8'), cv2.IMREAD_UNCHANGED)
-                bev_array = cv2.cvtColor(bev_array, cv2.COLOR_BGR2RGB)
-                if (bev_array is None):
-                    print("Error loading file: ", str(bevs[i], encoding='utf-8'))
-                bev_array = np.moveaxis(bev_array, -1, 0)
-                bevs_i = decode_pil_to_npy(bev_array).astype(np.uint8)
-                if self.multitask:
-                    depths_i = cv2.imread(str(depths[i], encoding='utf-8'), cv2.IMREAD_COLOR)
-                    if (depths_i is None):
-                        print("Error loading file: ", str(depths[i], encoding='utf-8'))
-                    depths_i = scale_image_cv2(cv2.cvtColor(depths_i, cv2.COLOR_BGR2RGB), self.scale)
-
-                    semantics_i = cv2.imread(str(semantics[i], encoding='utf-8'), cv2.IMREAD_UNCHANGED)
-                    if (semantics_i is None):
-                        print("Error loading file: ", str(semantics[i], encoding='utf-8'))
-                    semantics_i = scale_seg(semantics_i, self.scale)
-                else:
-                    depths_i = None
-                    semantics_i = None
+                # Decoded camera frames are shared by all workers, hits are read only views into the cache
+                camera_frame = None
+                if self.sample_cache is not None:
+                    camera_frame = self.sample_cache.get(self.frame_keys[index][i])
+                if camera_frame is None:
+                    camera_frame = self.load_camera_frame(*camera_sources)
+                    if self.sample_cache is not None:
+                        self.sample_cache.put(self.frame_keys[index][i], camera_frame)
+                images_i, bevs_i = camera_frame['rgb'], camera_frame['bev']
+                depths_i, semantics_i = camera_frame.get('depth'), camera_frame.get('semantics')
 
                 if not self.data_cache is None:
                     # We want to cache the images in png format instead of uncompressed, to reduce memory usage
@@ -219,6 +289,12 @@ class CARLA_Data(Dataset):
             rad = np.deg2rad(degree)
             crop_shift = degree / 60 * self.img_width / self.scale # we scale first
 
+        if self.device_augment:
+            self.add_raw_inputs(data, loaded_images, loaded_bevs, loaded_depths, loaded_semantics, loaded_lidars,
+                                loaded_lidars_raw if backbone == 'geometric_fusion' else None, labels, measurements, degree, crop_shift)
+            self.add_measurements(data, measurements, rad)
+            return data
+
         images_i = loaded_images[self.seq_len-1]
         images_i = crop_image_cv2(images_i, crop=self.img_resolution, crop_shift=crop_shift)
 
@@ -323,6 +399,55 @@ class CARLA_Data(Dataset):
         data['label'] = label_pad
         data['ego_waypoint'] = ego_waypoint
 
+        self.add_measurements(data, measurements, rad)
+        return data
+
+    def add_raw_inputs(self, data, images, bevs, depths, semantics, lidars, lidars_raw, labels, measurements, degree, crop_shift):
+        """
+        Stores the inputs of the last frame before augmentation, together with the drawn augmentation. BatchAugmenter
+        (batch_augment.py) crops and rotates them and parses the labels for the whole batch on the training device.
+        All arrays but the LiDAR points have a fixed shape, batch_augment.collate_raw pads the points to the largest cloud
+        of the batch.
+        """
+        last = self.seq_len - 1
+        data['rgb_raw'] = images[last]
+        data['bev_raw'] = bevs[last]
+        if self.multitask:
+            data['depth_raw'] = depths[last]
+            data['semantic_raw'] = semantics[last]
+
+        # The alignment is applied on the device. Like in the worker path all points are splatted, only the point
+        # pillars get at most max_lidar_points.
+        lidar = lidars[last]
+        num_points = min(int(self.max_lidar_points), lidar.shape[0]) if self.use_point_pillars else lidar.shape[0]
+        data['lidar_raw_points'] = np.ascontiguousarray(lidar[:num_points, :4], dtype=np.float32)
+        data['num_points'] = num_points
+        data['lidar_matrix'] = align_matrix(measurements[last], measurements[last], degree=degree)
+
+        if lidars_raw is not None:
+            # We don't align the raw LiDARs for now
+            data['bev_points'], data['cam_points'] = lidar_bev_cam_correspondences(deepcopy(lidars_raw[last]), debug=False)
+
+        # Only boxes with LiDAR hits that are inside the LiDAR range for any rotation are kept
+        boxes = np.zeros((MAX_RAW_BOXES, 9), dtype=np.float64)
+        num_boxes = 0
+        for result in labels[last]:
+            x, y = result['position'][0], result['position'][1]
+            if result['num_points'] <= 1 or x * x + y * y >= RAW_BOX_RANGE * RAW_BOX_RANGE or num_boxes == MAX_RAW_BOXES:
+                continue
+            boxes[num_boxes] = result['extent'] + result['position'] + [result['yaw'], result['speed'], result['brake']]
+            num_boxes += 1
+        data['raw_boxes'] = boxes
+        data['num_boxes'] = num_boxes
+
+        ego_id = labels[last][0]['id']
+        waypoints = transform_waypoints(get_waypoints(labels[last:], self.pred_len+1))
+        data['ego_waypoint_raw'] = np.array([matrix[:2, 3] for matrix, flag in waypoints[ego_id][1:]])
+
+        data['aug_degree'] = degree
+        data['crop_shift'] = int(crop_shift)
+
+    def add_measurements(self, data, measurements, rad):
         # other measurement
         # do you use the last frame that already happend or use the next frame?
         data['steer'] = measurements[self.seq_len-1]['steer']
@@ -353,7 +478,150 @@ class CARLA_Data(Dataset):
         data['target_point'] = local_command_point
         
         data['target_point_image'] = draw_target_point(local_command_point)
-        return data
+
+
+# Bump if the content of the route manifests changes, outdated manifests are rewritten.
+MANIFEST_VERSION = 3
+MANIFEST_FILE = "index_manifest.json"
+# Name of the route shard, keep in sync with team_code_autopilot/utils/frame_shards.py
+SHARD_FILE = "frames.tar"
+
+def list_routes(sub_root):
+    """
+    Lists the route directories inside of sub_root.
+    """
+    return [os.path.join(sub_root, folder) for folder in sorted(os.listdir(sub_root))
+            if not os.path.isfile(os.path.join(sub_root, folder))]
+
+def scan_route(route_dir):
+    """
+    Returns the number of frames in route_dir and, for packed routes, the byte ranges of every frame in the shard.
+    The result is cached in a manifest inside the route directory that is keyed on the modification time of the
+    lidar folder (or the shard), so routes that did not change since the last run are not listed again.
+    """
+    shard_file = os.path.join(route_dir, SHARD_FILE)
+    is_shard = os.path.isfile(shard_file)
+    scanned_path = shard_file if is_shard else os.path.join(route_dir, "lidar")
+    manifest_file = os.path.join(route_dir, MANIFEST_FILE)
+    mtime = os.stat(scanned_path).st_mtime_ns
+
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = ujson.load(f)
+        if manifest['version'] == MANIFEST_VERSION and manifest['mtime'] == mtime and manifest['shard'] == is_shard:
+            return route_dir, manifest['num_frames'], manifest['frame_ranges']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if is_shard:
+        frame_ranges = scan_shard(shard_file)
+        # The frame numbers of a shard may start at an offset or have gaps, so they span up to the last frame
+        num_frames = frame_ranges[-1][0] + 1 if len(frame_ranges) > 0 else 0
+    else:
+        frame_ranges = None
+        num_frames = len(os.listdir(scanned_path))
+    manifest = {'version': MANIFEST_VERSION, 'mtime': mtime, 'shard': is_shard, 'num_frames': num_frames,
+                'frame_ranges': frame_ranges}
+    try:
+        # Write to a temporary file first so concurrent training runs never read a partial manifest
+        tmp_file = manifest_file + ".%d.tmp" % os.getpid()
+        with open(tmp_file, 'w') as f:
+            ujson.dump(manifest, f)
+        os.replace(tmp_file, manifest_file)
+    except OSError:
+        pass # The dataset may be read only, in that case we just scan again next time
+
+    return route_dir, num_frames, frame_ranges
+
+def scan_shard(shard_file):
+    """
+    Returns [frame, start, labels_end, end] for every frame of a route shard, sorted by frame number.
+    [start, labels_end) holds the json members of the frame and [start, end) all of its members.
+    """
+    ranges = {}
+    with tarfile.open(shard_file, 'r:') as tar:
+        for member in tar:
+            frame, kind = member.name.split('.')[:2]
+            frame = int(frame)
+            # members are padded to full tar blocks
+            member_end = member.offset_data + (member.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+            if frame not in ranges:
+                ranges[frame] = [member.offset, 0, member_end]
+            ranges[frame][2] = max(ranges[frame][2], member_end)
+            if kind in ('measurements', 'label_raw'):
+                ranges[frame][1] = max(ranges[frame][1], member_end)
+    return [[frame] + ranges[frame] for frame in sorted(ranges)]
+
+def read_shard_frame(shard_file, start, end):
+    """
+    Reads the byte range [start, end) of a shard with a single read and returns the members in it, keyed by their kind.
+    """
+    with open(shard_file, 'rb') as f:
+        f.seek(start)
+        block = f.read(end - start)
+    members = {}
+    with tarfile.open(fileobj=io.BytesIO(block), mode='r:') as tar:
+        for member in tar:
+            members[member.name.split('.')[1]] = tar.extractfile(member).read()
+    return members
+
+def load_json(source):
+    """
+    Loads a json file from a path or from the bytes of a shard member.
+    """
+    if isinstance(source, bytes):
+        return ujson.loads(source)
+    with open(source, 'r') as f:
+        return ujson.load(f)
+
+def load_npy(source):
+    """
+    Loads a npy file from a path or from the bytes of a shard member.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return np.load(source, allow_pickle=True)
+
+def load_lidar(source):
+    """
+    Loads the [N, 4] float32 XYZI points of a LiDAR frame from a path or from the bytes of a shard member.
+    Compact float16 files (see team_code_autopilot/utils/lidar_format.py) are read without pickle,
+    files in the original pickled (frame, points) format are still supported.
+    """
+    try:
+        compact = np.load(io.BytesIO(source) if isinstance(source, bytes) else source)
+    except ValueError: # Object arrays can not be loaded without pickle
+        return load_npy(source)[1]
+
+    if compact.dtype != np.float16:
+        raise ValueError('Unknown LiDAR format with dtype %s' % compact.dtype)
+    # torch converts float16 much faster than numpy
+    return torch.from_numpy(compact).float().numpy()
+
+def load_image(source, flags):
+    """
+    Loads an image from a path or from the bytes of a shard member. Returns None if it could not be decoded.
+    """
+    if source is None:
+        return None
+    if isinstance(source, bytes):
+        return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flags)
+    return cv2.imread(source, flags)
+
+def route_paths(route_dir, folder, pattern, frames):
+    """
+    Returns the paths of the given frames of a route as numpy byte strings with the same shape as frames.
+    """
+    paths = [os.path.join(route_dir, folder, pattern % frame) for frame in frames.flat]
+    return np.array(paths).astype(np.string_).reshape(frames.shape)
+
+def concatenate_paths(paths, num_frames):
+    """
+    Concatenates the per route path arrays into one array of shape [num_samples, num_frames].
+    """
+    if len(paths) == 0:
+        return np.zeros((0, num_frames), dtype=np.string_)
+    return np.concatenate(paths, axis=0)
 
 def get_depth(data):
     """
@@ -408,8 +676,10 @@ def transform_waypoints(waypoints):
             
     return waypoints
 
-def align(lidar_0, measurements_0, measurements_1, degree=0):
-    
+def align_matrix(measurements_0, measurements_1, degree=0):
+    """
+    Transform from the LiDAR frame of measurements_0 to the LiDAR frame of measurements_1, rotated by the augmentation.
+    """
     matrix_0 = measurements_0['ego_matrix']
     matrix_1 = measurements_1['ego_matrix']
 
@@ -427,7 +697,11 @@ def align(lidar_0, measurements_0, measurements_1, degree=0):
                               [-np.sin(rad), np.cos(rad), 0, 0],
                               [0, 0, 1, 0],
                               [0, 0, 0, 1]])
-    transform_0_to_1 = degree_matrix @ transform_0_to_1
+    return degree_matrix @ transform_0_to_1
+
+def align(lidar_0, measurements_0, measurements_1, degree=0):
+
+    transform_0_to_1 = align_matrix(measurements_0, measurements_1, degree=degree)
                             
     lidar = lidar_0.copy()
     lidar[:, -1] = 1.
@@ -447,27 +721,7 @@ def lidar_to_histogram_features(lidar):
     """
     Convert LiDAR point cloud into 2-bin histogram over 256x256 grid
     """
-    def splat_points(point_cloud):
-        # 256 x 256 grid
-        pixels_per_meter = 8
-        hist_max_per_pixel = 5
-        x_meters_max = 16
-        y_meters_max = 32
-        xbins = np.linspace(-x_meters_max, x_meters_max, 32*pixels_per_meter+1)
-        ybins = np.linspace(-y_meters_max, 0, 32*pixels_per_meter+1)
-        hist = np.histogramdd(point_cloud[..., :2], bins=(xbins, ybins))[0]
-        hist[hist>hist_max_per_pixel] = hist_max_per_pixel
-        overhead_splat = hist/hist_max_per_pixel
-        return overhead_splat
-
-    below = lidar[lidar[...,2]<=-2.3]
-    above = lidar[lidar[...,2]>-2.3]
-    below_features = splat_points(below)
-    above_features = splat_points(above)
-    features = np.stack([above_features, below_features], axis=-1)
-    features = np.transpose(features, (2, 0, 1)).astype(np.float32)
-    features = np.rot90(features, -1, axes=(1,2)).copy()
-    return features
+    return LIDAR_SPLATTER(lidar)
 
 def get_bbox_label(bbox, rad=0):
     # dx, dy, dz, x, y, z, yaw
@@ -629,50 +883,26 @@ def draw_target_point(target_point, color = (255, 255, 255)):
     image = image.reshape(1, 256, 256)
     return image.astype(np.float) / 255.
 
-def correspondences_at_one_scale(valid_bev_points, valid_cam_points, lidar_x, lidar_y, camera_x, camera_y, scale):
+def correspondences_at_one_scale(valid_bev_points, valid_cam_points, lidar_x, lidar_y, camera_x, camera_y, scale, device=None):
     """
     Compute projections between LiDAR BEV and image space
+    If device is given the sampling runs with torch on that device and tensors are returned.
     """
-    cam_to_bev_proj_locs = np.zeros((lidar_x, lidar_y, 5, 2))
-    bev_to_cam_proj_locs = np.zeros((camera_x, camera_y, 5, 2))
-
-    tmp_bev = np.empty((lidar_x, lidar_y, ), dtype=object)
-    tmp_cam = np.empty((camera_x, camera_y, ), dtype=object)
-    for i in range(lidar_x):
-        for j in range(lidar_y):
-            tmp_bev[i,j] = []
-
-    for i in range(camera_x):
-        for j in range(camera_y):
-            tmp_cam[i, j] = []
-
-    for i in range(valid_bev_points.shape[0]):
-        tmp_bev[valid_bev_points[i][0]//scale, valid_bev_points[i][1]//scale].append(valid_cam_points[i]//scale)
-        tmp_cam[valid_cam_points[i][0]//scale, valid_cam_points[i][1]//scale].append(valid_bev_points[i]//scale)
-
-    for i in range(lidar_x):
-        for j in range(lidar_y):
-            cam_to_bev_points = tmp_bev[i,j]
-
-            if len(cam_to_bev_points) > 5:
-                cam_to_bev_proj_locs[i,j] = np.array(random.sample(cam_to_bev_points, 5))
-            elif len(cam_to_bev_points) > 0:
-                num_points = len(cam_to_bev_points)
-                cam_to_bev_proj_locs[i,j,:num_points] = np.array(cam_to_bev_points)
-
-    for i in range(camera_x):
-        for j in range(camera_y):
-            bev_to_cam_points = tmp_cam[i,j]
-
-            if len(bev_to_cam_points) > 5:
-                bev_to_cam_proj_locs[i,j] = np.array(random.sample(bev_to_cam_points, 5))
-            elif len(bev_to_cam_points) > 0:
-                num_points = len(bev_to_cam_points)
-                bev_to_cam_proj_locs[i,j,:num_points] = np.array(bev_to_cam_points)
+    valid_bev_points = np.asarray(valid_bev_points, dtype=np.int64).reshape(-1, 2) // scale
+    valid_cam_points = np.asarray(valid_cam_points, dtype=np.int64).reshape(-1, 2) // scale
+
+    if device is not None:
+        valid_bev_points = torch.from_numpy(valid_bev_points).to(device)
+        valid_cam_points = torch.from_numpy(valid_cam_points).to(device)
+        cam_to_bev_proj_locs = sample_cell_points_torch(valid_bev_points, valid_cam_points, lidar_x, lidar_y)
+        bev_to_cam_proj_locs = sample_cell_points_torch(valid_cam_points, valid_bev_points, camera_x, camera_y)
+    else:
+        cam_to_bev_proj_locs = sample_cell_points(valid_bev_points, valid_cam_points, lidar_x, lidar_y)
+        bev_to_cam_proj_locs = sample_cell_points(valid_cam_points, valid_bev_points, camera_x, camera_y)
 
     return cam_to_bev_proj_locs, bev_to_cam_proj_locs
 
-def lidar_bev_cam_correspondences(world, lidar_vis=None, image_vis=None, step=None, debug=False):
+def lidar_bev_cam_correspondences(world, lidar_vis=None, image_vis=None, step=None, debug=False, device=None):
     """
     Convert LiDAR point cloud to camera co-ordinates
 
@@ -681,6 +911,7 @@ def lidar_bev_cam_correspondences(world, lidar_vis=None, image_vis=None, step=No
     image_vis: RGB input image to the network
     step: current timestep
     debug: Whether to save the debug images. If false only world is required
+    device: If given, the correspondences are sampled with torch on this device and returned as tensors
     """
 
     pixels_per_meter = 8
@@ -797,27 +1028,23 @@ def lidar_bev_cam_correspondences(world, lidar_vis=None, image_vis=None, step=No
         vis_original_lidar[np.greater(lidar_vis[0,1], 0)] = 255
 
 
-    valid_bev_points = []
-    valid_cam_points = []
-    for i in range(results_total.shape[0]):
-        # Project the LiDAR point to BEV and save index of the BEV image pixel.
-        lidar_index = int(results_total[i, 2])
-        bev_x = int((lidar[lidar_index][0] + lidar_meters_x) * pixels_per_meter)
-        # The network input images use a top left coordinate system, we need to convert the bottom left coordinates by inverting the y axis
-        bev_y = (int(lidar[lidar_index][1] * pixels_per_meter) - (lidar_height-1)) * -1
-
-        valid_bev_points.append([bev_x, bev_y])
-        # Calculate index in the final image by rounding down
-        img_x = int(results_total[i][0])
-        # The network input images use a top left coordinate system, we need to convert the bottom left coordinates by inverting the y axis
-        img_y = (int(results_total[i][1]) - (img_height - 1)) * -1
-        valid_cam_points.append([img_x, img_y])
+    # Project the LiDAR points to BEV and save index of the BEV image pixel.
+    lidar_indices = results_total[:, 2].astype(np.int64)
+    bev_x = ((lidar[lidar_indices, 0] + lidar_meters_x) * pixels_per_meter).astype(np.int64)
+    # The network input images use a top left coordinate system, we need to convert the bottom left coordinates by inverting the y axis
+    bev_y = ((lidar[lidar_indices, 1] * pixels_per_meter).astype(np.int64) - (lidar_height-1)) * -1
+    valid_bev_points = np.stack([bev_x, bev_y], axis=1)
 
+    # Calculate index in the final image by rounding down
+    img_x = results_total[:, 0].astype(np.int64)
+    # The network input images use a top left coordinate system, we need to convert the bottom left coordinates by inverting the y axis
+    img_y = (results_total[:, 1].astype(np.int64) - (img_height - 1)) * -1
+    valid_cam_points = np.stack([img_x, img_y], axis=1)
 
-        if (debug == True):
-            vis_original_image[img_y, img_x] = np.array([0.0,1.0,0.0])
-            vis_bev[bev_y, bev_x] = 255 #Debug visualization
-            vis[img_y, img_x] = 255
+    if (debug == True):
+        vis_original_image[img_y, img_x] = np.array([0.0,1.0,0.0])
+        vis_bev[bev_y, bev_x] = 255 #Debug visualization
+        vis[img_y, img_x] = 255
 
     if (debug == True):
         # NOTE add the paths you want the images to land in here before debugging
@@ -832,12 +1059,9 @@ def lidar_bev_cam_correspondences(world, lidar_vis=None, image_vis=None, step=No
         plt.ioff()
 
 
-    valid_bev_points = np.array(valid_bev_points)
-    valid_cam_points = np.array(valid_cam_points)
-
     bev_points, cam_points = correspondences_at_one_scale(valid_bev_points, valid_cam_points,  (lidar_width // downscale_factor),
                                                           (lidar_height // downscale_factor), (img_width // downscale_factor) * 2,
-                                                          (img_height // downscale_factor), downscale_factor)
+                                                          (img_height // downscale_factor), downscale_factor, device=device)
 
     return bev_points, cam_points
 
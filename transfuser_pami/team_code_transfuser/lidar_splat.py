@@ -0,0 +1,174 @@
+"""
+Splats LiDAR point clouds into the 2 channel BEV histogram used as LiDAR input of the models.
+Both height channels are computed with a single bincount over integer cell indices, and the indices are computed for the
+final orientation, so no intermediate histogram, stack or rot90 copy is needed.
+There is a NumPy path for the data loader and a torch path that runs on the device of the points.
+Also holds the per cell point sampling of the LiDAR-camera correspondences of geometric fusion.
+This module is shared by team_code_transfuser and the transfuser, late_fusion and geometric_fusion training directories,
+leaderboard/team_code/transfuser_pami/lidar_splat.py is a copy of it for the agents, keep them in sync.
+"""
+
+import numpy as np
+import torch
+
+
+class LidarSplatter(object):
+    """
+    Histogram of the points above and below a height threshold over a regular x/y grid.
+    The bins follow np.histogramdd: every bin is closed on the left and the last bin is also closed on the right.
+    With rotate=True the output shape is [2, num_y_bins, num_x_bins] (channel 0: above, channel 1: below). Rows go from
+    min y to max y and columns from max x to min x, which is the orientation of np.rot90(histogram, -1, axes=(1,2)) that
+    the transfuser_pami models were trained with.
+    With rotate=False the output is the stacked np.histogramdd layout of the original TransFuser, late fusion and geometric
+    fusion models: [2, num_x_bins, num_y_bins] (channel 0: below, channel 1: above).
+    num_x and num_y default to pixels_per_meter bins per meter.
+    """
+
+    def __init__(self, x_min=-16.0, x_max=16.0, y_min=-32.0, y_max=0.0, pixels_per_meter=8, height_threshold=-2.3, hist_max_per_pixel=5,
+                 num_x=None, num_y=None, rotate=True):
+        self.num_x = int(round((x_max - x_min) * pixels_per_meter)) if num_x is None else num_x
+        self.num_y = int(round((y_max - y_min) * pixels_per_meter)) if num_y is None else num_y
+        self.x_edges = np.linspace(x_min, x_max, self.num_x + 1)
+        self.y_edges = np.linspace(y_min, y_max, self.num_y + 1)
+        self.height_threshold = height_threshold
+        self.hist_max_per_pixel = hist_max_per_pixel
+        self.rotate = rotate
+        self.shape = (2, self.num_y, self.num_x) if rotate else (2, self.num_x, self.num_y)
+        self.num_cells = 2 * self.num_y * self.num_x
+        self._torch_edges = {} # device -> (x_edges, y_edges)
+
+    def __call__(self, lidar):
+        """
+        Splat a single [N, >=3] point cloud. Returns a float32 array of shape self.shape.
+        """
+        return self.splat_batch([lidar])[0]
+
+    def splat_batch(self, lidars):
+        """
+        Splat a list of [N_i, >=3] point clouds with one bincount. Returns a float32 array of shape [B, *self.shape].
+        """
+        if len(lidars) == 0:
+            return np.zeros((0,) + self.shape, dtype=np.float32)
+
+        indices = []
+        for batch_idx, lidar in enumerate(lidars):
+            cell, valid = self._cell_indices_np(lidar)
+            indices.append(cell[valid] + batch_idx * self.num_cells)
+        indices = np.concatenate(indices)
+
+        hist = np.bincount(indices, minlength=len(lidars) * self.num_cells).astype(np.float32)
+        np.minimum(hist, self.hist_max_per_pixel, out=hist)
+        hist /= self.hist_max_per_pixel
+        return hist.reshape((len(lidars),) + self.shape)
+
+    def splat_torch(self, points, num_points=None):
+        """
+        Splat a batch of point clouds on their device.
+        points: [B, N, >=3] tensor, num_points: optional [B] tensor with the number of valid (non padding) points.
+        Returns a float32 tensor of shape [B, *self.shape].
+        """
+        batch_size, max_points = points.shape[0], points.shape[1]
+        x_edges, y_edges = self._get_torch_edges(points.device)
+
+        x = points[..., 0].to(x_edges.dtype)
+        y = points[..., 1].to(y_edges.dtype)
+        x_bin = self._bin_torch(x, x_edges)
+        y_bin = self._bin_torch(y, y_edges)
+        valid = (x_bin >= 0) & (x_bin < self.num_x) & (y_bin >= 0) & (y_bin < self.num_y)
+        valid &= ~torch.isnan(points[..., 2])
+        if num_points is not None:
+            valid &= torch.arange(max_points, device=points.device)[None, :] < num_points.to(points.device)[:, None]
+
+        cell = self._cell(x_bin, y_bin, points[..., 2] <= self.height_threshold)
+        cell = cell + torch.arange(batch_size, device=points.device)[:, None] * self.num_cells
+
+        hist = torch.bincount(cell[valid], minlength=batch_size * self.num_cells).float()
+        hist = torch.clamp(hist, max=self.hist_max_per_pixel) / self.hist_max_per_pixel
+        return hist.view((batch_size,) + self.shape)
+
+    def _cell_indices_np(self, lidar):
+        x_bin = self._bin_np(lidar[:, 0], self.x_edges)
+        y_bin = self._bin_np(lidar[:, 1], self.y_edges)
+        valid = (x_bin >= 0) & (x_bin < self.num_x) & (y_bin >= 0) & (y_bin < self.num_y)
+        # points with an undefined height are in neither channel
+        valid &= ~np.isnan(lidar[:, 2])
+        cell = self._cell(x_bin, y_bin, lidar[:, 2] <= self.height_threshold)
+        return cell, valid
+
+    def _cell(self, x_bin, y_bin, below):
+        # Flat index into the output, works for NumPy arrays and torch tensors
+        if self.rotate:
+            return below * (self.num_y * self.num_x) + y_bin * self.num_x + (self.num_x - 1 - x_bin)
+        return ~below * (self.num_x * self.num_y) + x_bin * self.num_y + y_bin
+
+    @staticmethod
+    def _bin_np(values, edges):
+        # Same binning rule as np.histogramdd, values outside of the edges get -1 or len(edges) - 1
+        bins = np.searchsorted(edges, values, side='right') - 1
+        bins[values == edges[-1]] -= 1
+        return bins
+
+    @staticmethod
+    def _bin_torch(values, edges):
+        bins = torch.bucketize(values.contiguous(), edges, right=True) - 1
+        return bins - (values == edges[-1]).long()
+
+    def _get_torch_edges(self, device):
+        if device not in self._torch_edges:
+            self._torch_edges[device] = (torch.from_numpy(self.x_edges).to(device),
+                                         torch.from_numpy(self.y_edges).to(device))
+        return self._torch_edges[device]
+
+
+def sample_cell_points(cells, values, grid_x, grid_y, max_points=5):
+    """
+    Groups values by the grid cell they belong to and stores up to max_points values per cell.
+    Cells with more points get a uniform random subset (random keys + sort, which is equivalent to reservoir sampling),
+    cells with fewer points keep their points in input order and are padded with zeros.
+    cells: [N, 2] integer cell coordinates, values: [N, 2]. Returns [grid_x, grid_y, max_points, 2].
+    """
+    locs = np.zeros((grid_x, grid_y, max_points, 2))
+    if len(cells) == 0:
+        return locs
+
+    cell_ids = cells[:, 0] * grid_y + cells[:, 1]
+    _, inverse, counts = np.unique(cell_ids, return_inverse=True, return_counts=True)
+    # Inside of full cells the order is random, everywhere else it stays the input order
+    keys = np.where(counts[inverse] > max_points, np.random.random(len(cell_ids)), np.arange(len(cell_ids)) / len(cell_ids))
+    order = np.lexsort((keys, cell_ids))
+
+    sorted_ids = cell_ids[order]
+    cell_starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    rank = np.arange(len(order)) - np.repeat(cell_starts, np.diff(np.r_[cell_starts, len(order)]))
+    keep = rank < max_points
+
+    kept = order[keep]
+    locs[cells[kept, 0], cells[kept, 1], rank[keep]] = values[kept]
+    return locs
+
+
+def sample_cell_points_torch(cells, values, grid_x, grid_y, max_points=5):
+    """
+    Same as sample_cell_points but for torch tensors, runs on the device of cells.
+    """
+    locs = torch.zeros((grid_x, grid_y, max_points, 2), dtype=torch.float64, device=cells.device)
+    if len(cells) == 0:
+        return locs
+
+    num_points = len(cells)
+    cell_ids = cells[:, 0] * grid_y + cells[:, 1]
+    _, inverse, counts = torch.unique(cell_ids, return_inverse=True, return_counts=True)
+    keys = torch.where(counts[inverse] > max_points, torch.rand(num_points, dtype=torch.float64, device=cells.device),
+                       torch.arange(num_points, dtype=torch.float64, device=cells.device) / num_points)
+    # keys are in [0, 1), so adding the cell id sorts by cell first
+    order = torch.argsort(cell_ids.double() + keys)
+
+    sorted_ids = cell_ids[order]
+    _, cell_counts = torch.unique_consecutive(sorted_ids, return_counts=True)
+    cell_starts = torch.cumsum(cell_counts, 0) - cell_counts
+    rank = torch.arange(num_points, device=cells.device) - torch.repeat_interleave(cell_starts, cell_counts)
+    keep = rank < max_points
+
+    kept = order[keep]
+    locs[cells[kept, 0], cells[kept, 1], rank[keep]] = values[kept].double()
+    return locs
@@ -0,0 +1,213 @@
+"""
+Cache for the decoded camera frames (rgb, bev, depth, semantics) of CARLA_Data.
+Decoding the PNGs dominates the data loading time once the files are in the page cache, so the decoded arrays are kept in
+a memory-mapped slab with fixed-size slots that is shared by all DataLoader workers (they are forked from the process that
+created the cache). Hits are returned as read-only views into the slab, so nothing is copied, decoded or unpickled.
+Every frame of the dataset has an integer key; a key table maps it to its slot. When the slab is full, the least recently
+used slot is evicted. The arrays are stored before the random crop of the augmentation, so every epoch can reuse them.
+A slot is pinned while views of it (or arrays derived from them, e.g. crops that end up in a batch) are alive, pinned slots
+are never replaced. The shared lock only guards the key table, the pins and the LRU times, slots are copied without it.
+"""
+
+import os
+import time
+import shutil
+import weakref
+import warnings
+import tempfile
+import multiprocessing
+
+import numpy as np
+import torch
+
+SLOT_ALIGNMENT = 64
+# Key table entry of a frame that is not cached, and of one that a worker is writing into its slot
+NOT_CACHED = -1
+WRITING = -2
+
+# The default collate wraps the read-only cached arrays with torch.as_tensor before it stacks (copies) them
+warnings.filterwarnings('ignore', message='The given NumPy array is not writable')
+
+
+class SlotLease(np.ndarray):
+    """
+    The bytes of a pinned slot. All views of a hit refer to it, the pin is released when the last of them is gone.
+    """
+
+
+class SampleCache(object):
+    """
+    size_limit: Size of the slab in bytes, this bounds the number of cached frames.
+    directory: Where the slab is stored. Use a fast local disk or a tmpfs such as /dev/shm, default is the system tmp dir.
+    max_workers: Number of DataLoader workers that get their own hit/miss counter.
+    """
+
+    def __init__(self, size_limit, directory=None, max_workers=32):
+        self.size_limit = int(size_limit)
+        self.directory = tempfile.mkdtemp(prefix='sample_cache_', dir=directory)
+        self.max_workers = max_workers
+        self.layout = None # name -> (shape, dtype, byte offset in a slot)
+        self.slot_bytes = 0
+        self.num_slots = 0
+        self.num_keys = 0
+        # Created before the workers are forked, so it is shared by all of them
+        self._lock = multiprocessing.Lock()
+        self._maps = None
+        self._maps_key = None
+
+    def reserve(self, num_keys):
+        """
+        Reserves num_keys consecutive keys and returns the first one. Every dataset that uses the cache reserves its frames
+        once, before any data is loaded.
+        """
+        base = self.num_keys
+        if num_keys > 0:
+            # Only the new keys are appended, the entries of the datasets that reserved before are kept
+            with open(os.path.join(self.directory, 'keys.bin'), 'ab') as f:
+                f.write(np.full(num_keys, NOT_CACHED, dtype=np.int64).tobytes())
+            self.num_keys += num_keys
+        return base
+
+    def set_layout(self, arrays):
+        """
+        Fixes the slot layout from the decoded arrays of one frame (dict name -> array) and allocates the slab.
+        Frames whose arrays do not match the layout are not cached.
+        """
+        layout = {}
+        offset = 0
+        for name, array in arrays.items():
+            if array is None:
+                continue
+            layout[name] = (tuple(array.shape), np.dtype(array.dtype).str, offset)
+            offset += -(-array.nbytes // SLOT_ALIGNMENT) * SLOT_ALIGNMENT
+        if self.layout is not None:
+            if layout != self.layout:
+                raise ValueError('All datasets that share a SampleCache need the same frame layout.')
+            return
+
+        self.layout = layout
+        self.slot_bytes = offset
+        self.num_slots = self.size_limit // max(self.slot_bytes, 1)
+        print('Sample cache: %d slots of %.2f MB in %s' % (self.num_slots, self.slot_bytes / 1024 ** 2, self.directory))
+
+        # Sparse files, the pages are only allocated when a slot is written
+        with open(os.path.join(self.directory, 'slab.bin'), 'wb') as f:
+            f.truncate(max(self.num_slots * self.slot_bytes, 1))
+        owners = np.memmap(os.path.join(self.directory, 'owners.bin'), dtype=np.int64, mode='w+', shape=(max(self.num_slots, 1),))
+        owners[:] = -1
+        owners.flush()
+        np.memmap(os.path.join(self.directory, 'pins.bin'), dtype=np.int64, mode='w+', shape=(max(self.num_slots, 1),)).flush()
+        np.memmap(os.path.join(self.directory, 'last_used.bin'), dtype=np.int64, mode='w+', shape=(max(self.num_slots, 1),)).flush()
+        np.memmap(os.path.join(self.directory, 'counters.bin'), dtype=np.int64, mode='w+', shape=(self.max_workers + 1, 2)).flush()
+
+    def get(self, key):
+        """
+        Returns the cached arrays of key as read-only views into the slab, or None on a miss.
+        The slot stays pinned until the views and all arrays derived from them are released.
+        """
+        maps = self._open()
+        if maps is None:
+            return None
+        with self._lock:
+            slot = maps['keys'][key]
+            hit = slot >= 0 and maps['owners'][slot] == key
+            if hit:
+                maps['pins'][slot] += 1
+                # A slot that was just read is the most recently used one, so it is only reused after all other slots were replaced
+                maps['last_used'][slot] = time.monotonic_ns()
+        self._count(maps, 0 if hit else 1)
+        if not hit:
+            return None
+
+        start = slot * self.slot_bytes
+        lease = maps['slab'][start:start + self.slot_bytes].view(SlotLease)
+        weakref.finalize(lease, self._unpin, slot)
+        return self._views(lease, 0)
+
+    def put(self, key, arrays):
+        maps = self._open()
+        if maps is None or self.num_slots == 0:
+            return
+        for name, (shape, dtype, _) in self.layout.items():
+            array = arrays.get(name)
+            if array is None or tuple(array.shape) != shape or array.dtype.str != dtype:
+                return
+
+        with self._lock:
+            if maps['keys'][key] != NOT_CACHED: # Another worker was faster
+                return
+            free = np.flatnonzero(maps['owners'] < 0)
+            if len(free) > 0:
+                slot = free[0]
+            else:
+                # Slots that are still read are not replaced
+                slot = np.argmin(np.where(maps['pins'] > 0, np.iinfo(np.int64).max, maps['last_used']))
+                if maps['pins'][slot] > 0:
+                    return
+            old_key = maps['owners'][slot]
+            if old_key >= 0:
+                maps['keys'][old_key] = NOT_CACHED
+            maps['owners'][slot] = key
+            maps['pins'][slot] = 1 # The writer, so the slot is not replaced before it is published
+            maps['keys'][key] = WRITING
+
+        for name, view in self._views(maps['slab_writer'], slot * self.slot_bytes).items():
+            view[...] = arrays[name]
+
+        with self._lock:
+            maps['pins'][slot] -= 1
+            maps['last_used'][slot] = time.monotonic_ns()
+            maps['keys'][key] = slot # Publish the slot only after it is written
+
+    def stats(self):
+        """
+        Returns (hits, misses) summed over all workers since the last reset_stats.
+        """
+        maps = self._open()
+        if maps is None:
+            return 0, 0
+        hits, misses = maps['counters'].sum(axis=0)
+        return int(hits), int(misses)
+
+    def reset_stats(self):
+        maps = self._open()
+        if maps is not None:
+            maps['counters'][:] = 0
+
+    def close(self):
+        self._maps = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _open(self):
+        # The memory maps are opened lazily in every process, the workers all map the same files
+        if self.layout is None:
+            return None
+        maps_key = (os.getpid(), self.num_keys, self.num_slots)
+        if self._maps_key != maps_key:
+            self._maps = {
+                # Hits are views of a read-only map of the slab, slots are written through slab_writer in put
+                'slab': np.memmap(os.path.join(self.directory, 'slab.bin'), dtype=np.uint8, mode='r'),
+                'slab_writer': np.memmap(os.path.join(self.directory, 'slab.bin'), dtype=np.uint8, mode='r+'),
+                'keys': np.memmap(os.path.join(self.directory, 'keys.bin'), dtype=np.int64, mode='r+'),
+                'owners': np.memmap(os.path.join(self.directory, 'owners.bin'), dtype=np.int64, mode='r+'),
+                'pins': np.memmap(os.path.join(self.directory, 'pins.bin'), dtype=np.int64, mode='r+'),
+                'last_used': np.memmap(os.path.join(self.directory, 'last_used.bin'), dtype=np.int64, mode='r+'),
+                'counters': np.memmap(os.path.join(self.directory, 'counters.bin'), dtype=np.int64, mode='r+').reshape(-1, 2),
+            }
+            self._maps_key = maps_key
+        return self._maps
+
+    def _views(self, buffer, start):
+        return {name: np.ndarray(shape, dtype=dtype, buffer=buffer, offset=start + offset)
+                for name, (shape, dtype, offset) in self.layout.items()}
+
+    def _unpin(self, slot):
+        maps = self._open()
+        if maps is not None:
+            with self._lock:
+                maps['pins'][slot] -= 1
+
+    def _count(self, maps, column):
+        worker_info = torch.utils.data.get_worker_info()
+        row = 0 if worker_info is None else 1 + worker_info.id % self.max_workers
+        maps['counters'][row, column] += 1
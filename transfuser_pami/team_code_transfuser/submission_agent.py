@@ -14,12 +14,13 @@ import math
 from leaderboard.autoagents import autonomous_agent
 from model import LidarCenterNet
 from config import GlobalConfig
-from data import lidar_to_histogram_features, draw_target_point, lidar_bev_cam_correspondences
+from data import LIDAR_SPLATTER, draw_target_point, lidar_bev_cam_correspondences
 
 from shapely.geometry import Polygon
 
 import itertools
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 SAVE_PATH = os.environ.get('SAVE_PATH')
 
 if not SAVE_PATH:
@@ -104,6 +105,17 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
 
         self.use_lidar_safe_check = True
         self.aug_degrees = [0] # Test time data augmentation. Unused we only augment by 0 degree.
+        # Inverse rotation of every test time augmentation, applied to the waypoints as wp @ matrix
+        aug_rads = np.deg2rad(self.aug_degrees)
+        self.aug_inverse_rotations = torch.tensor(np.array([[[np.cos(rad), np.sin(rad)], [-np.sin(rad), np.cos(rad)]] for rad in aug_rads]),
+                                                  dtype=torch.float32, device='cuda')
+
+        # Every model of the ensemble runs in its own thread on its own CUDA stream. forward_ego synchronizes with the
+        # host to read the bounding boxes, so a single thread would serialize the models.
+        self.ensemble_streams = None
+        if self.config.ensemble_streams and self.model_count > 1:
+            self.ensemble_streams = [torch.cuda.Stream() for _ in range(self.model_count)]
+            self.ensemble_pool = ThreadPoolExecutor(max_workers=self.model_count)
         self.steer_damping = self.config.steer_damping
         self.rgb_back = None #For debugging
 
@@ -313,35 +325,28 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
 
 
         # forward pass
-        with torch.no_grad():
-            pred_wps = []
-            bounding_boxes = []
-            for i in range(self.model_count):
-                rotated_bb = []
-                if (self.backbone == 'transFuser'):
-                    pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity,
-                                                          num_points=num_points, save_path=SAVE_PATH, stuck_detector=self.stuck_detector,
-                                                          forced_move=is_stuck, debug=self.config.debug, rgb_back=self.rgb_back)
-                elif (self.backbone == 'late_fusion'):
-                    pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, num_points=num_points)
-                elif (self.backbone == 'geometric_fusion'):
-                    bev_points = list()
-                    cam_points = list()
-
-                    curr_bev_points, curr_cam_points = lidar_bev_cam_correspondences(deepcopy(tick_data['lidar']), lidar_bev, image, self.step, False)
-                    bev_points.append(torch.from_numpy(curr_bev_points).unsqueeze(0))
-                    cam_points.append(torch.from_numpy(curr_cam_points).unsqueeze(0))
-
-                    bev_points = bev_points[0].long().to('cuda', dtype=torch.int64)
-                    cam_points = cam_points[0].long().to('cuda', dtype=torch.int64)
-                    pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, bev_points, cam_points, num_points=num_points)
-                elif (self.backbone == 'latentTF'):
-                    pred_wp, rotated_bb = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, num_points=num_points)
-                else:
-                    raise ("The chosen vision backbone does not exist. The options are: transFuser, late_fusion, geometric_fusion, latentTF")
-
-                pred_wps.append(pred_wp)
-                bounding_boxes.append(rotated_bb)
+        bev_points, cam_points = None, None
+        if (self.backbone == 'geometric_fusion'):
+            # The correspondences are the same for every model of the ensemble
+            bev_points, cam_points = lidar_bev_cam_correspondences(deepcopy(tick_data['lidar']), lidar_bev, image, self.step, False, device='cuda')
+            bev_points = bev_points.unsqueeze(0).to('cuda', dtype=torch.int64)
+            cam_points = cam_points.unsqueeze(0).to('cuda', dtype=torch.int64)
+
+        inputs = (image, lidar_bev, target_point, target_point_image, velocity, bev_points, cam_points, num_points, is_stuck)
+        if self.ensemble_streams is None:
+            outputs = [self.forward_net(i, *inputs) for i in range(self.model_count)]
+        else:
+            main_stream = torch.cuda.current_stream()
+            for stream in self.ensemble_streams:
+                stream.wait_stream(main_stream)
+            jobs = [self.ensemble_pool.submit(self.forward_net, i, *inputs, stream=self.ensemble_streams[i]) for i in range(self.model_count)]
+            outputs = [job.result() for job in jobs]
+            for stream in self.ensemble_streams:
+                main_stream.wait_stream(stream)
+            for pred_wp, _ in outputs:
+                pred_wp.record_stream(main_stream) # Allocated on a side stream but used on the main stream
+        pred_wps = [pred_wp for pred_wp, _ in outputs]
+        bounding_boxes = [rotated_bb for _, rotated_bb in outputs]
 
         bbs_vehicle_coordinate_system = self.non_maximum_suppression(bounding_boxes, self.iou_treshold_nms)
 
@@ -349,19 +354,9 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
         self.pred_wp = torch.stack(pred_wps, dim=0).mean(dim=0) #Average the predictions from the ensembles
 
         # transform to local coordinates
-        pred_wp_transformed = []
-        for i, degree in enumerate(self.aug_degrees):
-            rad = np.deg2rad(degree)
-            degree_matrix = np.array([[np.cos(rad), np.sin(rad)],
-                                [-np.sin(rad), np.cos(rad)]])
-            # inverse
-            degree_matrix = degree_matrix.T
-            cur_pred_wp = self.pred_wp[i].detach().cpu().numpy()
-            transformed_wp = (degree_matrix @ cur_pred_wp.T).T
-            pred_wp_transformed.append(transformed_wp)
-
-        self.pred_wp = np.stack(pred_wp_transformed, axis=0)
-        self.pred_wp = torch.median(torch.from_numpy(self.pred_wp).to('cuda', dtype=torch.float32), dim=0, keepdims=True)[0]
+        num_augs = len(self.aug_degrees)
+        pred_wp_transformed = torch.bmm(self.pred_wp[:num_augs].float(), self.aug_inverse_rotations)
+        self.pred_wp = torch.median(pred_wp_transformed, dim=0, keepdim=True)[0]
 
         if (self.backbone == 'latentTF'):
             safety_box = []
@@ -418,6 +413,27 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
         self.update_gps_buffer(self.control, tick_data['compass'], tick_data['speed'])
         return control
 
+    def forward_net(self, i, image, lidar_bev, target_point, target_point_image, velocity, bev_points, cam_points, num_points, is_stuck, stream=None):
+        """
+        Runs model i of the ensemble. When a stream is given the model is executed on it, the caller has to synchronize.
+        """
+        with torch.no_grad(), torch.cuda.stream(stream):
+            rotated_bb = []
+            if (self.backbone == 'transFuser'):
+                pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity,
+                                                      num_points=num_points, save_path=SAVE_PATH, stuck_detector=self.stuck_detector,
+                                                      forced_move=is_stuck, debug=self.config.debug, rgb_back=self.rgb_back)
+            elif (self.backbone == 'late_fusion'):
+                pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, num_points=num_points)
+            elif (self.backbone == 'geometric_fusion'):
+                pred_wp, _ = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, bev_points, cam_points, num_points=num_points)
+            elif (self.backbone == 'latentTF'):
+                pred_wp, rotated_bb = self.nets[i].forward_ego(image, lidar_bev, target_point, target_point_image, velocity, num_points=num_points)
+            else:
+                raise ("The chosen vision backbone does not exist. The options are: transFuser, late_fusion, geometric_fusion, latentTF")
+
+        return pred_wp, rotated_bb
+
     def bb_detected_in_front_of_vehicle(self, ego_speed):
         if (len(self.bb_buffer) < 1):  # We only start after we have 4 time steps.
             return False
@@ -564,11 +580,10 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
 
 
     def prepare_lidar(self, tick_data):
-        lidar_transformed = deepcopy(tick_data['lidar']) 
+        # Splat on the GPU, only the raw points are copied to the device
+        lidar_transformed = torch.from_numpy(tick_data['lidar']).to('cuda')
         lidar_transformed[:, 1] *= -1  # invert
-        lidar_transformed = torch.from_numpy(lidar_to_histogram_features(lidar_transformed)).unsqueeze(0)
-        lidar_transformed_degrees = [lidar_transformed.to('cuda', dtype=torch.float32)]
-        lidar_bev = torch.cat(lidar_transformed_degrees[::-1], dim=1)
+        lidar_bev = LIDAR_SPLATTER.splat_torch(lidar_transformed.unsqueeze(0))
         return lidar_bev
 
     def prepare_goal_location(self, tick_data):
@@ -623,6 +638,8 @@ class HybridAgent(autonomous_agent.AutonomousAgent):
         return cropped_image
 
     def destroy(self):
+        if self.ensemble_streams is not None:
+            self.ensemble_pool.shutdown()
         del self.nets
 
 # Taken from LBC
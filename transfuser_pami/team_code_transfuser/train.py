@@ -17,6 +17,8 @@ from torch.utils.tensorboard import SummaryWriter
 from config import GlobalConfig
 from model import LidarCenterNet
 from data import CARLA_Data, lidar_bev_cam_correspondences
+from sample_cache import SampleCache
+from batch_augment import BatchAugmenter, collate_raw
 
 import pathlib
 import datetime
@@ -74,6 +76,9 @@ def main():
     parser.add_argument('--zero_redundancy_optimizer', type=int, default=0, help='0: Normal AdamW Optimizer, 1: Use Zero Reduncdancy Optimizer to reduce memory footprint. Only use with --parallel_training 1')
     parser.add_argument('--use_disk_cache', type=int, default=0, help='0: Do not cache the dataset 1: Cache the dataset on the disk pointed to by the SCRATCH enironment variable. Useful if the dataset is stored on slow HDDs and can be temporarily stored on faster SSD storage.')
 
+    parser.add_argument('--sample_cache_size', type=float, default=0, help='Size in GB of the cache for decoded camera frames that is shared by the data loader workers. 0: Disable the cache. The frames are not decoded again while they are in the cache.')
+    parser.add_argument('--sample_cache_dir', type=str, default=None, help='Directory of the decoded frame cache. Use fast storage such as /dev/shm or a local SSD. Default is the system tmp dir.')
+    parser.add_argument('--device_augment', type=int, default=0, help='0: Augment and parse the labels in the data loader workers, 1: Do it batched on the GPU. Frees the workers from the BEV rotation and the label parsing.')
     parser.add_argument('--wandb', action="store_true", default=False, help='True to log to wandb otherwise False')
     parser.add_argument('--gpu_id', type=int, default=0, help='The GPU number to use')
 
@@ -135,6 +140,7 @@ def main():
     config.n_layer = args.n_layer
     config.use_point_pillars = bool(args.use_point_pillars)
     config.backbone = args.backbone
+    config.device_augment = bool(args.device_augment)
     if(bool(args.no_bev_loss)):
         index_bev = config.detailed_losses.index("loss_bev")
         config.detailed_losses_weights[index_bev] = 0.0
@@ -162,20 +168,28 @@ def main():
     print ('Total trainable parameters: ', params)
 
     # Data
-    train_set = CARLA_Data(root=config.train_data, config=config, shared_dict=shared_dict)
-    val_set   = CARLA_Data(root=config.val_data,   config=config, shared_dict=shared_dict)
+    num_workers = 8 if parallel == True else 0
+    if (args.sample_cache_size > 0):
+        # Every process has its own cache that is shared by its data loader workers
+        sample_cache = SampleCache(size_limit=args.sample_cache_size * 1024 ** 3, directory=args.sample_cache_dir, max_workers=max(num_workers, 1))
+    else:
+        sample_cache = None
+    train_set = CARLA_Data(root=config.train_data, config=config, shared_dict=shared_dict, sample_cache=sample_cache)
+    val_set   = CARLA_Data(root=config.val_data,   config=config, shared_dict=shared_dict, sample_cache=sample_cache)
 
     g_cuda = torch.Generator(device='cpu')
+    # The raw LiDAR point clouds of the device augmentation have different sizes
+    collate_fn = collate_raw if config.device_augment else None
     g_cuda.manual_seed(torch.initial_seed())
 
     if(parallel == True):
         sampler_train = torch.utils.data.distributed.DistributedSampler(train_set, shuffle=True, num_replicas=world_size, rank=rank)
         sampler_val   = torch.utils.data.distributed.DistributedSampler(val_set,   shuffle=True, num_replicas=world_size, rank=rank)
-        dataloader_train = DataLoader(train_set, sampler=sampler_train, batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=8, pin_memory=True)
-        dataloader_val   = DataLoader(val_set,   sampler=sampler_val,   batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=8, pin_memory=True)
+        dataloader_train = DataLoader(train_set, sampler=sampler_train, batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=num_workers, pin_memory=True, collate_fn=collate_fn)
+        dataloader_val   = DataLoader(val_set,   sampler=sampler_val,   batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=num_workers, pin_memory=True, collate_fn=collate_fn)
     else:
-      dataloader_train = DataLoader(train_set, shuffle=True, batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=0, pin_memory=True)
-      dataloader_val   = DataLoader(val_set,   shuffle=True, batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=0, pin_memory=True)
+      dataloader_train = DataLoader(train_set, shuffle=True, batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=num_workers, pin_memory=True, collate_fn=collate_fn)
+      dataloader_val   = DataLoader(val_set,   shuffle=True, batch_size=args.batch_size, worker_init_fn=seed_worker, generator=g_cuda, num_workers=num_workers, pin_memory=True, collate_fn=collate_fn)
 
     # Create logdir
     if ((not os.path.isdir(args.logdir)) and (rank == 0)):
@@ -200,7 +214,7 @@ def main():
 
     trainer = Engine(model=model, optimizer=optimizer, dataloader_train=dataloader_train, dataloader_val=dataloader_val,
                      args=args, config=config, writer=writer, device=device, rank=rank, world_size=world_size,
-                     parallel=parallel, cur_epoch=args.start_epoch)
+                     parallel=parallel, cur_epoch=args.start_epoch, sample_cache=sample_cache)
 
     if args.wandb:
         wandb.watch(model, log="all")
@@ -228,13 +242,16 @@ def main():
         else:
             trainer.save()
 
+    if sample_cache is not None:
+        sample_cache.close()
+
 
 class Engine(object):
     """
     Engine that runs training.
     """
 
-    def __init__(self, model, optimizer, dataloader_train, dataloader_val, args, config, writer, device, rank=0, world_size=1, parallel=False, cur_epoch=0):
+    def __init__(self, model, optimizer, dataloader_train, dataloader_val, args, config, writer, device, rank=0, world_size=1, parallel=False, cur_epoch=0, sample_cache=None):
         self.cur_epoch = cur_epoch
         self.bestval_epoch = cur_epoch
         self.train_loss = []
@@ -251,6 +268,8 @@ class Engine(object):
         self.rank = rank
         self.world_size = world_size
         self.parallel = parallel
+        self.sample_cache = sample_cache
+        self.batch_augmenter = BatchAugmenter(config, device) if config.device_augment else None
         self.vis_save_path = self.args.logdir + r'/visualizations'
         if(self.config.debug == True):
             pathlib.Path(self.vis_save_path).mkdir(parents=True, exist_ok=True)
@@ -263,6 +282,8 @@ class Engine(object):
         self.detailed_weights = {key: detailed_losses_weights[idx] for idx, key in enumerate(self.detailed_losses)}
 
     def load_data_compute_loss(self, data):
+        if self.batch_augmenter is not None:
+            data = self.batch_augmenter(data)
         # Move data to GPU
         rgb = data['rgb'].to(self.device, dtype=torch.float32)
         if self.config.multitask:
@@ -335,6 +356,7 @@ class Engine(object):
             loss_epoch += float(loss.item())
 
         self.log_losses(loss_epoch, detailed_losses_epoch, num_batches, '')
+        self.log_sample_cache('')
 
 
     @torch.inference_mode() # Faster version of torch_no_grad
@@ -359,6 +381,7 @@ class Engine(object):
             loss_epoch += float(loss.item())
 
         self.log_losses(loss_epoch, detailed_val_losses_epoch, num_batches, 'val_')
+        self.log_sample_cache('val_')
         
 
     def log_losses(self, loss_epoch, detailed_losses_epoch, num_batches, prefix=''):
@@ -405,6 +428,25 @@ class Engine(object):
         if self.args.wandb:
                 wandb.log(dic)
 
+    def log_sample_cache(self, prefix=''):
+        if self.sample_cache is None:
+            return
+        stats = self.sample_cache.stats()
+        self.sample_cache.reset_stats()
+
+        gathered_stats = [None for _ in range(self.world_size)]
+        if (self.parallel == True):
+            torch.distributed.gather_object(obj=stats, object_gather_list=gathered_stats if self.rank == 0 else None, dst=0)
+        else:
+            gathered_stats[0] = stats
+
+        if (self.rank == 0):
+            hits = sum(stat[0] for stat in gathered_stats)
+            misses = sum(stat[1] for stat in gathered_stats)
+            self.writer.add_scalar(prefix + 'sample_cache_hits', hits, self.cur_epoch)
+            self.writer.add_scalar(prefix + 'sample_cache_misses', misses, self.cur_epoch)
+            self.writer.add_scalar(prefix + 'sample_cache_hit_rate', hits / max(hits + misses, 1), self.cur_epoch)
+
     def save(self):
         # NOTE saving the model with torch.save(model.module.state_dict(), PATH) if parallel processing is used would be cleaner, we keep it for backwards compatibility
         torch.save(self.model.state_dict(), os.path.join(self.args.logdir, 'model_%d.pth' % self.cur_epoch))
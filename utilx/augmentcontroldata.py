@@ -1,141 +1,111 @@
-import json
+"""
+Augments the control data of a dataset with the future controls of every frame.
+
+For every route the steer, throttle and brake of all measurements are read once into arrays. The window of a frame holds
+its own control and the ones of the next seq_len - 1 frames, the last control of the route is repeated at the end.
+The windows are written into one sidecar file per route (CONTROL_FILE) that LetFuser/data.py reads when it builds its
+sample index, the measurement files are not modified. Routes without a sidecar (e.g. added after this tool ran) still
+work, data.py then builds their windows from the measurements.
+
+Usage: python utilx/augmentcontroldata.py --root /path/to/dataset --seq_len 3 --workers 16
+"""
+
 import os
-import sys
+import json
+import argparse
 import logging
-import asyncio
-import time
-from tqdm import tqdm
+from multiprocessing import Pool
 
+import numpy as np
+from tqdm import tqdm
 
-Folder =[]
-# function that takes a queue, minmum length (m) and json file address as input and write 'vel' element 
-# of json file into queue and pop the last element of queue  
-def update_queue(queue_s, queue_t, queue_b, json_file):
-    # read json file
-    try:
-        with open(json_file) as f:
+# Sidecar of a route, keep in sync with LetFuser/data.py
+CONTROL_FILE = 'control_windows_%d.npz'
+CONTROLS = ('steer', 'throttle', 'brake')
+
+
+def find_routes(root):
+    """
+    Returns all route directories below root that have measurements.
+    """
+    routes = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if 'measurements' in dirnames:
+            routes.append(dirpath)
+            dirnames[:] = [] # Do not descend into the sensor folders
+    return sorted(routes)
+
+
+def read_controls(measurements_dir):
+    """
+    Reads the controls of all measurements of a route in frame order.
+    Returns the frame numbers [N] and a dict with the steer, throttle and brake arrays [N].
+    """
+    files = sorted(os.listdir(measurements_dir))
+    frames = np.array([int(file.split('.')[0]) for file in files], dtype=np.int32)
+    controls = {name: np.zeros(len(files), dtype=np.float32) for name in CONTROLS}
+    for i, file in enumerate(files):
+        with open(os.path.join(measurements_dir, file)) as f:
             data = json.load(f)
-    except:
-        logging.error('Failed to read {} file'.format(json_file))
-        return None
-    # append tuple element of json file into queue
-    queue_s.append(data['steer'] if type(data['steer'])==type(0.1) else data['steer'][0])
-    queue_t.append(data['throttle'] if type(data['throttle'])==type(0.1) else data['throttle'][0])
-    queue_b.append(data['brake'] if type(data['brake'])==type(True) else data['brake'][0])
+        for name in CONTROLS:
+            value = data[name]
+            # measurements that were augmented by the old version of this tool hold a list that starts with the own control
+            controls[name][i] = value[0] if isinstance(value, list) else value
+    return frames, controls
 
-    # pop the last element of queue
-    queue_s.pop(0)
-    queue_t.pop(0)
-    queue_b.pop(0)
 
-    return queue_s, queue_t, queue_b
+def control_windows(values, seq_len):
+    """
+    Windows [N, seq_len] of values and its seq_len - 1 successors, padded with the last value.
+    """
+    padded = np.concatenate([values, np.repeat(values[-1:], seq_len - 1)])
+    return np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(padded, seq_len))
 
-# function that takes a queue and json file address as input and write queue into 'vel' element of json      
-def update_json(queue_s, queue_t, queue_b, json_file):
-    #read a json file 
 
-    
-    with open(json_file) as f:
-        data = json.load(f)
-
-    # write queue into control elements of json 
-    data['steer'],data['throttle'], data['brake']  = queue_s, queue_t, queue_b 
-
-    # dump data to json file
+def augment_route(args):
+    route_dir, seq_len = args
     try:
-        with open(json_file, 'w') as f:
-            json.dump(data, f, indent=2)
-        return True
-    except:
-        return False
-
-def background(f):
-    def wrapped(*args, **kwargs):
-        return asyncio.get_event_loop().run_in_executor(None, f, *args, **kwargs)
-    return wrapped
-
-# function that takes folder address as input and call update_queue function for each json file in the folder sorted according to their names
-# then wait to have at least m elements in queue and call update_json function for each json file in the folder sorted according to their names
-@background
-def get_queue(folder,seq_len):
-    start = time.time()
-    
-    # get list of json files in the folder sorted according to their names 
-    files = sorted(os.listdir(folder))
-
-    # initialize queue
-    queue_s = [0 for _ in range(seq_len)]
-    queue_t = [0 for _ in range(seq_len)]
-    queue_b = [0 for _ in range(seq_len)]
-
-    # call update_queue function for each json file in the folder sorted according to their names
-    for ind, file in enumerate(files):
-        queue_s, queue_t, queue_b = update_queue(queue_s, queue_t, queue_b, os.path.join(folder, file))
-        if not queue_s or not queue_b or not queue_t:
-            return None
-        if ind>=seq_len-1:
-            log = update_json(queue_s, queue_t, queue_b, os.path.join(folder, files[ind-seq_len+1]))
-            # if update_json return False, write the failed file name in logging.error
-            if not log:
-                if log == False:
-                    logging.error('failed to write {} file in {} folder'.format(files[ind-seq_len+1], folder))
-                
-                
-    # continue to update json for the last m files     
-    for i in range(seq_len-1,0, -1):
-        queue_s.append(queue_s[-1])
-        queue_t.append(queue_t[-1])
-        queue_b.append(queue_b[-1])
-        queue_s.pop(0)
-        queue_t.pop(0)
-        queue_b.pop(0)
-        update_json(queue_s,queue_t, queue_b, os.path.join(folder, files[-i]))
-    
-    #logging.info('Processing folder: {} Executed elpsed time: {}'.format(folder, time.time()-start))
-    Folder.append(folder.split('/')[-2])
-    # return folder.split('/')[-1] 
-
-def main(root,seq_len,nt):
-    sub_folders = os.listdir(root)
-    sub_folders = [sub_folders[0]]
-    ins = []
-    prog_bar = tqdm(total=nt)
-    for folders in sub_folders:
-        rfolders = os.path.join(root, folders)
-        sub_routes = os.listdir(rfolders)
-        for routes in sub_routes:
-            rroutes = os.path.join(rfolders, routes)
-            samples = os.listdir(rroutes)
-            for sample in samples:
-                rsample = os.path.join(rroutes, sample)
-                if os.path.isdir(rsample):
-                    # to keep track
-                    ins.append(sample)
-                    get_queue(os.path.join(rsample, 'measurements'),seq_len)
-                    #folder = get_queue(os.path.join(rsample, 'measurements'),seq_len) 
-                    #outs.append(folder)
-                    #prog_bar.set_postfix(sample)
-                    prog_bar.update(1)
-            time.sleep(20*len(samples)/7)
-    prog_bar.close()     
-    return ins#list(set(ins)-set(outs) 
-
-# main function that call get_stack for a sample data folder
-if __name__ == '__main__':
-    logging.basicConfig(filename='./utilx/log.txt', level=logging.DEBUG)
-    start = time.time()
-    data_address = '/localhome/pagand/projects/e2etransfuser/transfuser_pmlr/data0'
-    ntotal = 45 # total folders
-    ins = main(data_address,seq_len=3,nt = ntotal)
-    print('Waiting for all background process to finish ...')
-    time.sleep(ntotal/10)
-    logging.info('Number of incomplete files: {}'.format(len(ins)- len(Folder)))
-    logging.info('Incompleted folders: {}'.format(list(set(ins)-set(Folder))))
-    # all_tasks = asyncio.all_tasks()
-    # await asyncio.wait(all_tasks) 
-
-
-
-    logging.info('TOTAL elapsed time {}'.format( time.time()-start))
+        frames, controls = read_controls(os.path.join(route_dir, 'measurements'))
+    except (OSError, ValueError, KeyError) as e:
+        logging.error('Failed to read the measurements of {}: {}'.format(route_dir, e))
+        return route_dir, 0
+    if len(frames) == 0:
+        return route_dir, 0
+
+    windows = {name: control_windows(values, seq_len) for name, values in controls.items()}
+    # Write to a temporary file first, so an interrupted run never leaves a truncated sidecar
+    sidecar = os.path.join(route_dir, CONTROL_FILE % seq_len)
+    tmp_file = sidecar + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, frames=frames, **windows)
+    os.replace(tmp_file, sidecar)
+    return route_dir, len(frames)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', type=str, required=True, help='Root directory of the dataset that should be augmented.')
+    parser.add_argument('--seq_len', type=int, default=3, help='Number of controls per frame, pred_len of the LetFuser config.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of routes that are processed in parallel.')
+    args = parser.parse_args()
+
+    routes = find_routes(args.root)
+    print('Augmenting the controls of %d routes' % len(routes))
+
+    num_frames = 0
+    skipped = []
+    with Pool(args.workers) as pool:
+        jobs = [(route, args.seq_len) for route in routes]
+        for route, frames in tqdm(pool.imap_unordered(augment_route, jobs), total=len(jobs)):
+            num_frames += frames
+            if frames == 0:
+                skipped.append(route)
+    print('Augmented %d frames' % num_frames)
+    if skipped:
+        print('No sidecar was written for %d routes, their control windows are built from the measurements:' % len(skipped))
+        for route in sorted(skipped):
+            print('  ' + route)
 
 
+if __name__ == '__main__':
+    main()
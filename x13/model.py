@@ -213,7 +213,6 @@ class x13(nn.Module): #
         #proses awal
         depth_in = depth * 1000.0 #normalize to 1 - 1000
         _, label_img = torch.max(semseg, dim=1) #pada axis C
-        cloud_data_n = torch.ravel(torch.tensor([[n for _ in range(self.h*self.w)] for n in range(depth.shape[0])])).to(self.gpu_device)
         
         #normalize to frame
         cloud_data_x = torch.round(((depth_in * self.x_matrix) + (self.cover_area[1]/2)) * (self.w-1) / self.cover_area[1]).ravel()
@@ -221,13 +220,12 @@ class x13(nn.Module): #
 
         #find the interest index
         bool_xz = torch.logical_and(torch.logical_and(cloud_data_x <= self.w-1, cloud_data_x >= 0), torch.logical_and(cloud_data_z <= self.h-1, cloud_data_z >= 0))
-        idx_xz = bool_xz.nonzero().squeeze() #remove axis with size=1, so no need to add ".item()" later
 
-        #stack n x z cls dan plot
-        coorx = torch.stack([cloud_data_n, label_img.ravel(), cloud_data_z, cloud_data_x])
-        coor_clsn = torch.unique(coorx[:, idx_xz], dim=1).long() #tensor must be long so that it can be used as an index
+        #flat NCHW index of every point, duplicates all write 1.0 so there is no need for torch.unique
+        n_cls = torch.arange(depth.shape[0], device=label_img.device).view(-1, 1, 1) * semseg.shape[1] + label_img
+        idx_nczx = ((n_cls.ravel() * self.h + cloud_data_z.long()) * self.w + cloud_data_x.long())[bool_xz]
         top_view_sc = torch.zeros_like(semseg) #this is faster because automatically the size, data type, and device are the same as those of the input (semseg)
-        top_view_sc[coor_clsn[0], coor_clsn[1], coor_clsn[2], coor_clsn[3]] = 1.0 #axis format from NCHW
+        top_view_sc.view(-1)[idx_nczx] = 1.0
 
 
         return top_view_sc